@@ -1,35 +1,74 @@
 import os
+import time
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 
 # Añadimos el parámetro 'config_overrides'
 def create_app(config_overrides=None):
+    inicio = time.perf_counter()
     app = Flask(__name__)
     
     # Configuración por defecto (Base de datos)
-    app.config['SECRET_KEY'] = 'clave-secreta-proyecto-unam'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///marketplace.db'
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'clave-secreta-proyecto-unam')
+    # DATABASE_URL permite usar un servidor de BD en producción
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///marketplace.db')
     app.config['UPLOAD_FOLDER'] = os.path.join(app.static_folder, 'uploads')
     
     #  Si nos pasan una config de prueba, la usamos ANTES de conectar la BD
     if config_overrides:
         app.config.update(config_overrides)
+
+    # Detrás de un proxy inverso: cuántos saltos de X-Forwarded-For son de
+    # confianza. Sin esto remote_addr es la IP del proxy y los límites de login
+    # por IP (contrasenas.py) agrupan a todos los clientes en una sola clave.
+    app.config.setdefault('PROXY_X_FOR', int(os.environ.get('PROXY_X_FOR', 0)))
+    if app.config['PROXY_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_X_FOR'],
+                                x_proto=app.config.get('PROXY_X_PROTO', 0))
     
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    
+    from . import basedatos
+    # Pool, WAL y demás ajustes del motor (antes de la primera conexión)
+    basedatos.configurar(app)
     db.init_app(app)
+    basedatos.init_app(app)
+
+    from . import archivo, cache, cambios, carrito, contrasenas, estaticos, eventos, facetas, fragmentos, identidad, imagenes, metricas, migraciones, recomendaciones, salud, trabajos, ventas
+    cache.init_app(app)
+    carrito.init_app(app)
+    eventos.init_app(app)
+    # URLs con huella, cache inmutable y compresión gzip/brotli
+    estaticos.init_app(app)
+    # {% cache ... %} en plantillas: fragmentos versionados por updated_at
+    fragmentos.init_app(app)
+    facetas.init_app(app)
+    cambios.init_app(app)
+    imagenes.init_app(app)
+    ventas.init_app(app)
+    # "Se compra junto con": co-ocurrencias de productos en memoria
+    recomendaciones.init_app(app)
+    # Cola durable de trabajos posteriores al checkout (outbox + hilos)
+    trabajos.init_app(app)
+    # Pedidos entregados antiguos al almacén frío (flask archivar-pedidos)
+    archivo.init_app(app)
+    # Conteo de consultas SQL, tiempos y detección de N+1 por petición
+    metricas.init_app(app)
+    # /salud/vivo y /salud/listo para el balanceador / orquestador
+    salud.init_app(app)
+    migraciones.init_app(app)
+    # Usuario en cache entre peticiones y hash de contraseñas en un pool acotado
+    identidad.init_app(app)
+    contrasenas.init_app(app)
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
 
-    from .models import Usuario
-
     @login_manager.user_loader
     def load_user(id):
-        return db.session.get(Usuario, int(id)) # Actualizado para evitar el warning Legacy
+        return identidad.cargar(int(id))
 
     # Registro de Blueprints
     from .auth import auth as auth_blueprint
@@ -50,7 +89,18 @@ def create_app(config_overrides=None):
         from flask import render_template
         return render_template('404.html'), 404
     
-    with app.app_context():
-        db.create_all()
-        
-    return app
\ No newline at end of file
+    # En desarrollo y pruebas el esquema se crea al arrancar. En producción
+    # (wsgi.py) lo hace 'flask init-db' una vez por despliegue y cada worker
+    # arranca sin tocar la BD (las recomendaciones se arman en segundo plano
+    # con la primera petición que las usa).
+    if app.config.get('ESQUEMA_AUTOMATICO', True):
+        migraciones.inicializar(app)
+        with app.app_context():
+            recomendaciones.reconstruir()
+    else:
+        with app.app_context():
+            app.extensions['busqueda_fts'] = app.extensions['facetas_triggers'] = \
+                app.extensions['cambios_triggers'] = db.engine.dialect.name == 'sqlite'
+
+    salud.registrar_arranque(app, inicio)
+    return app
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+import click
+import sqlalchemy as sa
+from .models import Pedido, PedidoArchivado, PedidoItem, PedidoItemArchivado, db
+
+# Archivo de pedidos viejos.
+# Los pedidos entregados hace más de N meses se copian a pedido_archivado /
+# pedido_item_archivado y se borran de las tablas calientes, por lotes y en
+# transacciones cortas para no bloquear el checkout mientras corre.
+
+LOTE = 1000
+_COLUMNAS_PEDIDO = ['id', 'fecha', 'estado', 'total', 'tipo_entrega', 'metodo_pago', 'cliente_id', 'repartidor_id',
+                    'destino_lat', 'destino_lon', 'celda', 'updated_at']
+_COLUMNAS_ITEM = ['id', 'pedido_id', 'producto_id', 'cantidad', 'precio_unitario']
+
+
+def archivar(meses=6, lote=LOTE):
+    """Mueve los pedidos entregados anteriores al corte; devuelve cuántos movió."""
+    corte = datetime.utcnow() - timedelta(days=30 * meses)
+    # El pedido más reciente nunca se mueve: SQLite reusaría su id (y el de sus
+    # items) para el siguiente pedido y chocaría con el archivado.
+    ultimo = db.session.scalar(sa.select(sa.func.max(Pedido.id))) or 0
+    movidos = 0
+    while True:
+        ids = db.session.scalars(
+            sa.select(Pedido.id)
+            .where(Pedido.estado == 'entregado', Pedido.fecha < corte, Pedido.id < ultimo)
+            .order_by(Pedido.id).limit(lote)).all()
+        if not ids:
+            return movidos
+        db.session.execute(sa.insert(PedidoArchivado).from_select(
+            _COLUMNAS_PEDIDO,
+            sa.select(*[getattr(Pedido, c) for c in _COLUMNAS_PEDIDO]).where(Pedido.id.in_(ids))))
+        db.session.execute(sa.insert(PedidoItemArchivado).from_select(
+            _COLUMNAS_ITEM,
+            sa.select(*[getattr(PedidoItem, c) for c in _COLUMNAS_ITEM]).where(PedidoItem.pedido_id.in_(ids))))
+        db.session.execute(sa.delete(PedidoItem).where(PedidoItem.pedido_id.in_(ids)))
+        db.session.execute(sa.delete(Pedido).where(Pedido.id.in_(ids)))
+        db.session.commit()
+        movidos += len(ids)
+
+
+def init_app(app):
+    @app.cli.command('archivar-pedidos')
+    @click.option('--meses', default=6, show_default=True, help='Antigüedad mínima de los pedidos entregados.')
+    def archivar_pedidos_cmd(meses):
+        """Mueve los pedidos entregados antiguos al almacén frío."""
+        click.echo('%d pedidos archivados.' % archivar(meses))
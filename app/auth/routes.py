@@ -1,17 +1,35 @@
 from flask import render_template, redirect, url_for, flash, request
 from flask_login import login_user, logout_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
 from ..models import Usuario, db
+from .. import contrasenas, geo
 from . import auth
 
+def _rechazar(mensaje, plantilla, codigo):
+    flash(mensaje)
+    return render_template(plantilla), codigo
+
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form.get('email')
         password = request.form.get('password')
+        if not contrasenas.limitar(request.remote_addr, email):
+            return _rechazar('Demasiados intentos. Espera un minuto.', 'auth/login.html', 429)
+
         usuario = Usuario.query.filter_by(email=email).first()
-        
-        if usuario and check_password_hash(usuario.password, password):
+        hashes = contrasenas.pool()
+        try:
+            # El hash corre en el pool acotado (también si el correo no existe)
+            valido = hashes.verificar(usuario.password if usuario else None, password)
+            if valido and hashes.necesita_rehash(usuario.password):
+                # Contraseña con parámetros viejos: se actualiza al configurado
+                usuario.password = hashes.generar(password)
+                db.session.commit()
+        except contrasenas.Ocupado:
+            return _rechazar('Servidor ocupado, intenta de nuevo.', 'auth/login.html', 503)
+
+        if usuario and valido:
+            contrasenas.reiniciar_email(email)
             login_user(usuario)
             if usuario.rol == 'tienda':
                 return redirect(url_for('inventario.dashboard'))
@@ -31,15 +49,27 @@ def registro():
         rol = request.form.get('rol')
         telefono = request.form.get('telefono') 
         
+        if not contrasenas.limitar(request.remote_addr, email):
+            return _rechazar('Demasiados intentos. Espera un minuto.', 'auth/registro.html', 429)
+
         if Usuario.query.filter_by(email=email).first():
             flash('Correo ya registrado.')
             return redirect(url_for('auth.registro'))
+
+        try:
+            password_hash = contrasenas.pool().generar(password)
+        except contrasenas.Ocupado:
+            return _rechazar('Servidor ocupado, intenta de nuevo.', 'auth/registro.html', 503)
         
+        # Ubicación opcional (dirección de la tienda o domicilio del cliente)
+        ubicacion = geo.coordenadas(request.form.get('lat'), request.form.get('lon')) or (None, None)
         nuevo_usuario = Usuario(
             email=email, nombre=nombre, 
-            password=generate_password_hash(password),
+            password=password_hash,
             rol=rol,
-            telefono=telefono 
+            telefono=telefono,
+            direccion_tienda=request.form.get('direccion') or None,
+            lat=ubicacion[0], lon=ubicacion[1]
         )
         
         db.session.add(nuevo_usuario)
@@ -0,0 +1,52 @@
+import os
+import sqlalchemy as sa
+from . import db
+
+# Perfil de producción de la base de datos.
+# - URI y tamaño de pool vienen de la configuración/entorno, así se puede
+#   cambiar SQLite por un servidor (PostgreSQL, MySQL) sin tocar código.
+# - En SQLite cada conexión nueva se ajusta para concurrencia: WAL permite
+#   leer mientras otro escribe y busy_timeout espera en vez de fallar con
+#   "database is locked".
+
+
+def configurar(app):
+    """Completa las opciones del motor a partir de la config y variables de entorno."""
+    app.config.setdefault('DB_POOL_SIZE', int(os.environ.get('DB_POOL_SIZE', 10)))
+    app.config.setdefault('DB_MAX_OVERFLOW', int(os.environ.get('DB_MAX_OVERFLOW', 20)))
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT_MS', 5000)
+    app.config.setdefault('SQLITE_MMAP_BYTES', 256 * 1024 * 1024)
+
+    uri = sa.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    opciones = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    if uri.get_backend_name() == 'sqlite':
+        # El driver también espera por el candado (segundos)
+        opciones.setdefault('connect_args', {}).setdefault(
+            'timeout', app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000)
+    else:
+        opciones.setdefault('pool_size', app.config['DB_POOL_SIZE'])
+        opciones.setdefault('max_overflow', app.config['DB_MAX_OVERFLOW'])
+        opciones.setdefault('pool_pre_ping', True)
+        opciones.setdefault('pool_recycle', 1800)
+
+
+def _pragmas_sqlite(app):
+    en_memoria = app.config['SQLALCHEMY_DATABASE_URI'] in ('sqlite://', 'sqlite:///:memory:')
+
+    def al_conectar(conexion, _):
+        cursor = conexion.cursor()
+        if not en_memoria:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA mmap_size=%d' % app.config['SQLITE_MMAP_BYTES'])
+        # Con WAL, NORMAL es seguro ante caídas de la app (solo no ante cortes de luz)
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % app.config['SQLITE_BUSY_TIMEOUT_MS'])
+        cursor.close()
+
+    return al_conectar
+
+
+def init_app(app):
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            sa.event.listen(db.engine, 'connect', _pragmas_sqlite(app))
@@ -0,0 +1,89 @@
+import re
+import sqlalchemy as sa
+from flask import current_app
+from . import db
+
+# Índice de texto completo del catálogo (SQLite FTS5).
+# Es una tabla "external content": el texto vive en 'producto' y el índice
+# solo guarda los tokens. Los triggers lo mantienen sincronizado en cualquier
+# INSERT/UPDATE/DELETE (alta de productos, ajustes de stock, checkout...).
+# 'remove_diacritics 2' pliega acentos: "azucar" encuentra "Azúcar".
+
+_DDL_INDICE = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS producto_fts USING fts5(
+        nombre, descripcion, categoria,
+        content='producto', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS producto_fts_ai AFTER INSERT ON producto BEGIN
+        INSERT INTO producto_fts(rowid, nombre, descripcion, categoria)
+        VALUES (new.id, new.nombre, new.descripcion, new.categoria);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS producto_fts_ad AFTER DELETE ON producto BEGIN
+        INSERT INTO producto_fts(producto_fts, rowid, nombre, descripcion, categoria)
+        VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria);
+    END""",
+    # Solo reindexa si cambia el texto; los cambios de stock no tocan el índice
+    """CREATE TRIGGER IF NOT EXISTS producto_fts_au AFTER UPDATE OF nombre, descripcion, categoria ON producto BEGIN
+        INSERT INTO producto_fts(producto_fts, rowid, nombre, descripcion, categoria)
+        VALUES ('delete', old.id, old.nombre, old.descripcion, old.categoria);
+        INSERT INTO producto_fts(rowid, nombre, descripcion, categoria)
+        VALUES (new.id, new.nombre, new.descripcion, new.categoria);
+    END""",
+]
+
+# Pesos BM25 por columna: nombre > categoria > descripcion
+_PESOS = (10.0, 2.0, 5.0)
+
+_fts = sa.table('producto_fts', sa.column('rowid'))
+_tabla_fts = sa.literal_column('producto_fts')
+
+
+def crear_indice(engine):
+    """Crea el índice FTS5 y sus triggers. Devuelve False si el motor no es SQLite."""
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as conn:
+        existia = conn.execute(sa.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'producto_fts'")).first()
+        for ddl in _DDL_INDICE:
+            conn.execute(sa.text(ddl))
+        if not existia:
+            # Base de datos previa al índice: indexar lo que ya existe
+            conn.execute(sa.text("INSERT INTO producto_fts(producto_fts) VALUES ('rebuild')"))
+    return True
+
+
+def reconstruir_indice():
+    """Reindexa todo el catálogo (útil tras cargas masivas hechas fuera de la app)."""
+    if current_app.extensions.get('busqueda_fts'):
+        db.session.execute(sa.text("INSERT INTO producto_fts(producto_fts) VALUES ('rebuild')"))
+        db.session.commit()
+
+
+def terminos(texto):
+    return re.findall(r'\w+', (texto or '').lower())
+
+
+def filtrar(query, texto):
+    """Aplica la búsqueda de 'texto' a una consulta de Producto, ordenada por relevancia."""
+    from .models import Producto
+
+    palabras = terminos(texto)
+    if not palabras:
+        return query
+
+    if not current_app.extensions.get('busqueda_fts'):
+        # Motor sin FTS5: búsqueda simple en nombre, descripción y categoría
+        for palabra in palabras:
+            query = query.filter(sa.or_(Producto.nombre.contains(palabra),
+                                        Producto.descripcion.contains(palabra),
+                                        Producto.categoria.contains(palabra)))
+        return query
+
+    # Cada palabra va entre comillas (sin sintaxis FTS del usuario) y como
+    # prefijo, para que la búsqueda funcione mientras se escribe.
+    consulta = ' '.join('"%s"*' % p for p in palabras)
+    return (query.join(_fts, _fts.c.rowid == Producto.id)
+                 .filter(_tabla_fts.op('MATCH')(consulta))
+                 .order_by(sa.func.bm25(_tabla_fts, *_PESOS)))
@@ -0,0 +1,146 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+import sqlalchemy as sa
+from flask import current_app, g, request
+from .models import VersionCatalogo, db
+
+
+class CacheLRU:
+    """Cache en memoria con expulsión LRU y caducidad (TTL), segura entre hilos."""
+
+    def __init__(self, max_items=256, ttl=300):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clave, default=None):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None or entrada[1] < time.monotonic():
+                if entrada is not None:
+                    del self._datos[clave]
+                self.misses += 1
+                return default
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return entrada[0]
+
+    def set(self, clave, valor, ttl=None):
+        caduca = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._datos[clave] = (valor, caduca)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def delete(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+
+    def __len__(self):
+        return len(self._datos)
+
+    def estadisticas(self):
+        return {'items': len(self._datos), 'max_items': self.max_items, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class CacheCatalogo(CacheLRU):
+    """Cache de respuestas del catálogo validada contra la versión guardada en la BD.
+
+    Cada escritura que cambia el catálogo (alta de producto, ajuste de stock,
+    importación, checkout) llama a invalidar() antes de su commit: sube el
+    contador de la fila version_catalogo en la misma transacción. Cada
+    petición lee esa fila una vez, así que todos los workers (y los
+    reinicios) comparten versión, Last-Modified y ETag; las entradas locales
+    de versiones anteriores quedan inalcanzables y salen por LRU.
+    """
+
+    def vigente(self):
+        """(version, modificado) actuales; una consulta por llave primaria por petición."""
+        if 'version_catalogo' not in g:
+            fila = db.session.execute(
+                sa.select(VersionCatalogo.version, VersionCatalogo.modificado)
+                .where(VersionCatalogo.id == 1)).first()
+            version, modificado = fila or (0, datetime(1970, 1, 1))
+            g.version_catalogo = version, modificado.replace(tzinfo=timezone.utc)
+        return g.version_catalogo
+
+    @property
+    def version(self):
+        return self.vigente()[0]
+
+    @property
+    def modificado(self):
+        return self.vigente()[1]
+
+    def invalidar(self):
+        """Sube la versión en la transacción actual (no hace commit)."""
+        # Last-Modified / If-Modified-Since solo tienen segundos: se guarda igual
+        # para que el cliente que devuelve el encabezado reciba 304. Dos
+        # escrituras en el mismo segundo las distingue el ETag (lleva la versión).
+        ahora = datetime.utcnow().replace(microsecond=0)
+        cambio = sa.update(VersionCatalogo).where(VersionCatalogo.id == 1).values(
+            version=VersionCatalogo.version + 1, modificado=ahora)
+        if db.session.execute(cambio).rowcount == 0:
+            db.session.add(VersionCatalogo(id=1, version=1, modificado=ahora))
+        g.pop('version_catalogo', None)
+        self.clear()
+
+    def etag(self, *partes):
+        version, modificado = self.vigente()
+        # La fecha distingue versiones con el mismo número en otra BD (p. ej. recreada)
+        firma = repr((version, modificado.isoformat()) + partes).encode('utf-8')
+        return 'v%d-%s' % (version, hashlib.sha1(firma).hexdigest()[:16])
+
+    def no_modificado(self, etag):
+        """True si el cliente ya tiene esta versión (If-None-Match / If-Modified-Since)."""
+        if request.if_none_match:
+            # Débil: la respuesta pudo viajar comprimida con el ETag marcado W/
+            return request.if_none_match.contains_weak(etag)
+        return bool(request.if_modified_since and request.if_modified_since >= self.modificado.replace(microsecond=0))
+
+    def marcar(self, respuesta, etag):
+        respuesta.set_etag(etag)
+        respuesta.last_modified = self.modificado.replace(microsecond=0)
+        # El navegador puede guardarla, pero debe revalidar con el ETag
+        respuesta.cache_control.no_cache = True
+        return respuesta
+
+    def estadisticas(self):
+        datos = super().estadisticas()
+        datos.update(version=self.version, modificado=self.modificado.isoformat())
+        return datos
+
+
+def init_app(app):
+    app.extensions['cache_catalogo'] = CacheCatalogo(
+        max_items=app.config.get('CATALOGO_CACHE_MAX', 256),
+        ttl=app.config.get('CATALOGO_CACHE_TTL', 300))
+
+
+def crear_version(engine):
+    """Crea la fila de versión del catálogo si no existe."""
+    with engine.begin() as conn:
+        if conn.execute(sa.select(VersionCatalogo.id).where(VersionCatalogo.id == 1)).first() is None:
+            conn.execute(sa.insert(VersionCatalogo).values(id=1, version=1,
+                                                           modificado=datetime.utcnow().replace(microsecond=0)))
+
+
+def cache_catalogo():
+    return current_app.extensions['cache_catalogo']
+
+
+def invalidar_catalogo():
+    """Marca el catálogo como cambiado; llamar antes del commit de la escritura."""
+    cache_catalogo().invalidar()
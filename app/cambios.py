@@ -0,0 +1,102 @@
+import click
+import sqlalchemy as sa
+from . import db
+
+# Bitácora de cambios del catálogo para clientes que lo replican.
+# Los triggers sobre 'producto' agregan una fila por cada cambio visible en la
+# API: alta con stock, cambio de datos, entrada o salida de existencia (el
+# checkout que deja un producto en 0 genera una 'baja') y eliminación.
+# Bajar de 10 a 9 unidades no genera nada: el stock no viaja en la API.
+# El id de la fila es el cursor: el cliente pide "cambios después de N".
+
+_CAMPOS_VISIBLES = ('nombre', 'precio', 'categoria', 'tipo', 'imagen', 'tienda_id')
+
+_DDL_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS cambio_producto_ai AFTER INSERT ON producto
+       WHEN new.stock_actual > 0 BEGIN
+        INSERT INTO cambio_producto(producto_id, op) VALUES (new.id, 'upsert');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS cambio_producto_au AFTER UPDATE OF %s, stock_actual ON producto
+       WHEN (new.stock_actual > 0) != (old.stock_actual > 0)
+         OR (new.stock_actual > 0 AND (%s)) BEGIN
+        INSERT INTO cambio_producto(producto_id, op)
+        VALUES (new.id, CASE WHEN new.stock_actual > 0 THEN 'upsert' ELSE 'baja' END);
+    END""" % (', '.join(_CAMPOS_VISIBLES),
+              ' OR '.join('new.%s IS NOT old.%s' % (c, c) for c in _CAMPOS_VISIBLES)),
+    """CREATE TRIGGER IF NOT EXISTS cambio_producto_ad AFTER DELETE ON producto
+       WHEN old.stock_actual > 0 BEGIN
+        INSERT INTO cambio_producto(producto_id, op) VALUES (old.id, 'baja');
+    END""",
+    # El nombre de la tienda viaja con cada producto
+    """CREATE TRIGGER IF NOT EXISTS cambio_producto_tienda AFTER UPDATE OF nombre ON usuario
+       WHEN new.nombre IS NOT old.nombre BEGIN
+        INSERT INTO cambio_producto(producto_id, op)
+        SELECT id, 'upsert' FROM producto WHERE tienda_id = new.id AND stock_actual > 0;
+    END""",
+]
+
+
+def crear_triggers(engine):
+    """Instala los triggers de la bitácora. Devuelve False si el motor no es SQLite."""
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as conn:
+        existia = conn.execute(sa.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'cambio_producto_ai'")).first()
+        for ddl in _DDL_TRIGGERS:
+            conn.execute(sa.text(ddl))
+        if not existia:
+            # Base de datos previa a la bitácora: since=0 trae todo el catálogo
+            conn.execute(sa.text(
+                "INSERT INTO cambio_producto(producto_id, op) "
+                "SELECT id, 'upsert' FROM producto WHERE stock_actual > 0 ORDER BY id"))
+    return True
+
+
+def desde(cursor, limite):
+    """Hasta 'limite' cambios con id > cursor: ([(producto_id, op)], ultimo_id, hay_mas).
+
+    Si un producto aparece varias veces en el tramo solo cuenta su último cambio.
+    """
+    from .models import CambioProducto
+
+    filas = db.session.execute(
+        sa.select(CambioProducto.id, CambioProducto.producto_id, CambioProducto.op)
+        .where(CambioProducto.id > cursor)
+        .order_by(CambioProducto.id).limit(limite + 1)).all()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    ultimos = {}
+    for _, producto_id, op in filas:
+        ultimos.pop(producto_id, None)
+        ultimos[producto_id] = op
+    return list(ultimos.items()), (filas[-1][0] if filas else cursor), hay_mas
+
+
+def ultimo_id():
+    from .models import CambioProducto
+
+    return db.session.scalar(sa.select(sa.func.max(CambioProducto.id))) or 0
+
+
+def compactar():
+    """Borra los cambios que ya reemplazó otro posterior del mismo producto.
+
+    Un cliente con cualquier cursor sigue recibiendo el estado final de cada
+    producto; solo se ahorra espacio y filas por recorrer.
+    """
+    from .models import CambioProducto
+
+    vigentes = sa.select(sa.func.max(CambioProducto.id)).group_by(CambioProducto.producto_id)
+    borrados = db.session.execute(
+        sa.delete(CambioProducto).where(CambioProducto.id.not_in(vigentes))
+        .execution_options(synchronize_session=False)).rowcount
+    db.session.commit()
+    return borrados
+
+
+def init_app(app):
+    @app.cli.command('compactar-cambios')
+    def compactar_cambios_cmd():
+        """Quita de la bitácora de cambios las filas reemplazadas."""
+        click.echo('%d cambios reemplazados eliminados.' % compactar())
@@ -0,0 +1,133 @@
+import threading
+from collections import Counter
+from flask import current_app, session
+from flask_login import current_user
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from .models import CarritoItem, db
+
+# El carrito vive en el servidor como {producto_id: cantidad} por usuario.
+# La cookie de sesión solo guarda el total de unidades ('carrito_n') para
+# pintar el contador del menú sin consultar la BD.
+
+
+class CarritoSQL:
+    """Carrito en la tabla carrito_item (llave única usuario + producto)."""
+
+    def obtener(self, usuario_id):
+        return dict(db.session.execute(
+            sa.select(CarritoItem.producto_id, CarritoItem.cantidad)
+            .where(CarritoItem.usuario_id == usuario_id)).all())
+
+    def agregar(self, usuario_id, producto_id, cantidad=1):
+        dialecto = db.session.get_bind().dialect.name
+        if dialecto in ('sqlite', 'postgresql'):
+            insert = (sqlite if dialecto == 'sqlite' else postgresql).insert(CarritoItem)
+            db.session.execute(insert.values(usuario_id=usuario_id, producto_id=producto_id, cantidad=cantidad)
+                               .on_conflict_do_update(
+                                   index_elements=['usuario_id', 'producto_id'],
+                                   set_={'cantidad': CarritoItem.cantidad + insert.excluded.cantidad}))
+        else:
+            item = db.session.get(CarritoItem, (usuario_id, producto_id))
+            if item is None:
+                db.session.add(CarritoItem(usuario_id=usuario_id, producto_id=producto_id, cantidad=cantidad))
+            else:
+                item.cantidad += cantidad
+        db.session.commit()
+
+    def fijar(self, usuario_id, producto_id, cantidad):
+        if cantidad <= 0:
+            db.session.execute(sa.delete(CarritoItem).where(CarritoItem.usuario_id == usuario_id,
+                                                            CarritoItem.producto_id == producto_id))
+            db.session.commit()
+            return
+        resultado = db.session.execute(
+            sa.update(CarritoItem)
+            .where(CarritoItem.usuario_id == usuario_id, CarritoItem.producto_id == producto_id)
+            .values(cantidad=cantidad))
+        if resultado.rowcount == 0:
+            db.session.add(CarritoItem(usuario_id=usuario_id, producto_id=producto_id, cantidad=cantidad))
+        db.session.commit()
+
+    def quitar(self, usuario_id, producto_id, cantidad=1):
+        db.session.execute(
+            sa.update(CarritoItem)
+            .where(CarritoItem.usuario_id == usuario_id, CarritoItem.producto_id == producto_id)
+            .values(cantidad=CarritoItem.cantidad - cantidad))
+        db.session.execute(sa.delete(CarritoItem).where(CarritoItem.usuario_id == usuario_id,
+                                                        CarritoItem.producto_id == producto_id,
+                                                        CarritoItem.cantidad <= 0))
+        db.session.commit()
+
+    def vaciar(self, usuario_id, commit=True):
+        db.session.execute(sa.delete(CarritoItem).where(CarritoItem.usuario_id == usuario_id))
+        if commit:
+            db.session.commit()
+
+
+class CarritoMemoria:
+    """Carrito en un diccionario del proceso (pruebas o un solo worker).
+
+    Sirve de ejemplo de backend clave-valor: cualquier objeto con los mismos
+    métodos (p. ej. sobre hashes de Redis) puede configurarse en CARRITO_BACKEND.
+    """
+
+    def __init__(self):
+        self._datos = {}
+        self._lock = threading.Lock()
+
+    def obtener(self, usuario_id):
+        with self._lock:
+            return dict(self._datos.get(usuario_id, {}))
+
+    def agregar(self, usuario_id, producto_id, cantidad=1):
+        with self._lock:
+            carrito = self._datos.setdefault(usuario_id, {})
+            carrito[producto_id] = carrito.get(producto_id, 0) + cantidad
+
+    def fijar(self, usuario_id, producto_id, cantidad):
+        with self._lock:
+            carrito = self._datos.setdefault(usuario_id, {})
+            if cantidad <= 0:
+                carrito.pop(producto_id, None)
+            else:
+                carrito[producto_id] = cantidad
+
+    def quitar(self, usuario_id, producto_id, cantidad=1):
+        with self._lock:
+            carrito = self._datos.get(usuario_id, {})
+            restante = carrito.get(producto_id, 0) - cantidad
+            if restante <= 0:
+                carrito.pop(producto_id, None)
+            else:
+                carrito[producto_id] = restante
+
+    def vaciar(self, usuario_id, commit=True):
+        with self._lock:
+            self._datos.pop(usuario_id, None)
+
+
+BACKENDS = {'sql': CarritoSQL, 'memoria': CarritoMemoria}
+
+
+def almacen():
+    return current_app.extensions['carrito']
+
+
+def sincronizar_contador(usuario_id):
+    session['carrito_n'] = sum(almacen().obtener(usuario_id).values())
+
+
+def _migrar_carrito_de_sesion():
+    # Carritos viejos guardados como lista de ids en la cookie: se mueven una vez
+    if 'carrito' not in session or not current_user.is_authenticated:
+        return
+    for producto_id, cantidad in Counter(int(i) for i in session.pop('carrito') or []).items():
+        almacen().agregar(current_user.id, producto_id, cantidad)
+    sincronizar_contador(current_user.id)
+
+
+def init_app(app):
+    backend = app.config.get('CARRITO_BACKEND', 'sql')
+    app.extensions['carrito'] = BACKENDS[backend]() if isinstance(backend, str) else backend
+    app.before_request(_migrar_carrito_de_sesion)
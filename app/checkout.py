@@ -0,0 +1,132 @@
+from datetime import datetime
+import sqlalchemy as sa
+from flask import current_app
+from sqlalchemy.orm import joinedload, selectinload
+from .models import Producto, Pedido, PedidoItem, db
+from . import eventos, geo, recomendaciones, trabajos, ventas
+from .cache import invalidar_catalogo
+
+
+class StockInsuficiente(Exception):
+    """El pedido no se pudo confirmar porque algún producto ya no tiene stock."""
+
+    def __init__(self, productos):
+        self.productos = productos
+        super().__init__('Sin stock suficiente: ' + ', '.join(productos))
+
+
+def cargar_carrito(cantidades):
+    """Carga todos los productos del carrito con un solo SELECT ... IN.
+
+    Devuelve (productos, total); los ids que ya no existen se ignoran.
+    """
+    if not cantidades:
+        return [], 0
+    productos = (Producto.query
+                 .filter(Producto.id.in_(list(cantidades)))
+                 .options(joinedload(Producto.propietario))
+                 .order_by(Producto.id)
+                 .all())
+    total = sum(p.precio * cantidades[p.id] for p in productos)
+    return productos, total
+
+
+def confirmar_pedido(cliente_id, productos, cantidades, tipo_entrega, metodo_pago,
+                     antes_de_confirmar=None, destino=None):
+    """Descuenta stock y crea Pedido + PedidoItem en una sola transacción.
+
+    El stock se descuenta con un único UPDATE condicional
+    (stock_actual >= cantidad) para todos los productos físicos: si alguna
+    fila no cumple, nada se aplica y se lanza StockInsuficiente. Así dos
+    compradores simultáneos nunca dejan el stock en negativo.
+
+    'antes_de_confirmar' se ejecuta justo antes del commit (p. ej. vaciar
+    el carrito en la misma transacción).
+
+    'destino' es el (lat, lon) de la entrega; con él el pedido entra en la
+    rejilla de despacho (ver geo.py).
+
+    En la misma transacción se encola el resumen de ventas (ver trabajos.py)
+    y se publica el aviso a repartidores (ver eventos.py). La matriz de
+    recomendaciones es memoria de este proceso: se actualiza aquí tras el
+    commit y los demás workers la reciben con su reconstrucción periódica.
+    """
+    # Los servicios no controlan stock
+    fisicos = {p.id: cantidades[p.id] for p in productos if p.tipo == 'producto'}
+    try:
+        if fisicos:
+            cantidad = sa.case(fisicos, value=Producto.id)
+            resultado = db.session.execute(
+                sa.update(Producto)
+                .where(Producto.id.in_(list(fisicos)), Producto.stock_actual >= cantidad)
+                .values(stock_actual=Producto.stock_actual - cantidad)
+                .execution_options(synchronize_session=False))
+            if resultado.rowcount != len(fisicos):
+                db.session.rollback()
+                agotados = (Producto.query
+                            .filter(Producto.id.in_(list(fisicos)))
+                            .filter(Producto.stock_actual < sa.case(fisicos, value=Producto.id))
+                            .all())
+                raise StockInsuficiente([p.nombre for p in agotados])
+
+        # El precio se congela en cada renglón: los reportes no cambian si
+        # la tienda modifica el precio después
+        items = [PedidoItem(producto_id=p.id, cantidad=cantidades[p.id], precio_unitario=p.precio)
+                 for p in productos]
+        pedido = Pedido(
+            fecha=datetime.utcnow(),
+            total=sum(p.precio * cantidades[p.id] for p in productos),
+            cliente_id=cliente_id,
+            estado='pendiente',
+            tipo_entrega=tipo_entrega,
+            metodo_pago=metodo_pago,
+            items=items,
+        )
+        if destino:
+            pedido.destino_lat, pedido.destino_lon = destino
+            pedido.celda = geo.celda(*destino)
+        db.session.add(pedido)
+        db.session.flush()
+        _encolar_efectos(pedido)
+        # El stock cambió: nueva versión del catálogo en esta misma transacción
+        invalidar_catalogo()
+        if antes_de_confirmar:
+            antes_de_confirmar()
+        # Tras el commit los productos quedan expirados: se copian antes
+        vendidos = [(p.id, p.nombre) for p in productos]
+        db.session.commit()
+    except StockInsuficiente:
+        raise
+    except Exception:
+        db.session.rollback()
+        raise
+    recomendaciones.registrar_pedido(vendidos)
+    return pedido
+
+
+def _encolar_efectos(pedido):
+    # Llaves por pedido: reintentar el checkout nunca duplica un efecto
+    trabajos.encolar('ventas.registrar', clave='ventas:%d' % pedido.id, pedido_id=pedido.id)
+    if pedido.tipo_entrega == 'envio':
+        # Aviso en vivo al tablero de repartidores; la fila del evento se
+        # confirma (o se descarta) junto con el pedido
+        eventos.publicar('nuevo', pedido=pedido.id, total=pedido.total,
+                         metodo_pago=pedido.metodo_pago, items=sum(i.cantidad for i in pedido.items),
+                         lat=pedido.destino_lat, lon=pedido.destino_lon)
+
+
+def _pedido_con_items(pedido_id):
+    return db.session.scalar(
+        sa.select(Pedido).where(Pedido.id == pedido_id)
+        .options(selectinload(Pedido.items).joinedload(PedidoItem.producto)))
+
+
+@trabajos.tarea('ventas.registrar')
+def _registrar_ventas(pedido_id):
+    pedido = _pedido_con_items(pedido_id)
+    if pedido is None:
+        # Archivado o borrado antes de que corriera el trabajo: reintentar no
+        # lo traería de vuelta, y ventas.reconstruir() también lee el archivo
+        current_app.logger.warning('Pedido %d no encontrado; resumen de ventas omitido', pedido_id)
+        return
+    ventas.registrar(pedido.items, {i.producto_id: i.producto for i in pedido.items}, pedido.fecha.date())
@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Hash de contraseñas fuera del hilo de la petición.
+# scrypt/pbkdf2 gastan cientos de ms de CPU a propósito; en una ráfaga de
+# logins eso ocupaba todos los workers. Ahora:
+# - un pool acotado (AUTH_HASH_HILOS) hace los hashes, así el resto de la CPU
+#   queda para el catálogo;
+# - si ya hay AUTH_HASH_COLA trabajos en espera se responde "ocupado" en vez
+#   de encolar sin límite;
+# - cada IP y cada correo tienen un máximo de intentos por ventana de tiempo.
+
+
+class Ocupado(Exception):
+    """El pool de hash está lleno o la espera superó AUTH_HASH_ESPERA."""
+
+
+class Limitador:
+    """Ventana deslizante de intentos por clave (IP, correo...)."""
+
+    def __init__(self, limite, ventana):
+        self.limite = limite
+        self.ventana = ventana
+        self._intentos = {}
+        self._lock = threading.Lock()
+
+    def _vigentes(self, clave, ahora):
+        intentos = self._intentos.setdefault(clave, deque())
+        while intentos and intentos[0] <= ahora - self.ventana:
+            intentos.popleft()
+        return intentos
+
+    def disponible(self, clave):
+        """True si la clave aún tiene cupo (no registra el intento)."""
+        with self._lock:
+            return len(self._vigentes(clave, time.monotonic())) < self.limite
+
+    def registrar(self, clave):
+        ahora = time.monotonic()
+        with self._lock:
+            self._vigentes(clave, ahora).append(ahora)
+            if len(self._intentos) > 10000:
+                self._purgar(ahora)
+
+    def reiniciar(self, clave):
+        with self._lock:
+            self._intentos.pop(clave, None)
+
+    def _purgar(self, ahora):
+        for clave in [c for c, i in self._intentos.items() if not i or i[-1] <= ahora - self.ventana]:
+            del self._intentos[clave]
+
+
+class PoolHash:
+    def __init__(self, hilos, cola, espera, metodo):
+        self.metodo = metodo
+        self.espera = espera
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='hash')
+        self._cupo = threading.BoundedSemaphore(hilos + cola)
+        self._relleno = None
+
+    def _ejecutar(self, funcion, *args):
+        if not self._cupo.acquire(blocking=False):
+            raise Ocupado()
+        try:
+            futuro = self._pool.submit(funcion, *args)
+        except BaseException:
+            self._cupo.release()
+            raise
+        futuro.add_done_callback(lambda _: self._cupo.release())
+        try:
+            return futuro.result(timeout=self.espera)
+        except TimeoutError:
+            raise Ocupado()
+
+    def generar(self, password):
+        return self._ejecutar(generate_password_hash, password, self.metodo)
+
+    def verificar(self, hash_guardado, password):
+        if hash_guardado is None:
+            # Hash de relleno: un correo inexistente cuesta lo mismo que uno real
+            if self._relleno is None:
+                self._relleno = self.generar('relleno')
+            hash_guardado = self._relleno
+        return self._ejecutar(check_password_hash, hash_guardado, password or '')
+
+    def necesita_rehash(self, hash_guardado):
+        # El prefijo guarda método y parámetros, p. ej. 'scrypt:32768:8:1$...'
+        return not hash_guardado.startswith(self.metodo + '$')
+
+
+def pool():
+    return current_app.extensions['hash_pool']
+
+
+def limitar(ip, email):
+    """True si la IP y el correo aún tienen intentos disponibles."""
+    limites = current_app.extensions['hash_limites']
+    claves = [(limites['ip'], ip), (limites['email'], (email or '').lower())]
+    # Se revisan ambos antes de contar: un intento rechazado no gasta cupo de
+    # la otra clave (p. ej. un correo bloqueado no agota la IP, ni al revés)
+    if not all(limitador.disponible(clave) for limitador, clave in claves):
+        return False
+    for limitador, clave in claves:
+        limitador.registrar(clave)
+    return True
+
+
+def reiniciar_email(email):
+    current_app.extensions['hash_limites']['email'].reiniciar((email or '').lower())
+
+
+def init_app(app):
+    # Parámetros del hash de werkzeug: 'scrypt:32768:8:1', 'pbkdf2:sha256:600000'...
+    app.config.setdefault('AUTH_HASH_METODO', 'scrypt:32768:8:1')
+    app.extensions['hash_pool'] = PoolHash(
+        hilos=app.config.get('AUTH_HASH_HILOS', 2),
+        cola=app.config.get('AUTH_HASH_COLA', 16),
+        espera=app.config.get('AUTH_HASH_ESPERA', 10),
+        metodo=app.config['AUTH_HASH_METODO'])
+    ventana = app.config.get('AUTH_LIMITE_VENTANA', 60)
+    app.extensions['hash_limites'] = {
+        'ip': Limitador(app.config.get('AUTH_LIMITE_IP', 20), ventana),
+        'email': Limitador(app.config.get('AUTH_LIMITE_EMAIL', 5), ventana),
+    }
@@ -1,50 +1,172 @@
-from flask import render_template, redirect, url_for, flash
+import time
+from flask import render_template, redirect, url_for, flash, request, jsonify, Response, current_app
 from flask_login import login_required, current_user
+import sqlalchemy as sa
 from ..models import Pedido, db
+from .. import eventos, geo
 from . import delivery
 
+# Espera máxima de una petición long-poll y latido del stream SSE (segundos)
+ESPERA_LONG_POLL = 25
+LATIDO_SSE = 15
+# Vida máxima de un stream SSE: al cerrarse, el navegador reconecta con su
+# Last-Event-ID y el hilo del servidor queda libre
+DURACION_SSE = 300
+# Pedidos cercanos que se muestran por defecto y como máximo
+PEDIDOS_CERCANOS = 20
+MAX_PEDIDOS_CERCANOS = 100
+
 @delivery.route('/dashboard')
 @login_required
 def dashboard():
     if current_user.rol != 'repartidor':
         flash('Zona exclusiva para repartidores.')
-        return redirect(url_for('market.index'))
+        return redirect(url_for('market.home'))
+
+    # La posición se guarda con POST /ubicacion; aquí solo se lee
+    posicion = geo.coordenadas(current_user.lat, current_user.lon)
+    k = min(max(request.args.get('k', PEDIDOS_CERCANOS, type=int), 1), MAX_PEDIDOS_CERCANOS)
+
+    # Solo los k pendientes de envío más cercanos (no toda la cola de la ciudad)
+    disponibles = geo.mas_cercanos(db.session, posicion, k)
+    total_disponibles = db.session.scalar(
+        sa.select(sa.func.count(Pedido.id))
+        .where(Pedido.estado == 'pendiente', Pedido.tipo_entrega == 'envio'))
+
+    # Entregas en curso en orden de visita: primero las tiendas, luego los clientes
+    recogidas, mis_entregas = geo.ruta_repartidor(db.session, current_user.id, posicion)
+
+    return render_template('delivery/dashboard.html',
+                           disponibles=disponibles,
+                           total_disponibles=total_disponibles,
+                           recogidas=recogidas,
+                           mis_entregas=mis_entregas,
+                           posicion=posicion,
+                           ultimo_evento=eventos.ultimo_id())
+
+@delivery.route('/ubicacion', methods=['POST'])
+@login_required
+def ubicacion():
+    if current_user.rol != 'repartidor':
+        return "Acceso denegado", 403
 
-    # Solo mostrar pedidos pendientes que requieran envío
-    pedidos_disponibles = Pedido.query.filter_by(estado='pendiente', tipo_entrega='envio').all()
-    
-    mis_entregas = Pedido.query.filter_by(estado='en_camino', repartidor_id=current_user.id).all()
+    posicion = geo.coordenadas(request.form.get('lat'), request.form.get('lon'))
+    if posicion:
+        current_user.lat, current_user.lon = posicion
+        db.session.commit()
+    else:
+        flash('Ubicación inválida.')
+    # El tablero se vuelve a ordenar por cercanía desde la posición guardada
+    return redirect(url_for('delivery.dashboard', k=request.form.get('k', type=int)))
 
-    return render_template('delivery/dashboard.html', 
-                           disponibles=pedidos_disponibles, 
-                           mis_entregas=mis_entregas)
+def _cambiar_estado(id, condiciones, valores, evento):
+    """UPDATE condicional (compare-and-set): True solo si esta petición ganó la fila.
+
+    El aviso a los demás repartidores se guarda en la misma transacción.
+    """
+    resultado = db.session.execute(
+        sa.update(Pedido)
+        .where(Pedido.id == id, *condiciones)
+        .values(**valores)
+        .execution_options(synchronize_session=False))
+    gano = resultado.rowcount == 1
+    if gano:
+        eventos.publicar(evento, pedido=id, repartidor=current_user.id)
+    db.session.commit()
+    return gano
 
 @delivery.route('/aceptar/<int:id>')
 @login_required
 def aceptar_pedido(id):
-    pedido = Pedido.query.get_or_404(id)
-    
-    if pedido.estado != 'pendiente':
+    if current_user.rol != 'repartidor':
+        return "Acceso denegado", 403
+
+    # Dos repartidores pueden tocar "Aceptar" a la vez: solo uno cambia la fila
+    tomado = _cambiar_estado(id,
+                             [Pedido.estado == 'pendiente', Pedido.tipo_entrega == 'envio'],
+                             {'repartidor_id': current_user.id, 'estado': 'en_camino'}, 'tomado')
+    if not tomado:
         flash('No disponible.')
         return redirect(url_for('delivery.dashboard'))
-    
-    pedido.repartidor_id = current_user.id
-    pedido.estado = 'en_camino'
-    db.session.commit()
-    
+
     flash('¡Pedido aceptado!')
     return redirect(url_for('delivery.dashboard'))
 
 @delivery.route('/finalizar/<int:id>')
 @login_required
 def finalizar_pedido(id):
-    pedido = Pedido.query.get_or_404(id)
-    
-    if pedido.repartidor_id != current_user.id:
-        return "Acceso denegado", 403
-        
-    pedido.estado = 'entregado'
-    db.session.commit()
-    
+    entregado = _cambiar_estado(id,
+                                [Pedido.repartidor_id == current_user.id, Pedido.estado == 'en_camino'],
+                                {'estado': 'entregado'}, 'entregado')
+    if not entregado:
+        pedido = db.get_or_404(Pedido, id)
+        if pedido.repartidor_id != current_user.id:
+            return "Acceso denegado", 403
+        flash('No disponible.')
+        return redirect(url_for('delivery.dashboard'))
+
     flash('Entrega completada.')
-    return redirect(url_for('delivery.dashboard'))
\ No newline at end of file
+    return redirect(url_for('delivery.dashboard'))
+
+def _ultimo_id_cliente():
+    return request.headers.get('Last-Event-ID', type=int) or request.args.get('desde', 0, type=int)
+
+@delivery.route('/stream')
+@login_required
+def stream():
+    """Server-Sent Events: nuevos pedidos de envío y cambios de asignación."""
+    if current_user.rol != 'repartidor':
+        return "Acceso denegado", 403
+
+    app = current_app._get_current_object()
+    bus = eventos.bus()
+    if not bus.reservar():
+        # Sin hilos libres para otro stream: el tablero pasa a consultar /eventos
+        respuesta = Response('Demasiados streams abiertos', status=503, mimetype='text/plain')
+        respuesta.headers['Retry-After'] = str(LATIDO_SSE)
+        return respuesta
+    ultimo_id = _ultimo_id_cliente()
+
+    def generar():
+        nonlocal ultimo_id
+        yield 'retry: 3000\n\n'
+        fin = time.monotonic() + app.config.get('DELIVERY_DURACION_SSE', DURACION_SSE)
+        # Contexto propio (no el de la petición): el bus suelta la conexión
+        # tras cada lectura, así que no queda ninguna tomada mientras espera
+        with app.app_context():
+            while time.monotonic() < fin:
+                nuevos = bus.desde(ultimo_id, espera=min(LATIDO_SSE, max(fin - time.monotonic(), 0)))
+                if not nuevos:
+                    # Comentario SSE: mantiene viva la conexión a través de proxies
+                    yield ': latido\n\n'
+                    continue
+                for evento in nuevos:
+                    yield eventos.formato_sse(evento)
+                ultimo_id = nuevos[-1]['id']
+
+    respuesta = Response(generar(), mimetype='text/event-stream')
+    # Al cerrar la respuesta (fin, desconexión o sin haber empezado) se libera el lugar
+    respuesta.call_on_close(bus.liberar)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    return respuesta
+
+@delivery.route('/eventos')
+@login_required
+def eventos_long_poll():
+    """Alternativa long-poll para clientes sin EventSource."""
+    if current_user.rol != 'repartidor':
+        return "Acceso denegado", 403
+
+    espera = min(request.args.get('espera', ESPERA_LONG_POLL, type=float), ESPERA_LONG_POLL)
+    bus = eventos.bus()
+    if espera > 0 and bus.reservar():
+        try:
+            nuevos = bus.desde(_ultimo_id_cliente(), espera=espera)
+        finally:
+            bus.liberar()
+    else:
+        # Sin lugar para esperar: responde con lo que haya, sin bloquear el hilo
+        nuevos = bus.desde(_ultimo_id_cliente())
+    return jsonify({'eventos': nuevos,
+                    'ultimo_id': nuevos[-1]['id'] if nuevos else _ultimo_id_cliente()})
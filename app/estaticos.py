@@ -0,0 +1,175 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import zlib
+import click
+from flask import current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # Brotli es opcional: sin él solo se precomprime gzip
+    brotli = None
+
+# Archivos de texto que vale la pena comprimir (las imágenes ya vienen comprimidas)
+EXTENSIONES_TEXTO = ('.css', '.js', '.mjs', '.svg', '.json', '.txt', '.html', '.xml', '.map')
+TIPOS_COMPRIMIBLES = ('text/html', 'application/json', 'text/css', 'text/plain',
+                      'application/javascript', 'image/svg+xml')
+UN_ANIO = 31536000
+# /static/uploads/... se sirve desde UPLOAD_FOLDER (puede estar fuera de static/)
+PREFIJO_SUBIDAS = 'uploads/'
+
+
+def _ubicar(filename):
+    """(carpeta, ruta relativa) donde vive un archivo estático."""
+    if filename.startswith(PREFIJO_SUBIDAS):
+        return current_app.config['UPLOAD_FOLDER'], filename[len(PREFIJO_SUBIDAS):]
+    return current_app.static_folder, filename
+
+
+class Huellas:
+    """Hash corto del contenido de cada archivo estático, recalculado si cambia."""
+
+    def __init__(self):
+        self._huellas = {}
+        self._lock = threading.Lock()
+
+    def de(self, filename):
+        ruta = safe_join(*_ubicar(filename))
+        try:
+            info = os.stat(ruta)
+        except (OSError, TypeError):
+            return None
+        firma = (info.st_mtime_ns, info.st_size)
+        guardada = self._huellas.get(filename)
+        if guardada and guardada[0] == firma:
+            return guardada[1]
+        h = hashlib.sha256()
+        with open(ruta, 'rb') as f:
+            for bloque in iter(lambda: f.read(65536), b''):
+                h.update(bloque)
+        huella = h.hexdigest()[:12]
+        with self._lock:
+            self._huellas[filename] = (firma, huella)
+        return huella
+
+
+def url(filename):
+    """url_for('static', ...) con la huella del contenido (?v=...) para cache inmutable."""
+    huella = current_app.extensions['huellas_estaticos'].de(filename)
+    if huella is None:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=huella)
+
+
+def precomprimir(carpeta):
+    """Genera .gz (y .br si hay Brotli) junto a cada asset de texto desactualizado."""
+    generados = 0
+    for raiz, _, archivos in os.walk(carpeta):
+        for nombre in archivos:
+            if not nombre.endswith(EXTENSIONES_TEXTO):
+                continue
+            ruta = os.path.join(raiz, nombre)
+            mtime = os.path.getmtime(ruta)
+            with open(ruta, 'rb') as f:
+                datos = f.read()
+            destinos = [('.gz', lambda d: gzip.compress(d, 9, mtime=0))]
+            if brotli is not None:
+                destinos.append(('.br', lambda d: brotli.compress(d, quality=11)))
+            for sufijo, comprimir in destinos:
+                destino = ruta + sufijo
+                if os.path.exists(destino) and os.path.getmtime(destino) >= mtime:
+                    continue
+                with open(destino + '.tmp', 'wb') as f:
+                    f.write(comprimir(datos))
+                os.replace(destino + '.tmp', destino)
+                generados += 1
+    return generados
+
+
+def _servir_estatico(filename):
+    app = current_app
+    carpeta, relativa = _ubicar(filename)
+    respuesta = None
+    if filename.endswith(EXTENSIONES_TEXTO):
+        # Versión precomprimida si existe y el cliente la acepta
+        for codificacion, sufijo in (('br', '.br'), ('gzip', '.gz')):
+            comprimido = safe_join(carpeta, relativa + sufijo)
+            if request.accept_encodings[codificacion] and comprimido and os.path.isfile(comprimido):
+                respuesta = send_from_directory(carpeta, relativa + sufijo,
+                                                mimetype=mimetypes.guess_type(filename)[0])
+                respuesta.headers['Content-Encoding'] = codificacion
+                break
+        if respuesta is None:
+            respuesta = send_from_directory(carpeta, relativa)
+        respuesta.vary.add('Accept-Encoding')
+    else:
+        respuesta = send_from_directory(carpeta, relativa)
+
+    version = request.args.get('v')
+    if version and version == app.extensions['huellas_estaticos'].de(filename):
+        # La URL cambia cuando cambia el contenido: el navegador no revalida
+        respuesta.cache_control.public = True
+        respuesta.cache_control.max_age = UN_ANIO
+        respuesta.cache_control.immutable = True
+    return respuesta
+
+
+def _gzip_en_flujo(iterable, compresor):
+    for trozo in iterable:
+        if isinstance(trozo, str):
+            trozo = trozo.encode('utf-8')
+        datos = compresor.compress(trozo) + compresor.flush(zlib.Z_SYNC_FLUSH)
+        if datos:
+            yield datos
+    yield compresor.flush()
+
+
+def _comprimir_respuesta(respuesta):
+    """Comprime con gzip al vuelo las respuestas HTML/JSON."""
+    app = current_app
+    if (request.endpoint == 'static' or respuesta.status_code < 200 or respuesta.status_code in (204, 304)
+            or 'Content-Encoding' in respuesta.headers
+            or respuesta.mimetype not in TIPOS_COMPRIMIBLES
+            or not request.accept_encodings['gzip']):
+        return respuesta
+
+    nivel = app.config.get('COMPRESION_NIVEL', 6)
+    if respuesta.is_streamed:
+        # Flujos JSON: cada trozo se envía comprimido sin esperar al final
+        compresor = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+        respuesta.response = _gzip_en_flujo(respuesta.response, compresor)
+        respuesta.headers.pop('Content-Length', None)
+    else:
+        datos = respuesta.get_data()
+        if len(datos) < app.config.get('COMPRESION_MINIMO', 500):
+            return respuesta
+        respuesta.set_data(gzip.compress(datos, nivel))
+
+    respuesta.headers['Content-Encoding'] = 'gzip'
+    respuesta.vary.add('Accept-Encoding')
+    etag, debil = respuesta.get_etag()
+    if etag and not debil:
+        # Mismo recurso, otros bytes: el ETag pasa a ser débil
+        respuesta.set_etag(etag, weak=True)
+    return respuesta
+
+
+def init_app(app):
+    app.extensions['huellas_estaticos'] = Huellas()
+    app.jinja_env.globals['estatico'] = url
+    app.view_functions['static'] = _servir_estatico
+    if app.config.get('COMPRESION', True):
+        app.after_request(_comprimir_respuesta)
+
+    # Precomprimir escribe en static/: por defecto lo hace solo el paso de
+    # despliegue (flask precomprimir), no cada create_app()
+    if app.config.get('ESTATICOS_PRECOMPRIMIR', False):
+        precomprimir(app.static_folder)
+
+    @app.cli.command('precomprimir')
+    def precomprimir_cmd():
+        """Precomprime (gzip/brotli) los assets de texto de static/."""
+        click.echo('%d archivos comprimidos.' % precomprimir(app.static_folder))
@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from collections import deque
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy.orm import Session
+from .models import Evento, db
+
+# Eventos del tablero de repartidores.
+# publicar() inserta una fila en 'evento' dentro de la transacción actual, así
+# que el aviso se guarda (o se descarta) junto con el cambio que lo origina.
+# El id autoincremental es el mismo en todos los workers: un cliente puede
+# reconectar con su Last-Event-ID a cualquiera. Cada proceso copia las filas
+# nuevas a un buffer en memoria como máximo cada 'sondeo' segundos (al
+# instante si el commit fue suyo) y sus conexiones esperan ahí: una consulta
+# por proceso, no una por repartidor conectado.
+# En SQLite las escrituras van en serie, así que los ids se confirman en orden.
+#
+# Cada stream SSE o long-poll ocupa un hilo del servidor mientras espera; el
+# bus reparte a lo más 'max_esperas' lugares (EVENTOS_MAX_ESPERAS) para que los
+# tableros abiertos no acaparen los hilos de todo el sitio.
+
+
+class BusEventos:
+    """Buffer local de los últimos N eventos de la BD con espera por Condition."""
+
+    def __init__(self, max_eventos=500, sondeo=1.0, max_esperas=4):
+        self._eventos = deque(maxlen=max_eventos)
+        self._esperas = threading.BoundedSemaphore(max_esperas)
+        self._cond = threading.Condition()
+        self._ultimo_id = 0
+        self._leido = None
+        self._leyendo = False
+        self.sondeo = sondeo
+
+    def reservar(self):
+        """Toma un lugar para una conexión en espera; False si no hay ninguno libre."""
+        return self._esperas.acquire(blocking=False)
+
+    def liberar(self):
+        self._esperas.release()
+
+    def despertar(self):
+        # Commit local con eventos: la próxima espera lee la BD sin aguardar el sondeo
+        with self._cond:
+            self._leido = None
+            self._cond.notify_all()
+
+    def _sincronizar(self):
+        """Copia al buffer los eventos nuevos de la BD, si ya toca leerla."""
+        with self._cond:
+            if self._leyendo or (self._leido is not None and time.monotonic() - self._leido < self.sondeo):
+                return
+            self._leyendo = True
+            desde = self._ultimo_id
+        filas = []
+        try:
+            # Conexión propia, devuelta al pool enseguida: la sesión de la
+            # petición (y current_user) no se toca y no queda transacción
+            # abierta mientras el cliente espera
+            with db.engine.connect() as conexion:
+                filas = conexion.execute(
+                    sa.select(Evento.id, Evento.tipo, Evento.datos).where(Evento.id > desde)
+                    .order_by(Evento.id.desc()).limit(self._eventos.maxlen)).all()
+        finally:
+            with self._cond:
+                for id, tipo, datos in reversed(filas):
+                    self._eventos.append({'id': id, 'tipo': tipo, 'datos': json.loads(datos)})
+                if filas:
+                    self._ultimo_id = filas[0][0]
+                self._leido = time.monotonic()
+                self._leyendo = False
+                self._cond.notify_all()
+
+    def _sin_continuidad(self, ultimo_id):
+        # Un id mayor que el último de la BD (otra BD, restauración) o más viejo
+        # que el buffer lleno (eventos ya descartados) no se puede continuar
+        if ultimo_id > self._ultimo_id:
+            return True
+        return (len(self._eventos) == self._eventos.maxlen
+                and ultimo_id < self._eventos[0]['id'] - 1)
+
+    def desde(self, ultimo_id, espera=0):
+        """Eventos con id > ultimo_id; bloquea hasta 'espera' segundos si no hay.
+
+        Si el id del cliente no tiene continuidad llega un solo evento
+        'resync' con el id actual: el cliente debe recargar su vista.
+        """
+        limite = time.monotonic() + espera
+        while True:
+            self._sincronizar()
+            with self._cond:
+                if self._leido is not None:
+                    if self._sin_continuidad(ultimo_id):
+                        return [{'id': self._ultimo_id, 'tipo': 'resync', 'datos': {}}]
+                    nuevos = [e for e in self._eventos if e['id'] > ultimo_id]
+                    if nuevos:
+                        return nuevos
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return []
+                self._cond.wait(min(restante, self.sondeo))
+
+
+def init_app(app):
+    app.extensions['eventos'] = BusEventos(app.config.get('EVENTOS_MAX', 500),
+                                           app.config.get('EVENTOS_SONDEO', 1.0),
+                                           app.config.get('EVENTOS_MAX_ESPERAS', 4))
+
+
+def bus():
+    return current_app.extensions['eventos']
+
+
+def publicar(tipo, **datos):
+    """Agrega el evento a la transacción actual (no hace commit)."""
+    db.session.add(Evento(tipo=tipo, datos=json.dumps(datos)))
+    # Solo se guardan los últimos EVENTOS_RETENER (borra por llave primaria)
+    retener = current_app.config.get('EVENTOS_RETENER', 5000)
+    db.session.execute(
+        sa.delete(Evento).where(Evento.id <= sa.select(sa.func.max(Evento.id)).scalar_subquery() - retener)
+        .execution_options(synchronize_session=False))
+    db.session.info['eventos_nuevos'] = True
+
+
+def ultimo_id():
+    """Id del último evento guardado (punto de partida de un tablero recién cargado)."""
+    return db.session.scalar(sa.select(sa.func.max(Evento.id))) or 0
+
+
+def formato_sse(evento):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (evento['id'], evento['tipo'], json.dumps(evento['datos']))
+
+
+def _al_confirmar(session):
+    if session.info.pop('eventos_nuevos', False) and has_app_context():
+        canal = current_app.extensions.get('eventos')
+        if canal is not None:
+            canal.despertar()
+
+
+sa.event.listen(Session, 'after_commit', _al_confirmar)
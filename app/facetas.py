@@ -0,0 +1,124 @@
+import click
+import sqlalchemy as sa
+from flask import current_app
+from . import db
+
+# Conteos de productos con stock por faceta (categoría, tipo, tienda).
+# En SQLite los triggers sobre 'producto' suman/restan en conteo_faceta en
+# cualquier escritura: alta, ajuste de stock, carga masiva o checkout (que
+# descuenta stock con un UPDATE). El catálogo solo lee unas pocas filas.
+# Otros motores calculan los conteos con GROUP BY y los guarda la cache del catálogo.
+
+FACETAS = ('categoria', 'tipo', 'tienda')
+# Columna de 'producto' que alimenta cada faceta
+_COLUMNAS = {'categoria': 'categoria', 'tipo': 'tipo', 'tienda': 'tienda_id'}
+
+MAX_TIENDAS = 20
+
+
+def _sumar(fila, signo):
+    return '\n'.join(
+        "INSERT INTO conteo_faceta(faceta, valor, conteo) VALUES ('%s', COALESCE(%s.%s, ''), %d)"
+        " ON CONFLICT(faceta, valor) DO UPDATE SET conteo = conteo + %d;"
+        % (faceta, fila, columna, signo, signo)
+        for faceta, columna in _COLUMNAS.items())
+
+
+# Un UPDATE solo mueve conteos si el producto entra o sale de existencia o si
+# cambia una columna de faceta: el 5 -> 4 de cada checkout no toca conteo_faceta
+_CAMBIA_FACETA = '(new.stock_actual > 0) != (old.stock_actual > 0) OR %s' % ' OR '.join(
+    'new.%s IS NOT old.%s' % (c, c) for c in _COLUMNAS.values())
+
+_TRIGGERS = ('conteo_faceta_ai', 'conteo_faceta_ad', 'conteo_faceta_au_sale', 'conteo_faceta_au_entra')
+
+_DDL_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS conteo_faceta_ai AFTER INSERT ON producto
+       WHEN new.stock_actual > 0 BEGIN %s END""" % _sumar('new', 1),
+    """CREATE TRIGGER IF NOT EXISTS conteo_faceta_ad AFTER DELETE ON producto
+       WHEN old.stock_actual > 0 BEGIN %s END""" % _sumar('old', -1),
+    """CREATE TRIGGER IF NOT EXISTS conteo_faceta_au_sale AFTER UPDATE OF stock_actual, categoria, tipo, tienda_id ON producto
+       WHEN old.stock_actual > 0 AND (%s) BEGIN %s END""" % (_CAMBIA_FACETA, _sumar('old', -1)),
+    """CREATE TRIGGER IF NOT EXISTS conteo_faceta_au_entra AFTER UPDATE OF stock_actual, categoria, tipo, tienda_id ON producto
+       WHEN new.stock_actual > 0 AND (%s) BEGIN %s END""" % (_CAMBIA_FACETA, _sumar('new', 1)),
+]
+
+
+def crear_triggers(engine):
+    """Instala los triggers de conteo. Devuelve False si el motor no es SQLite."""
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.begin() as conn:
+        existia = conn.execute(sa.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'conteo_faceta_ai'")).first()
+        # Se recrean siempre: una BD existente recibe la versión actual de cada trigger
+        for nombre in _TRIGGERS:
+            conn.execute(sa.text('DROP TRIGGER IF EXISTS %s' % nombre))
+        for ddl in _DDL_TRIGGERS:
+            conn.execute(sa.text(ddl))
+        if not existia:
+            # Base de datos previa a las facetas: contar lo que ya existe
+            _reconstruir(conn)
+    return True
+
+
+def _agregado():
+    from .models import Producto
+
+    for faceta in FACETAS:
+        columna = sa.func.coalesce(sa.cast(getattr(Producto, _COLUMNAS[faceta]), sa.String), '')
+        yield (sa.select(sa.literal(faceta), columna, sa.func.count())
+               .where(Producto.stock_actual > 0)
+               .group_by(columna))
+
+
+def _reconstruir(conn):
+    from .models import ConteoFaceta
+
+    conn.execute(sa.delete(ConteoFaceta))
+    for select in _agregado():
+        conn.execute(sa.insert(ConteoFaceta).from_select(['faceta', 'valor', 'conteo'], select))
+
+
+def reconstruir():
+    """Recalcula los conteos desde cero (tras cargas hechas fuera de la app)."""
+    _reconstruir(db.session.connection())
+    db.session.commit()
+
+
+def conteos():
+    """{faceta: [(valor, conteo), ...]} de mayor a menor, solo valores con stock."""
+    from .models import ConteoFaceta, Usuario
+
+    if current_app.extensions.get('facetas_triggers'):
+        # Una sola consulta: el nombre de la tienda llega por LEFT JOIN
+        filas = db.session.execute(
+            sa.select(ConteoFaceta.faceta, ConteoFaceta.valor, ConteoFaceta.conteo, Usuario.nombre)
+            .outerjoin(Usuario, sa.and_(ConteoFaceta.faceta == 'tienda',
+                                        Usuario.id == sa.cast(ConteoFaceta.valor, sa.Integer)))
+            .where(ConteoFaceta.conteo > 0)).all()
+    else:
+        filas = [tuple(fila) + (None,) for select in _agregado() for fila in db.session.execute(select).all()]
+        ids = [int(v) for f, v, _, _ in filas if f == 'tienda' and v.isdigit()]
+        nombres = dict(db.session.execute(sa.select(Usuario.id, Usuario.nombre).where(Usuario.id.in_(ids))).all())
+        filas = [(f, v, c, nombres.get(int(v)) if f == 'tienda' and v.isdigit() else None) for f, v, c, _ in filas]
+
+    resultado = {faceta: [] for faceta in FACETAS}
+    for faceta, valor, conteo, nombre in filas:
+        if faceta == 'tienda':
+            if nombre is not None:
+                resultado[faceta].append((int(valor), nombre, conteo))
+        else:
+            resultado[faceta].append((valor, conteo))
+    for valores in resultado.values():
+        valores.sort(key=lambda v: (-v[-1], v[0]))
+    # Tiendas: solo las de más oferta
+    resultado['tienda'] = resultado['tienda'][:MAX_TIENDAS]
+    return resultado
+
+
+def init_app(app):
+    @app.cli.command('reconstruir-facetas')
+    def reconstruir_facetas_cmd():
+        """Recalcula los conteos de facetas del catálogo."""
+        reconstruir()
+        click.echo('Conteos de facetas actualizados.')
@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+# Cache de fragmentos de plantilla:
+#
+#     {% cache 'tarjeta', p.id, p.updated_at %} ... {% endcache %}
+#
+# La llave es la plantilla + línea del bloque + los valores dados, así que
+# basta con incluir la versión del objeto (updated_at) para que un cambio
+# genere otra llave; las entradas viejas salen por LRU o por TTL. Dentro del
+# bloque no debe haber nada que dependa del usuario o de la petición.
+#
+# El backend es cualquier objeto con get(clave) / set(clave, valor): por
+# defecto memoria local acotada; FRAGMENTOS_BACKEND puede ser una instancia
+# compartida entre procesos (p. ej. un cliente de Redis o Memcached), que se
+# envuelve en BackendExterno porque esos clientes devuelven bytes.
+
+
+class MemoriaFragmentos:
+    """LRU en memoria acotada por número de entradas y por tamaño total (caracteres)."""
+
+    def __init__(self, max_items=5000, max_bytes=32 * 1024 * 1024, ttl=300):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _quitar(self, clave):
+        valor, _ = self._datos.pop(clave)
+        self._bytes -= len(valor)
+
+    def get(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None or entrada[1] < time.monotonic():
+                if entrada is not None:
+                    self._quitar(clave)
+                self.misses += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return entrada[0]
+
+    def set(self, clave, valor):
+        if len(valor) > self.max_bytes:
+            return
+        with self._lock:
+            if clave in self._datos:
+                self._quitar(clave)
+            self._datos[clave] = (valor, time.monotonic() + self.ttl)
+            self._bytes += len(valor)
+            while len(self._datos) > self.max_items or self._bytes > self.max_bytes:
+                self._quitar(next(iter(self._datos)))
+
+    def clear(self):
+        with self._lock:
+            self._datos.clear()
+            self._bytes = 0
+
+    def estadisticas(self):
+        return {'items': len(self._datos), 'bytes': self._bytes, 'max_items': self.max_items,
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+class Ninguno:
+    """Sin cache: cada bloque se renderiza siempre."""
+
+    def get(self, clave):
+        return None
+
+    def set(self, clave, valor):
+        pass
+
+
+class BackendExterno:
+    """Adapta un cliente externo: guarda texto y devuelve str aunque el cliente lea bytes."""
+
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def get(self, clave):
+        valor = self.cliente.get(clave)
+        return valor.decode('utf-8') if isinstance(valor, bytes) else valor
+
+    def set(self, clave, valor):
+        self.cliente.set(clave, valor)
+
+    def __getattr__(self, nombre):
+        # clear(), estadisticas()... del cliente, si los tiene
+        return getattr(self.cliente, nombre)
+
+
+class CacheFragmentos(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        partes = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            partes.append(parser.parse_expression())
+        prefijo = nodes.Const('%s:%d' % (parser.name, lineno))
+        cuerpo = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_renderizar', [prefijo, nodes.List(partes)]),
+                               [], [], cuerpo).set_lineno(lineno)
+
+    def _renderizar(self, prefijo, partes, caller):
+        backend = current_app.extensions['fragmentos']
+        clave = 'frag:%s:%s' % (prefijo, ':'.join(str(p) for p in partes))
+        html = backend.get(clave)
+        if html is None:
+            html = caller()
+            backend.set(clave, str(html))
+        return Markup(html)
+
+
+BACKENDS = {'memoria': MemoriaFragmentos, 'ninguno': Ninguno}
+
+
+def init_app(app):
+    backend = app.config.get('FRAGMENTOS_BACKEND', 'memoria')
+    if backend == 'memoria':
+        backend = MemoriaFragmentos(max_items=app.config.get('FRAGMENTOS_MAX', 5000),
+                                    max_bytes=app.config.get('FRAGMENTOS_MAX_BYTES', 32 * 1024 * 1024),
+                                    ttl=app.config.get('FRAGMENTOS_TTL', 300))
+    elif isinstance(backend, str):
+        backend = BACKENDS[backend]()
+    elif not isinstance(backend, tuple(BACKENDS.values())):
+        backend = BackendExterno(backend)
+    app.extensions['fragmentos'] = backend
+    app.jinja_env.add_extension(CacheFragmentos)
@@ -0,0 +1,170 @@
+import math
+import sqlalchemy as sa
+from sqlalchemy.orm import joinedload, selectinload
+from .models import Pedido, PedidoItem, Producto
+
+# Despacho por cercanía.
+# Cada pedido de envío guarda sus coordenadas de destino y la celda de una
+# rejilla fija (TAMANO_CELDA grados, ~1.1 km). Para los k pedidos más cercanos
+# se consultan anillos de celdas alrededor del repartidor (índice
+# estado + tipo_entrega + celda) hasta que ninguna celda sin consultar pueda
+# tener uno más cercano; solo esos candidatos se ordenan por distancia real.
+# Así el costo depende de la densidad local, no de cuántos pedidos abiertos
+# haya en la ciudad. La búsqueda por celdas llega hasta el último anillo de
+# BANDAS_ANILLOS (~16 km); más allá la lista se completa con los pendientes
+# más antiguos, lejanos o sin ubicación.
+
+TAMANO_CELDA = 0.01
+# Anillos consultados en cada paso (cada paso es una consulta): crecen
+# rápido para que una zona con pocos pedidos no cueste decenas de viajes.
+# El último paso lleva 31² - 15² = 736 celdas en el IN; un anillo más
+# pasaría de 2,700 y ya conviene el respaldo por antigüedad.
+BANDAS_ANILLOS = (0, 1, 3, 7, 15)
+RADIO_TIERRA_KM = 6371.0
+# Mejoras 2-opt como máximo por ruta (acota el tiempo con muchas paradas)
+MAX_ITERACIONES_2OPT = 2000
+
+
+def coordenadas(lat, lon):
+    """(lat, lon) como floats válidos, o None."""
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or math.isnan(lat) or math.isnan(lon):
+        return None
+    return lat, lon
+
+
+def _indices_celda(lat, lon):
+    return math.floor(lat / TAMANO_CELDA), math.floor(lon / TAMANO_CELDA)
+
+
+def celda(lat, lon):
+    return '%d:%d' % _indices_celda(lat, lon)
+
+
+def anillo(lat, lon, r):
+    """Celdas a distancia de Chebyshev exactamente r de la celda de (lat, lon)."""
+    i, j = _indices_celda(lat, lon)
+    if r == 0:
+        return ['%d:%d' % (i, j)]
+    celdas = []
+    for d in range(-r, r + 1):
+        celdas += ['%d:%d' % (i - r, j + d), '%d:%d' % (i + r, j + d)]
+    for d in range(-r + 1, r):
+        celdas += ['%d:%d' % (i + d, j - r), '%d:%d' % (i + d, j + r)]
+    return celdas
+
+
+def distancia_km(a, b):
+    """Distancia haversine entre dos (lat, lon)."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * RADIO_TIERRA_KM * math.asin(math.sqrt(h))
+
+
+def _pendientes():
+    return (sa.select(Pedido)
+            .where(Pedido.estado == 'pendiente', Pedido.tipo_entrega == 'envio')
+            .options(selectinload(Pedido.items)))
+
+
+def mas_cercanos(session, posicion, k=20):
+    """Los k pedidos pendientes de envío más cercanos: [(pedido, km), ...].
+
+    Sin posición, o sin k pedidos dentro del radio de búsqueda, se completan
+    con los más antiguos (fuera del radio, o sin ubicación y km None), para
+    que ningún pedido quede invisible.
+    """
+    if not posicion:
+        return [(p, None) for p in session.scalars(_pendientes().order_by(Pedido.fecha).limit(k))]
+
+    # Un grado de longitud mide menos lejos del ecuador: cota inferior de la
+    # distancia a cualquier celda fuera de los anillos ya consultados
+    km_por_anillo = TAMANO_CELDA * math.pi / 180 * RADIO_TIERRA_KM * max(math.cos(math.radians(posicion[0])), 0.01)
+    candidatos = []
+    anterior = -1
+    for hasta in BANDAS_ANILLOS:
+        celdas = [c for r in range(anterior + 1, hasta + 1) for c in anillo(posicion[0], posicion[1], r)]
+        anterior = hasta
+        candidatos += [(p, distancia_km(posicion, (p.destino_lat, p.destino_lon)))
+                       for p in session.scalars(_pendientes().where(Pedido.celda.in_(celdas)))]
+        candidatos.sort(key=lambda x: x[1])
+        # Listo cuando el k-ésimo está más cerca que cualquier celda sin consultar
+        if len(candidatos) >= k and candidatos[k - 1][1] <= hasta * km_por_anillo:
+            break
+    encontrados = candidatos[:k]
+
+    if len(encontrados) < k:
+        resto = session.scalars(
+            _pendientes().where(Pedido.id.not_in([p.id for p, _ in encontrados]))
+            .order_by(Pedido.fecha, Pedido.id).limit(k - len(encontrados))).all()
+        encontrados += [(p, None if p.celda is None else distancia_km(posicion, (p.destino_lat, p.destino_lon)))
+                        for p in resto]
+    return encontrados
+
+
+def ordenar_ruta(origen, paradas):
+    """Orden de visita de 'paradas' [(clave, (lat, lon)), ...] partiendo de 'origen'.
+
+    Vecino más cercano y luego mejoras 2-opt sobre el camino abierto.
+    Devuelve [(clave, km_desde_parada_anterior), ...].
+    """
+    if not paradas:
+        return []
+    pendientes = list(paradas)
+    ruta = []
+    actual = origen or pendientes[0][1]
+    while pendientes:
+        siguiente = min(pendientes, key=lambda p: distancia_km(actual, p[1]))
+        pendientes.remove(siguiente)
+        ruta.append(siguiente)
+        actual = siguiente[1]
+
+    puntos = [origen or ruta[0][1]] + [p[1] for p in ruta]
+    iteraciones, mejoro = 0, True
+    while mejoro and iteraciones < MAX_ITERACIONES_2OPT:
+        mejoro = False
+        for i in range(1, len(puntos) - 1):
+            for j in range(i + 1, len(puntos)):
+                iteraciones += 1
+                # Invertir el tramo i..j: cambian la arista de entrada y (si existe) la de salida
+                antes = distancia_km(puntos[i - 1], puntos[i])
+                despues = distancia_km(puntos[i - 1], puntos[j])
+                if j + 1 < len(puntos):
+                    antes += distancia_km(puntos[j], puntos[j + 1])
+                    despues += distancia_km(puntos[i], puntos[j + 1])
+                if despues < antes - 1e-9:
+                    puntos[i:j + 1] = reversed(puntos[i:j + 1])
+                    ruta[i - 1:j] = reversed(ruta[i - 1:j])
+                    mejoro = True
+    return [(clave, round(distancia_km(puntos[n], punto), 2))
+            for n, (clave, punto) in enumerate(ruta)]
+
+
+def ruta_repartidor(session, repartidor_id, posicion):
+    """Ruta de las entregas en curso: (recogidas, entregas).
+
+    Primero las tiendas de origen [(tienda, km_tramo), ...] y luego los
+    destinos [(pedido, km_tramo), ...] partiendo de la última tienda.
+    Tiendas o destinos sin coordenadas van al final de su lista.
+    """
+    entregas = session.scalars(
+        sa.select(Pedido)
+        .where(Pedido.estado == 'en_camino', Pedido.repartidor_id == repartidor_id)
+        .order_by(Pedido.fecha)
+        .options(joinedload(Pedido.cliente),
+                 selectinload(Pedido.items).joinedload(PedidoItem.producto).joinedload(Producto.propietario))
+    ).unique().all()
+    tiendas = {i.producto.propietario.id: i.producto.propietario for p in entregas for i in p.items}
+    con_ubicacion = [(t, (t.lat, t.lon)) for t in tiendas.values() if coordenadas(t.lat, t.lon)]
+    recogidas = ordenar_ruta(posicion, con_ubicacion)
+    # Las entregas salen de la última tienda con ubicación
+    inicio = (recogidas[-1][0].lat, recogidas[-1][0].lon) if recogidas else posicion
+    recogidas += [(t, None) for t in tiendas.values() if not coordenadas(t.lat, t.lon)]
+
+    con_destino = [(p, (p.destino_lat, p.destino_lon)) for p in entregas if p.celda is not None]
+    sin_destino = [(p, None) for p in entregas if p.celda is None]
+    return recogidas, ordenar_ruta(inicio, con_destino) + sin_destino
@@ -0,0 +1,63 @@
+import sqlalchemy as sa
+from flask import current_app, has_app_context
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from .cache import CacheLRU
+from .models import Usuario, db
+
+# Cache de identidad para login_manager.user_loader.
+# Guarda las columnas del usuario (no el objeto ORM) y en cada petición se
+# reconstruye un Usuario "detached" que se une a la sesión sin SELECT.
+# Las relaciones (productos, compras...) se siguen cargando bajo demanda.
+# Cada proceso tiene su cache: el TTL acota cuánto puede tardar en verse un
+# cambio hecho por otro worker.
+
+_COLUMNAS = [c.key for c in sa.inspect(Usuario).column_attrs]
+
+
+def _cache():
+    return current_app.extensions['identidad_cache']
+
+
+def cargar(usuario_id):
+    datos = _cache().get(usuario_id)
+    if datos is None:
+        usuario = db.session.get(Usuario, usuario_id)
+        if usuario is not None:
+            _cache().set(usuario_id, {c: getattr(usuario, c) for c in _COLUMNAS})
+        return usuario
+
+    usuario = Usuario(**datos)
+    make_transient_to_detached(usuario)
+    return db.session.merge(usuario, load=False)
+
+
+def invalidar(usuario_id):
+    _cache().delete(usuario_id)
+
+
+def _al_cambiar_usuario(mapper, conexion, usuario):
+    # Cambios de perfil o contraseña hechos con el ORM en este proceso. En el
+    # flush solo se anota el id y se invalida tras el commit: invalidando
+    # aquí, otra petición podría volver a guardar la fila vieja en la cache
+    # antes de que el cambio se confirme.
+    sesion = object_session(usuario)
+    if sesion is not None:
+        sesion.info.setdefault('usuarios_cambiados', set()).add(usuario.id)
+
+
+def _al_confirmar(session):
+    ids = session.info.pop('usuarios_cambiados', ())
+    if ids and has_app_context() and 'identidad_cache' in current_app.extensions:
+        for usuario_id in ids:
+            invalidar(usuario_id)
+
+
+sa.event.listen(Usuario, 'after_update', _al_cambiar_usuario)
+sa.event.listen(Usuario, 'after_delete', _al_cambiar_usuario)
+sa.event.listen(Session, 'after_commit', _al_confirmar)
+
+
+def init_app(app):
+    app.extensions['identidad_cache'] = CacheLRU(
+        max_items=app.config.get('IDENTIDAD_CACHE_MAX', 10000),
+        ttl=app.config.get('IDENTIDAD_CACHE_TTL', 60))
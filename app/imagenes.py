@@ -0,0 +1,154 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from . import estaticos
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Sin Pillow se sirven solo los originales
+    Image = None
+
+# Variantes de tamaño fijo (ancho, alto) que usan las plantillas
+VARIANTES = {
+    'thumb': (160, 160),
+    'card': (480, 360),
+}
+# WebP para navegadores modernos y JPEG como respaldo
+FORMATOS = (('webp', 'WEBP', {'quality': 80, 'method': 4}),
+            ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}))
+CARPETA_VARIANTES = 'variantes'
+
+
+def _carpeta():
+    return current_app.config['UPLOAD_FOLDER']
+
+
+def nombre_por_contenido(datos, extension):
+    """Nombre de archivo derivado del contenido: subidas idénticas comparten archivo."""
+    return hashlib.sha256(datos).hexdigest()[:16] + extension.lower()
+
+
+def ruta_variante(carpeta, nombre, variante, formato):
+    base = os.path.splitext(nombre)[0]
+    return os.path.join(carpeta, CARPETA_VARIANTES, '%s_%s.%s' % (base, variante, formato))
+
+
+def generar_variantes(carpeta, nombre):
+    """Crea todas las variantes de una imagen ya guardada (idempotente)."""
+    if Image is None:
+        return False
+    os.makedirs(os.path.join(carpeta, CARPETA_VARIANTES), exist_ok=True)
+    with Image.open(os.path.join(carpeta, nombre)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA')
+        for variante, tamano in VARIANTES.items():
+            recorte = ImageOps.fit(original, tamano, Image.LANCZOS)
+            for extension, formato, opciones in FORMATOS:
+                destino = ruta_variante(carpeta, nombre, variante, extension)
+                if os.path.exists(destino):
+                    continue
+                imagen = recorte
+                if formato == 'JPEG' and imagen.mode == 'RGBA':
+                    # JPEG no tiene transparencia: fondo blanco
+                    fondo = Image.new('RGB', imagen.size, (255, 255, 255))
+                    fondo.paste(imagen, mask=imagen.split()[3])
+                    imagen = fondo
+                # Escritura atómica: nunca se sirve una variante a medias
+                temporal = destino + '.tmp'
+                imagen.save(temporal, formato, **opciones)
+                os.replace(temporal, destino)
+    return True
+
+
+def _generar_en_segundo_plano(app, carpeta, nombre):
+    try:
+        generar_variantes(carpeta, nombre)
+    except Exception:
+        app.logger.exception('No se pudieron generar las variantes de %s', nombre)
+
+
+def guardar(archivo):
+    """Guarda una imagen subida con nombre por hash y encola sus variantes."""
+    datos = archivo.read()
+    _, extension = os.path.splitext(archivo.filename)
+    nombre = nombre_por_contenido(datos, extension)
+    carpeta = _carpeta()
+    os.makedirs(carpeta, exist_ok=True)
+    ruta = os.path.join(carpeta, nombre)
+    if not os.path.exists(ruta):
+        temporal = ruta + '.tmp'
+        with open(temporal, 'wb') as f:
+            f.write(datos)
+        os.replace(temporal, ruta)
+
+    app = current_app._get_current_object()
+    app.extensions['imagenes_pool'].submit(_generar_en_segundo_plano, app, carpeta, nombre)
+    return nombre
+
+
+def variante(nombre, tipo='card'):
+    """URLs de la mejor versión disponible: {'webp': url|None, 'src': url}.
+
+    Si la variante aún no existe (procesándose, sin Pillow, imagen por
+    defecto) se devuelve el original.
+    """
+    carpeta = _carpeta()
+    listas = current_app.extensions['imagenes_listas']
+    if (nombre, tipo) not in listas:
+        if not os.path.exists(ruta_variante(carpeta, nombre, tipo, 'jpg')):
+            return {'webp': None, 'src': estaticos.url('uploads/' + nombre)}
+        listas.add((nombre, tipo))
+    base = 'uploads/%s/%s_%s.' % (CARPETA_VARIANTES, os.path.splitext(nombre)[0], tipo)
+    return {'webp': estaticos.url(base + 'webp'),
+            'src': estaticos.url(base + 'jpg')}
+
+
+def procesar_existentes(deduplicar=True):
+    """Renombra los originales por contenido, une duplicados y genera variantes."""
+    from .models import Producto, db
+
+    carpeta = _carpeta()
+    renombres = {}
+    for nombre in sorted(os.listdir(carpeta)):
+        ruta = os.path.join(carpeta, nombre)
+        if not os.path.isfile(ruta) or nombre.endswith('.tmp'):
+            continue
+        if deduplicar:
+            with open(ruta, 'rb') as f:
+                nuevo = nombre_por_contenido(f.read(), os.path.splitext(nombre)[1])
+            if nuevo != nombre:
+                if os.path.exists(os.path.join(carpeta, nuevo)):
+                    os.remove(ruta)
+                else:
+                    os.replace(ruta, os.path.join(carpeta, nuevo))
+                renombres[nombre] = nuevo
+                nombre = nuevo
+        try:
+            generar_variantes(carpeta, nombre)
+        except Exception as e:
+            current_app.logger.warning('Imagen %s omitida: %s', nombre, e)
+
+    for viejo, nuevo in renombres.items():
+        Producto.query.filter_by(imagen=viejo).update({'imagen': nuevo})
+    db.session.commit()
+    return renombres
+
+
+def init_app(app):
+    app.extensions['imagenes_pool'] = ThreadPoolExecutor(
+        max_workers=app.config.get('IMAGENES_HILOS', 2), thread_name_prefix='imagenes')
+    # Variantes ya confirmadas en disco (evita un stat por tarjeta)
+    app.extensions['imagenes_listas'] = set()
+    app.jinja_env.globals['variante_imagen'] = variante
+
+    @app.cli.command('procesar-imagenes')
+    @click.option('--sin-deduplicar', is_flag=True, help='No renombrar los originales por contenido.')
+    def procesar_imagenes(sin_deduplicar):
+        """Genera variantes de las imágenes existentes y une duplicados."""
+        if Image is None:
+            raise click.ClickException('Se necesita Pillow (pip install Pillow).')
+        renombres = procesar_existentes(deduplicar=not sin_deduplicar)
+        click.echo('Imágenes procesadas; %d renombradas o unidas.' % len(renombres))
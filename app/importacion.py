@@ -0,0 +1,245 @@
+import csv
+import io
+import json
+import math
+import os
+import re
+import zipfile
+import sqlalchemy as sa
+from flask import current_app
+from werkzeug.datastructures import FileStorage
+from . import imagenes
+from .cache import invalidar_catalogo
+from .models import Producto, db
+
+# Alta masiva de productos de una tienda desde CSV o JSONL.
+# Las filas se leen una a una del archivo subido (werkzeug ya lo guarda en
+# disco si es grande), se validan y se insertan en lotes con executemany.
+# Todo ocurre en una transacción: en modo estricto cualquier error la revierte.
+# Las imágenes del ZIP se escriben en disco solo después del commit.
+
+COLUMNAS = ('nombre', 'precio', 'descripcion', 'categoria', 'tipo', 'stock', 'stock_minimo', 'imagen')
+TIPOS = ('producto', 'servicio')
+LOTE = 500
+MAX_ERRORES = 200
+# Imágenes más grandes dentro del ZIP se ignoran (evita descomprimir bombas)
+MAX_IMAGEN = 10 * 1024 * 1024
+
+
+class ErrorFila(ValueError):
+    pass
+
+
+def formato_de(nombre_archivo, pedido=None):
+    if pedido in ('csv', 'jsonl'):
+        return pedido
+    return 'jsonl' if (nombre_archivo or '').lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+# Bytes que no son UTF-8 quedan como sustitutos U+DC80..U+DCFF (surrogateescape)
+_NO_UTF8 = re.compile('[\udc80-\udcff]')
+
+
+def leer_filas(flujo, formato):
+    """Itera (numero, dict) sin cargar el archivo completo en memoria.
+
+    Una fila con bytes que no son UTF-8 (p. ej. un CSV guardado en Latin-1)
+    llega como ErrorFila en vez de cortar la importación.
+    """
+    texto = io.TextIOWrapper(flujo, encoding='utf-8-sig', errors='surrogateescape', newline='')
+    if formato == 'jsonl':
+        for numero, linea in enumerate(texto, 1):
+            if not linea.strip():
+                continue
+            if _NO_UTF8.search(linea):
+                yield numero, ErrorFila('codificación no es UTF-8')
+                continue
+            try:
+                fila = json.loads(linea)
+            except ValueError:
+                yield numero, ErrorFila('JSON inválido')
+                continue
+            yield numero, fila if isinstance(fila, dict) else ErrorFila('se esperaba un objeto')
+        return
+    # En CSV la fila 1 es el encabezado
+    lector = csv.DictReader(texto)
+    if lector.fieldnames and any(_NO_UTF8.search(k) for k in lector.fieldnames if k):
+        yield 1, ErrorFila('codificación no es UTF-8')
+        return
+    for numero, fila in enumerate(lector, 2):
+        if any(isinstance(v, str) and _NO_UTF8.search(v) for v in fila.values()):
+            yield numero, ErrorFila('codificación no es UTF-8')
+            continue
+        yield numero, {k.strip().lower(): v for k, v in fila.items() if k}
+
+
+def _texto(fila, campo, maximo, defecto=None):
+    valor = fila.get(campo)
+    valor = str(valor).strip() if valor not in (None, '') else ''
+    if len(valor) > maximo:
+        raise ErrorFila('%s excede %d caracteres' % (campo, maximo))
+    return valor or defecto
+
+
+def _numero(fila, campo, tipo, defecto):
+    valor = fila.get(campo)
+    if valor in (None, ''):
+        return defecto
+    try:
+        numero = tipo(valor)
+    except (TypeError, ValueError, OverflowError):
+        raise ErrorFila('%s no es un número' % campo)
+    # float('nan') y float('inf') se convierten sin error (JSONL acepta NaN e Infinity)
+    if not math.isfinite(numero):
+        raise ErrorFila('%s no es un número' % campo)
+    if numero < 0:
+        raise ErrorFila('%s no puede ser negativo' % campo)
+    return numero
+
+
+def validar(fila, tienda_id):
+    """Convierte una fila en los valores de un INSERT de Producto o lanza ErrorFila."""
+    nombre = _texto(fila, 'nombre', 100)
+    if not nombre:
+        raise ErrorFila('falta el nombre')
+    if fila.get('precio') in (None, ''):
+        raise ErrorFila('falta el precio')
+    tipo = _texto(fila, 'tipo', 20, 'producto').lower()
+    if tipo not in TIPOS:
+        raise ErrorFila('tipo debe ser producto o servicio')
+    return {
+        'nombre': nombre,
+        'precio': _numero(fila, 'precio', float, None),
+        'descripcion': _texto(fila, 'descripcion', 5000),
+        'categoria': _texto(fila, 'categoria', 50, 'General'),
+        'tipo': tipo,
+        # Un servicio se publica como disponible (el catálogo muestra stock > 0)
+        'stock_actual': _numero(fila, 'stock', int, 1 if tipo == 'servicio' else 0),
+        'stock_minimo': _numero(fila, 'stock_minimo', int, 5),
+        'imagen': _texto(fila, 'imagen', 255),
+        'tienda_id': tienda_id,
+    }
+
+
+class ImagenesZip:
+    """Imágenes de un ZIP subido.
+
+    'nombre' calcula el nombre por contenido sin tocar el disco; 'guardar'
+    escribe con imagenes.guardar (una vez cada una) las que se usaron. Así una
+    importación revertida no deja archivos huérfanos en uploads.
+    """
+
+    def __init__(self, archivo):
+        self._zip = zipfile.ZipFile(archivo.stream)
+        # Se busca por nombre de archivo, sin importar las carpetas del ZIP
+        self._miembros = {os.path.basename(i.filename): i for i in self._zip.infolist()
+                          if not i.is_dir() and i.file_size <= MAX_IMAGEN}
+        self._usadas = {}
+
+    def __contains__(self, nombre):
+        return os.path.basename(nombre) in self._miembros
+
+    def nombre(self, nombre):
+        clave = os.path.basename(nombre)
+        if clave not in self._usadas:
+            info = self._miembros[clave]
+            with self._zip.open(info) as miembro:
+                self._usadas[clave] = imagenes.nombre_por_contenido(
+                    miembro.read(), os.path.splitext(info.filename)[1])
+        return self._usadas[clave]
+
+    def guardar(self):
+        """Escribe las imágenes usadas; se llama después del commit."""
+        for clave in self._usadas:
+            info = self._miembros[clave]
+            with self._zip.open(info) as miembro:
+                imagenes.guardar(FileStorage(miembro, filename=info.filename))
+
+    def cerrar(self):
+        self._zip.close()
+
+
+def _resolver_imagen(nombre, imagenes_zip):
+    if not nombre:
+        return 'default.jpg'
+    if imagenes_zip is not None and nombre in imagenes_zip:
+        return imagenes_zip.nombre(nombre)
+    # Nombre de una imagen ya subida (p. ej. al reimportar una exportación)
+    if os.path.basename(nombre) == nombre and os.path.isfile(os.path.join(current_app.config['UPLOAD_FOLDER'], nombre)):
+        return nombre
+    raise ErrorFila('imagen %s no encontrada' % nombre)
+
+
+def importar(tienda_id, filas, imagenes_zip=None, estricto=False, max_filas=None):
+    """Inserta los productos válidos por lotes; devuelve (insertados, errores).
+
+    'errores' es una lista de {'fila': n, 'error': texto} (acotada a MAX_ERRORES).
+    En modo estricto, si hubo errores no se inserta nada.
+    """
+    insertados, procesadas, errores, lote = 0, 0, [], []
+
+    def volcar():
+        if lote:
+            db.session.execute(sa.insert(Producto), lote)
+            del lote[:]
+
+    try:
+        for numero, fila in filas:
+            if max_filas and procesadas >= max_filas:
+                errores.append({'fila': numero, 'error': 'límite de %d filas alcanzado' % max_filas})
+                break
+            procesadas += 1
+            try:
+                if isinstance(fila, ErrorFila):
+                    raise fila
+                valores = validar(fila, tienda_id)
+                valores['imagen'] = _resolver_imagen(valores['imagen'], imagenes_zip)
+            except ErrorFila as e:
+                if len(errores) < MAX_ERRORES:
+                    errores.append({'fila': numero, 'error': str(e)})
+                continue
+            lote.append(valores)
+            if len(lote) >= LOTE:
+                insertados += len(lote)
+                volcar()
+        insertados += len(lote)
+        volcar()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if estricto and errores:
+        db.session.rollback()
+        return 0, errores
+    if insertados:
+        invalidar_catalogo()
+    db.session.commit()
+    if imagenes_zip is not None:
+        imagenes_zip.guardar()
+    return insertados, errores
+
+
+def exportar(tienda_id, formato='csv'):
+    """Genera el catálogo de la tienda por trozos, leyendo la BD por lotes."""
+    columnas = [Producto.id, Producto.nombre, Producto.precio, Producto.descripcion, Producto.categoria,
+                Producto.tipo, Producto.stock_actual, Producto.stock_minimo, Producto.imagen]
+    encabezado = ('id',) + COLUMNAS
+    resultado = db.session.execute(
+        sa.select(*columnas).where(Producto.tienda_id == tienda_id).order_by(Producto.id)
+        .execution_options(yield_per=LOTE))
+
+    if formato == 'jsonl':
+        for filas in resultado.partitions():
+            yield ''.join(json.dumps(dict(zip(encabezado, fila)), ensure_ascii=False) + '\n' for fila in filas)
+        return
+
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(encabezado)
+    for filas in resultado.partitions():
+        escritor.writerows(filas)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
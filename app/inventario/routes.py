@@ -1,10 +1,22 @@
-import os
-import secrets
-from flask import render_template, redirect, url_for, flash, request, current_app
+import csv
+import io
+import zipfile
+from flask import render_template, redirect, url_for, flash, request, jsonify, Response, current_app, stream_with_context
 from flask_login import login_required, current_user
+import sqlalchemy as sa
+from sqlalchemy.orm import joinedload
+from datetime import date, datetime, time, timedelta
 from ..models import Producto, Pedido, PedidoItem, db
+from ..cache import invalidar_catalogo
+from .. import imagenes, importacion
+from .. import ventas as ventas_resumen
 from . import inventario
 
+ULTIMAS_VENTAS = 50
+POR_PAGINA = 50
+PRODUCTOS_GRAFICA = 20
+# Productos por UPDATE en el ajuste masivo (límite de parámetros de SQLite)
+LOTE_STOCK = 300
 
 def solo_tiendas(func):
     from functools import wraps
@@ -16,40 +28,76 @@ def solo_tiendas(func):
         return func(*args, **kwargs)
     return wrapper
 
+def _fecha(texto):
+    try:
+        return date.fromisoformat(texto) if texto else None
+    except ValueError:
+        return None
+
 def guardar_imagen(form_picture):
-    random_hex = secrets.token_hex(8)
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(current_app.config['UPLOAD_FOLDER'], picture_fn)
-    form_picture.save(picture_path)
-    return picture_fn
+    # Nombre por contenido (sin duplicados en disco); miniaturas en segundo plano
+    return imagenes.guardar(form_picture)
 
 @inventario.route('/dashboard')
 @login_required
 @solo_tiendas
 def dashboard():
-    mis_productos = Producto.query.filter_by(tienda_id=current_user.id).all()
-    
-    # Alerta solo cuenta PRODUCTOS, no servicios
-    alertas = sum(1 for p in mis_productos if p.tipo == 'producto' and p.stock_actual <= p.stock_minimo)
-    
-    nombres_prod = [p.nombre for p in mis_productos]
-    stocks_prod = [p.stock_actual for p in mis_productos]
+    pagina = max(request.args.get('page', 1, type=int), 1)
+    mios = Producto.tienda_id == current_user.id
+
+    # Conteos en SQL: no se cargan los productos para contarlos
+    total_productos, alertas = db.session.execute(
+        sa.select(sa.func.count(Producto.id),
+                  # Alerta solo cuenta PRODUCTOS, no servicios
+                  sa.func.coalesce(sa.func.sum(sa.case(
+                      (sa.and_(Producto.tipo == 'producto',
+                               Producto.stock_actual <= Producto.stock_minimo), 1),
+                      else_=0)), 0))
+        .where(mios)).one()
+
+    # La gráfica muestra los productos con menos stock (solo nombre y stock)
+    grafica = db.session.execute(
+        sa.select(Producto.nombre, Producto.stock_actual)
+        .where(mios, Producto.tipo == 'producto')
+        .order_by(Producto.stock_actual, Producto.id)
+        .limit(PRODUCTOS_GRAFICA)).all()
+
+    mis_productos = (Producto.query.filter(mios).order_by(Producto.id)
+                     .offset((pagina - 1) * POR_PAGINA).limit(POR_PAGINA).all())
 
     return render_template('inventario/dashboard.html', 
                            productos=mis_productos, 
+                           total_productos=total_productos,
                            alertas=alertas,
-                           nombres=nombres_prod,
-                           datos=stocks_prod)
+                           nombres=[n for n, _ in grafica],
+                           datos=[s for _, s in grafica],
+                           pagina=pagina,
+                           hay_mas=pagina * POR_PAGINA < total_productos)
 
 
 @inventario.route('/ventas')
 @login_required
 @solo_tiendas
 def historial_ventas():
-    ventas = PedidoItem.query.join(Producto).join(Pedido).filter(Producto.tienda_id == current_user.id).all()
-    ingreso_total = sum(item.producto.precio * item.cantidad for item in ventas)
-    return render_template('inventario/ventas.html', ventas=ventas, total=ingreso_total)
+    desde = _fecha(request.args.get('desde'))
+    hasta = _fecha(request.args.get('hasta'))
+
+    # Totales y gráficas desde el resumen precalculado (no recorre el historial)
+    resumen = ventas_resumen.totales(current_user.id, desde, hasta)
+
+    # Solo las transacciones más recientes, con pedido/cliente/producto en el mismo SELECT
+    query = (PedidoItem.query.join(Producto).join(Pedido)
+             .filter(Producto.tienda_id == current_user.id)
+             .options(joinedload(PedidoItem.producto),
+                      joinedload(PedidoItem.pedido).joinedload(Pedido.cliente)))
+    if desde:
+        query = query.filter(Pedido.fecha >= datetime.combine(desde, time.min))
+    if hasta:
+        query = query.filter(Pedido.fecha < datetime.combine(hasta + timedelta(days=1), time.min))
+    ventas = query.order_by(Pedido.fecha.desc(), PedidoItem.id.desc()).limit(ULTIMAS_VENTAS).all()
+
+    return render_template('inventario/ventas.html', ventas=ventas, total=resumen['ingreso'],
+                           resumen=resumen, desde=desde, hasta=hasta)
 
 @inventario.route('/agregar', methods=['GET', 'POST'])
 @login_required
@@ -75,6 +123,7 @@ def agregar_producto():
         )
         
         db.session.add(nuevo_item)
+        invalidar_catalogo()
         db.session.commit()
         return redirect(url_for('inventario.dashboard'))
         
@@ -84,13 +133,159 @@ def agregar_producto():
 @login_required
 @solo_tiendas
 def ajustar_stock(id):
-    producto = Producto.query.get_or_404(id)
+    producto = db.get_or_404(Producto, id)
     if producto.propietario != current_user:
         return "Acceso denegado", 403
     
     # Solo se ajusta stock si es producto
     if producto.tipo == 'producto':
         producto.stock_actual = int(request.form.get('nuevo_stock'))
+        invalidar_catalogo()
         db.session.commit()
         
-    return redirect(url_for('inventario.dashboard'))
\ No newline at end of file
+    return redirect(url_for('inventario.dashboard'))
+
+def _leer_pares_stock():
+    """Pares (id, stock) desde JSON, un CSV subido o campos stock_<id> del formulario."""
+    if request.is_json:
+        # La forma del documento ({"items": [...]}) ya la validó stock_masivo
+        for item in request.get_json(silent=True).get('items', []):
+            if isinstance(item, dict):
+                yield item.get('id'), item.get('stock')
+            elif isinstance(item, list) and len(item) >= 2:
+                yield item[0], item[1]
+            else:
+                # Renglón mal formado: sin stock válido, aplicar_stock lo rechaza
+                yield item, None
+        return
+
+    archivo = request.files.get('archivo')
+    if archivo:
+        for fila in csv.reader(io.TextIOWrapper(archivo.stream, encoding='utf-8-sig')):
+            if len(fila) >= 2:
+                yield fila[0], fila[1]
+        return
+
+    for campo, valor in request.form.items():
+        if campo.startswith('stock_'):
+            yield campo[len('stock_'):], valor
+
+def _entero(valor):
+    """Entero no negativo desde un int de JSON o un texto de dígitos; None si no lo es.
+
+    Sin int() directo: truncaría 3.7 a 3 y convertiría True en 1.
+    """
+    if isinstance(valor, int) and not isinstance(valor, bool):
+        return valor if valor >= 0 else None
+    if isinstance(valor, str) and valor.strip().isdigit():
+        return int(valor.strip())
+    return None
+
+def aplicar_stock(tienda_id, pares):
+    """Aplica muchos ajustes de stock con UPDATE ... CASE por lotes, en una transacción.
+
+    Solo toca productos físicos de la tienda; devuelve (actualizados, rechazados).
+    Un id con algún renglón inválido se rechaza completo, aunque otro renglón
+    suyo sea válido.
+    """
+    nuevos, rechazados = {}, []
+    for id, stock in pares:
+        if id in (None, '', 'id'):
+            # Encabezados de CSV o renglones sin id
+            continue
+        numero, stock = _entero(id), _entero(stock)
+        if numero is not None:
+            id = numero
+        if id in rechazados:
+            continue
+        if numero is None or stock is None:
+            rechazados.append(id)
+            nuevos.pop(id, None)
+        else:
+            nuevos[id] = stock
+
+    actualizados = 0
+    ids = list(nuevos)
+    for i in range(0, len(ids), LOTE_STOCK):
+        lote = {id: nuevos[id] for id in ids[i:i + LOTE_STOCK]}
+        # Verificación de propiedad en el mismo WHERE del UPDATE
+        propios = set(db.session.execute(
+            sa.select(Producto.id).where(Producto.id.in_(list(lote)),
+                                         Producto.tienda_id == tienda_id,
+                                         Producto.tipo == 'producto')).scalars())
+        rechazados.extend(id for id in lote if id not in propios)
+        if propios:
+            resultado = db.session.execute(
+                sa.update(Producto)
+                .where(Producto.id.in_(list(propios)), Producto.tienda_id == tienda_id)
+                .values(stock_actual=sa.case({id: lote[id] for id in propios}, value=Producto.id))
+                .execution_options(synchronize_session=False))
+            actualizados += resultado.rowcount
+    if actualizados:
+        invalidar_catalogo()
+    db.session.commit()
+    return actualizados, rechazados
+
+@inventario.route('/stock_masivo', methods=['POST'])
+@login_required
+@solo_tiendas
+def stock_masivo():
+    if request.is_json:
+        datos = request.get_json(silent=True)
+        if not isinstance(datos, dict) or not isinstance(datos.get('items', []), list):
+            return jsonify({'status': 'error', 'mensaje': 'Se esperaba {"items": [...]}'}), 400
+    try:
+        actualizados, rechazados = aplicar_stock(current_user.id, _leer_pares_stock())
+    except UnicodeDecodeError:
+        return jsonify({'status': 'error', 'mensaje': 'El archivo no está en UTF-8'}), 400
+
+    if request.is_json:
+        return jsonify({'status': 'ok', 'actualizados': actualizados, 'rechazados': rechazados})
+    flash('Stock actualizado: %d productos.' % actualizados)
+    if rechazados:
+        flash('Ignorados (no existen, no son tuyos o datos inválidos): %s' % ', '.join(map(str, rechazados[:20])))
+    return redirect(request.referrer or url_for('inventario.dashboard'))
+
+@inventario.route('/importar', methods=['POST'])
+@login_required
+@solo_tiendas
+def importar_productos():
+    archivo = request.files.get('archivo')
+    if not archivo:
+        return jsonify({'status': 'error', 'mensaje': 'Falta el archivo'}), 400
+    formato = importacion.formato_de(archivo.filename, request.form.get('formato'))
+
+    zip_imagenes = None
+    if request.files.get('imagenes'):
+        try:
+            zip_imagenes = importacion.ImagenesZip(request.files['imagenes'])
+        except zipfile.BadZipFile:
+            return jsonify({'status': 'error', 'mensaje': 'El archivo de imágenes no es un ZIP'}), 400
+    try:
+        insertados, errores = importacion.importar(
+            current_user.id, importacion.leer_filas(archivo.stream, formato), zip_imagenes,
+            estricto=bool(request.form.get('estricto')),
+            max_filas=current_app.config.get('IMPORTACION_MAX_FILAS', 50000))
+    finally:
+        if zip_imagenes is not None:
+            zip_imagenes.cerrar()
+
+    if request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html:
+        return jsonify({'status': 'ok', 'insertados': insertados, 'errores': errores})
+    flash('Importados: %d productos.' % insertados)
+    for error in errores[:10]:
+        flash('Fila %d: %s' % (error['fila'], error['error']))
+    if len(errores) > 10:
+        flash('... y %d errores más.' % (len(errores) - 10))
+    return redirect(url_for('inventario.dashboard'))
+
+@inventario.route('/exportar')
+@login_required
+@solo_tiendas
+def exportar_productos():
+    formato = 'jsonl' if request.args.get('formato') == 'jsonl' else 'csv'
+    # Se genera por lotes mientras se envía; la sesión de BD sigue abierta hasta el final
+    respuesta = Response(stream_with_context(importacion.exportar(current_user.id, formato)),
+                         mimetype='application/x-ndjson' if formato == 'jsonl' else 'text/csv')
+    respuesta.headers['Content-Disposition'] = 'attachment; filename=catalogo.%s' % formato
+    return respuesta
@@ -1,8 +1,15 @@
 from flask import render_template, redirect, url_for, flash, request, session
 from flask_login import login_required, current_user
-from ..models import Producto, Pedido, PedidoItem, db
+from ..models import Producto, Pedido, PedidoArchivado, PedidoItem, PedidoItemArchivado, db
+from .. import busqueda, cambios, carrito, checkout, facetas, geo, recomendaciones
+from ..cache import cache_catalogo
 from . import market
-from flask import jsonify
+from flask import Response, current_app, jsonify, make_response, stream_with_context
+from sqlalchemy.orm import joinedload, selectinload
+import sqlalchemy as sa
+from datetime import datetime
+from urllib.parse import quote
+import json
 
 # ---  RUTA HOME (LANDING PAGE) ---
 @market.route('/')
@@ -10,24 +17,88 @@ def home():
     return render_template('landing.html')
 
 # --- RUTA DEL CATÁLOGO  ---
+POR_PAGINA = 48
+# Tope de ?page=: un número enorme desbordaría el OFFSET (entero de 64 bits)
+MAX_PAGINA = 10000
+
+def _tarjeta_producto(p):
+    # Datos planos: se guardan en cache sin depender de la sesión de BD
+    return {
+        'id': p.id, 'nombre': p.nombre, 'precio': p.precio, 'categoria': p.categoria,
+        'tipo': p.tipo, 'imagen': p.imagen, 'updated_at': p.updated_at,
+        'propietario': {'nombre': p.propietario.nombre,
+                        'calificacion': p.propietario.calificacion,
+                        'telefono': p.propietario.telefono},
+    }
+
+def _filtros_catalogo():
+    # Varias opciones por faceta (?categoria=A&categoria=B): OR dentro de la
+    # faceta, AND entre facetas.
+    return {
+        'categoria': tuple(sorted(set(v for v in request.args.getlist('categoria') if v))),
+        'tipo': tuple(sorted(set(v for v in request.args.getlist('tipo') if v))),
+        'tienda': tuple(sorted(set(request.args.getlist('tienda', type=int)))),
+    }
+
+def _url_faceta(faceta, valor):
+    """URL del catálogo con 'valor' activado o desactivado en la faceta."""
+    args = request.args.to_dict(flat=False)
+    args.pop('page', None)
+    valores = args.get(faceta, [])
+    valor = str(valor)
+    args[faceta] = [v for v in valores if v != valor] if valor in valores else valores + [valor]
+    return url_for('market.catalogo', **args)
+
 @market.route('/catalogo')
 def catalogo():
     # Lógica de filtros 
-    categoria = request.args.get('categoria')
-    busqueda = request.args.get('q')
-    
-    query = Producto.query.filter(Producto.stock_actual > 0)
-    
-    if categoria:
-        query = query.filter_by(categoria=categoria)
-    if busqueda:
-        query = query.filter(Producto.nombre.contains(busqueda))
-        
-    productos = query.all()
-    categorias_raw = db.session.query(Producto.categoria).distinct().all()
-    categorias = [c[0] for c in categorias_raw]
-    
-    return render_template('market/index.html', productos=productos, categorias=categorias)
+    filtros = _filtros_catalogo()
+    q = request.args.get('q', '').strip()
+    pagina = min(max(request.args.get('page', 1, type=int), 1), MAX_PAGINA)
+    claves_filtro = tuple(filtros.items())
+
+    cache = cache_catalogo()
+    # El HTML incluye el menú del usuario y el tamaño del carrito; se leen
+    # de la cookie de sesión: un 304 solo cuesta leer la versión del catálogo.
+    etag = cache.etag(claves_filtro, q, pagina, session.get('_user_id'), session.get('carrito_n', 0))
+    hay_mensajes = bool(session.get('_flashes'))
+    if not hay_mensajes and cache.no_modificado(etag):
+        return cache.marcar(Response(status=304), etag)
+
+    clave = (cache.version, 'catalogo', claves_filtro, q, pagina)
+    datos = cache.get(clave)
+    if datos is None:
+        query = Producto.query.filter(Producto.stock_actual > 0)
+
+        if filtros['categoria']:
+            query = query.filter(Producto.categoria.in_(filtros['categoria']))
+        if filtros['tipo']:
+            query = query.filter(Producto.tipo.in_(filtros['tipo']))
+        if filtros['tienda']:
+            query = query.filter(Producto.tienda_id.in_(filtros['tienda']))
+
+        # Índice de texto completo: nombre, descripción y categoría, por relevancia
+        query = busqueda.filtrar(query, q)
+        query = query.order_by(Producto.id).options(joinedload(Producto.propietario))
+
+        productos = query.offset((pagina - 1) * POR_PAGINA).limit(POR_PAGINA + 1).all()
+        datos = {
+            'productos': [_tarjeta_producto(p) for p in productos[:POR_PAGINA]],
+            'hay_mas': len(productos) > POR_PAGINA,
+            # Conteos precalculados (tabla conteo_faceta), sin recorrer Producto
+            'facetas': facetas.conteos(),
+        }
+        cache.set(clave, datos)
+
+    # "Se compra junto con" se lee al renderizar: la matriz es de este proceso
+    # y cambia sin nueva versión del catálogo, así que no va en la cache
+    respuesta = make_response(render_template('market/index.html', pagina=pagina, filtros=filtros,
+                                              url_faceta=_url_faceta, junto_con=recomendaciones.junto_con,
+                                              **datos))
+    if hay_mensajes:
+        # Los mensajes flash son de un solo uso: esta página no se revalida
+        return respuesta
+    return cache.marcar(respuesta, etag)
 
 
 
@@ -38,88 +109,252 @@ def agregar_carrito(id):
         flash('Las tiendas no compran.')
         return redirect(url_for('market.catalogo')) 
 
-    if 'carrito' not in session:
-        session['carrito'] = []
-
-    session['carrito'].append(id)
-    session.modified = True
+    # El carrito vive en el servidor; la cookie solo lleva el contador
+    carrito.almacen().agregar(current_user.id, id)
+    session['carrito_n'] = session.get('carrito_n', 0) + 1
     flash('Producto agregado.')
     return redirect(url_for('market.catalogo')) 
 
 @market.route('/eliminar_item/<int:id>')
 @login_required
 def eliminar_item_carrito(id):
-    if 'carrito' in session:
-        carrito = session['carrito']
-        if id in carrito:
-            carrito.remove(id)
-            session['carrito'] = carrito
-            session.modified = True
-            flash('Producto eliminado del carrito.')
+    carrito.almacen().quitar(current_user.id, id)
+    carrito.sincronizar_contador(current_user.id)
+    flash('Producto eliminado del carrito.')
+    return redirect(url_for('market.ver_carrito'))
+
+@market.route('/carrito/cantidad/<int:id>', methods=['POST'])
+@login_required
+def cantidad_carrito(id):
+    carrito.almacen().fijar(current_user.id, id, request.form.get('cantidad', 0, type=int))
+    carrito.sincronizar_contador(current_user.id)
     return redirect(url_for('market.ver_carrito'))
 
 @market.route('/carrito', methods=['GET', 'POST'])
 @login_required
 def ver_carrito():
-    carrito_ids = session.get('carrito', [])
-    productos_en_carrito = []
-    total = 0
-    
-    for pid in carrito_ids:
-        prod = Producto.query.get(pid)
-        if prod:
-            productos_en_carrito.append(prod)
-            total += prod.precio
+    # {producto_id: cantidad} del almacén + un solo SELECT ... IN de productos
+    cantidades = carrito.almacen().obtener(current_user.id)
+    productos_en_carrito, total = checkout.cargar_carrito(cantidades)
 
     if request.method == 'POST':
         if not productos_en_carrito:
             return redirect(url_for('market.catalogo')) 
 
-        nuevo_pedido = Pedido(
-            total=total,
-            cliente_id=current_user.id,
-            estado='pendiente',
-            tipo_entrega=request.form.get('tipo_entrega'),
-            metodo_pago=request.form.get('metodo_pago')
-        )
-        db.session.add(nuevo_pedido)
-        db.session.commit() 
-        
-        for prod in productos_en_carrito:
-            item = PedidoItem(pedido_id=nuevo_pedido.id, producto_id=prod.id)
-            db.session.add(item)
-            prod.stock_actual -= 1
-            
-        db.session.commit()
-        session.pop('carrito', None)
+        # Destino: la ubicación que mandó el navegador o, si no, la del perfil
+        destino = None
+        if request.form.get('tipo_entrega') == 'envio':
+            destino = (geo.coordenadas(request.form.get('lat'), request.form.get('lon'))
+                       or geo.coordenadas(current_user.lat, current_user.lon))
+        try:
+            checkout.confirmar_pedido(current_user.id, productos_en_carrito, cantidades,
+                                      tipo_entrega=request.form.get('tipo_entrega'),
+                                      metodo_pago=request.form.get('metodo_pago'),
+                                      antes_de_confirmar=lambda: carrito.almacen().vaciar(current_user.id, commit=False),
+                                      destino=destino)
+        except checkout.StockInsuficiente as e:
+            flash('Sin stock suficiente: ' + ', '.join(e.productos))
+            return redirect(url_for('market.ver_carrito'))
+
+        session['carrito_n'] = 0
         
         flash('¡Pedido realizado con éxito!')
         return redirect(url_for('market.historial'))
 
-    return render_template('market/carrito.html', productos=productos_en_carrito, total=total)
+    # Sugerencias por co-ocurrencia: ids de la matriz en memoria + un SELECT ... IN
+    sugeridos = []
+    ids = recomendaciones.para_carrito(list(cantidades))
+    if ids:
+        por_id = {p.id: p for p in Producto.query.filter(Producto.id.in_(ids), Producto.stock_actual > 0)}
+        sugeridos = [por_id[i] for i in ids if i in por_id]
+
+    return render_template('market/carrito.html', productos=productos_en_carrito, cantidades=cantidades,
+                           total=total, sugeridos=sugeridos)
+
+PEDIDOS_POR_PAGINA = 20
+ITEMS_VISTA_PREVIA = 3
+
+def _cursor_pedido(texto):
+    # "<fecha iso>_<id>" del último pedido de la página anterior
+    try:
+        fecha, id = texto.rsplit('_', 1)
+        return datetime.fromisoformat(fecha), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+def _resumen_pedido(p):
+    # Vista previa: primeros ítems, tiendas distintas y conteo total
+    items = p.items
+    tiendas = []
+    for item in items:
+        if item.producto.propietario.nombre not in tiendas:
+            tiendas.append(item.producto.propietario.nombre)
+    return {
+        'pedido': p,
+        'previa': items[:ITEMS_VISTA_PREVIA],
+        'restantes': max(len(items) - ITEMS_VISTA_PREVIA, 0),
+        'unidades': sum(i.cantidad for i in items),
+        'tiendas': tiendas,
+    }
 
 @market.route('/mis_pedidos')
 @login_required
 def historial():
-    pedidos = Pedido.query.filter_by(cliente_id=current_user.id).order_by(Pedido.fecha.desc()).all()
-    return render_template('market/historial.html', pedidos=pedidos)
+    # ?archivo=1 consulta el almacén frío (pedidos entregados antiguos)
+    archivo = bool(request.args.get('archivo'))
+    modelo, item = (PedidoArchivado, PedidoItemArchivado) if archivo else (Pedido, PedidoItem)
+
+    # Paginación por llave (fecha, id) sobre ix_pedido_cliente_fecha, sin OFFSET
+    query = sa.select(modelo).where(modelo.cliente_id == current_user.id)
+    cursor = _cursor_pedido(request.args.get('cursor'))
+    if cursor:
+        query = query.where(sa.tuple_(modelo.fecha, modelo.id) < cursor)
+    # Ítems, productos y tiendas en una segunda consulta (selectin + joins), sin N+1
+    query = (query.order_by(modelo.fecha.desc(), modelo.id.desc())
+             .limit(PEDIDOS_POR_PAGINA + 1)
+             .options(selectinload(modelo.items).joinedload(item.producto).joinedload(Producto.propietario)))
+    pedidos = db.session.scalars(query).all()
+
+    hay_mas = len(pedidos) > PEDIDOS_POR_PAGINA
+    pedidos = pedidos[:PEDIDOS_POR_PAGINA]
+    siguiente = '%s_%d' % (pedidos[-1].fecha.isoformat(), pedidos[-1].id) if hay_mas else None
+    return render_template('market/historial.html', pedidos=[_resumen_pedido(p) for p in pedidos],
+                           siguiente=siguiente, archivo=archivo)
 
 @market.route('/limpiar')
 def limpiar_carrito():
+    if current_user.is_authenticated:
+        carrito.almacen().vaciar(current_user.id)
     session.pop('carrito', None)
+    session['carrito_n'] = 0
     return redirect(url_for('market.catalogo'))
 
+# Campos disponibles en la API (se eligen con ?fields=id,nombre,...)
+CAMPOS_API = ('id', 'nombre', 'precio', 'tienda', 'categoria', 'tipo', 'imagen_url')
+LIMITE_API = 50
+LIMITE_API_MAX = 500
+
+def _serializar_producto(p, campos, base_imagenes):
+    valores = {
+        'id': lambda: p.id,
+        'nombre': lambda: p.nombre,
+        'precio': lambda: p.precio,
+        'tienda': lambda: p.propietario.nombre,
+        'categoria': lambda: p.categoria,
+        'tipo': lambda: p.tipo,
+        'imagen_url': lambda: base_imagenes + quote(p.imagen),
+    }
+    return {c: valores[c]() for c in campos}
+
+def _campos_api():
+    return [c for c in request.args.get('fields', '').split(',') if c in CAMPOS_API] or list(CAMPOS_API)
+
+def _ids_api():
+    # None si no se pidió ?ids=; los ids inválidos se ignoran
+    if 'ids' not in request.args:
+        return None
+    ids = [int(i) for i in request.args['ids'].split(',') if i.strip().isdigit()]
+    return list(dict.fromkeys(ids))[:LIMITE_API_MAX]
+
 @market.route('/api/productos')
 def api_productos():
-    productos = Producto.query.filter(Producto.stock_actual > 0).all()
-    data = []
-    for p in productos:
-        data.append({
-            'id': p.id,
-            'nombre': p.nombre,
-            'precio': p.precio,
-            'tienda': p.propietario.nombre,
-            'categoria': p.categoria,
-            'imagen_url': url_for('static', filename='uploads/' + p.imagen, _external=True)
-        })
-    return jsonify({'status': 'ok', 'count': len(data), 'data': data})
\ No newline at end of file
+    cache = cache_catalogo()
+    # La versión va en la clave: una página que termina de generarse después
+    # de una invalidación no puede quedar guardada como vigente.
+    clave = (cache.version, 'api') + tuple(sorted(request.args.items(multi=True)))
+    etag = cache.etag(*clave[1:])
+    if cache.no_modificado(etag):
+        return cache.marcar(Response(status=304), etag)
+    cuerpo = cache.get(clave)
+    if cuerpo is not None:
+        return cache.marcar(Response(cuerpo, mimetype='application/json'), etag)
+
+    campos = _campos_api()
+    cursor = request.args.get('cursor', 0, type=int)
+    limite = min(max(request.args.get('limit', LIMITE_API, type=int), 1), LIMITE_API_MAX)
+
+    # Paginación por llave (keyset): id > cursor, sin OFFSET
+    query = Producto.query.filter(Producto.stock_actual > 0, Producto.id > cursor)
+    # ?ids=1,2,3: lote puntual (p. ej. lo que pidió el feed de cambios)
+    ids = _ids_api()
+    if ids is not None:
+        query = query.filter(Producto.id.in_(ids))
+        limite = len(ids) or 1
+    if request.args.get('categoria'):
+        query = query.filter(Producto.categoria == request.args['categoria'])
+    if request.args.get('tienda', type=int):
+        query = query.filter(Producto.tienda_id == request.args.get('tienda', type=int))
+    if request.args.get('tipo'):
+        query = query.filter(Producto.tipo == request.args['tipo'])
+    if 'tienda' in campos:
+        # La tienda viaja en el mismo SELECT (evita una consulta por producto)
+        query = query.options(joinedload(Producto.propietario))
+    # Se pide uno de más para saber si hay otra página
+    query = query.order_by(Producto.id).limit(limite + 1).yield_per(100)
+
+    # url_for una sola vez; cada imagen solo concatena su nombre
+    base_imagenes = url_for('static', filename='uploads/', _external=True)
+
+    def generar():
+        trozos = []
+        for trozo in _generar_pagina():
+            trozos.append(trozo)
+            yield trozo
+        # Página completa (acotada por LIMITE_API_MAX): se guarda para la próxima
+        cache.set(clave, ''.join(trozos))
+
+    def _generar_pagina():
+        yield '{"status": "ok", "data": ['
+        count, ultimo_id, hay_mas = 0, None, False
+        encontrados = set()
+        for p in query:
+            if count == limite:
+                hay_mas = True
+                break
+            yield (',' if count else '') + json.dumps(_serializar_producto(p, campos, base_imagenes))
+            count += 1
+            ultimo_id = p.id
+            encontrados.add(p.id)
+        if ids is not None:
+            # Sin stock o eliminados: el cliente los borra de su copia
+            yield '], "missing": %s' % json.dumps([i for i in ids if i not in encontrados])
+        else:
+            yield ']'
+        yield ', "count": %d, "next_cursor": %s}' % (count, json.dumps(ultimo_id if hay_mas else None))
+
+    return cache.marcar(Response(stream_with_context(generar()), mimetype='application/json'), etag)
+
+@market.route('/api/productos/changes')
+def api_cambios_productos():
+    """Feed de cambios: productos nuevos o modificados (upserts) y bajas (tombstones)
+    desde el cursor 'since'. Con since=0 llega el catálogo completo."""
+    if not current_app.extensions.get('cambios_triggers'):
+        return jsonify({'status': 'error', 'mensaje': 'Feed de cambios no disponible en este motor'}), 501
+    since = request.args.get('since', 0, type=int)
+    limite = min(max(request.args.get('limit', LIMITE_API_MAX, type=int), 1), LIMITE_API_MAX)
+    if since > cambios.ultimo_id():
+        # Cursor de otra base de datos (o inventado): hay que empezar de cero
+        return jsonify({'status': 'error', 'mensaje': 'Cursor desconocido; sincroniza con since=0'}), 410
+
+    filas, cursor, hay_mas = cambios.desde(since, limite)
+    # El id siempre viaja: es con lo que el cliente aplica el cambio
+    campos = ['id'] + [c for c in _campos_api() if c != 'id']
+    query = Producto.query.filter(Producto.id.in_([i for i, op in filas if op == 'upsert']),
+                                  Producto.stock_actual > 0)
+    if 'tienda' in campos:
+        query = query.options(joinedload(Producto.propietario))
+    # Se envía el estado actual: si cambió después, su cambio posterior llega en otro tramo
+    actuales = {p.id: p for p in query}
+    base_imagenes = url_for('static', filename='uploads/', _external=True)
+    return jsonify({
+        'status': 'ok',
+        'upserts': [_serializar_producto(actuales[i], campos, base_imagenes) for i, _ in filas if i in actuales],
+        'tombstones': [i for i, _ in filas if i not in actuales],
+        'cursor': cursor,
+        'has_more': hay_mas,
+    })
+
+@market.route('/api/catalogo/cache')
+def api_cache_catalogo():
+    # Contadores de aciertos/fallos para monitoreo
+    return jsonify(cache_catalogo().estadisticas())
@@ -0,0 +1,147 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from flask import g, has_app_context, jsonify, abort, request, template_rendered, before_render_template
+import sqlalchemy as sa
+from . import db
+
+# Límites superiores de las cubetas de los histogramas
+CUBETAS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+CUBETAS_CONSULTAS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histograma:
+    def __init__(self, limites):
+        self.limites = limites
+        self.cuentas = [0] * (len(limites) + 1)
+        self.total = 0
+        self.suma = 0.0
+        self.maximo = 0
+
+    def agregar(self, valor):
+        self.cuentas[bisect_left(self.limites, valor)] += 1
+        self.total += 1
+        self.suma += valor
+        self.maximo = max(self.maximo, valor)
+
+    def a_dict(self):
+        etiquetas = ['<=%s' % l for l in self.limites] + ['>%s' % self.limites[-1]]
+        return {'cubetas': dict(zip(etiquetas, self.cuentas)),
+                'promedio': round(self.suma / self.total, 2) if self.total else 0,
+                'max': round(self.maximo, 2)}
+
+
+class RegistroMetricas:
+    """Acumula, por endpoint, consultas SQL, tiempos y patrones N+1."""
+
+    def __init__(self, umbral_n1=5):
+        self.umbral_n1 = umbral_n1
+        self.rutas = {}
+        self.ultima = None
+        self._lock = threading.Lock()
+
+    def registrar(self, endpoint, datos):
+        with self._lock:
+            ruta = self.rutas.get(endpoint)
+            if ruta is None:
+                ruta = self.rutas[endpoint] = {
+                    'peticiones': 0, 'n_mas_1': 0,
+                    'consultas': Histograma(CUBETAS_CONSULTAS),
+                    'tiempo_ms': Histograma(CUBETAS_MS),
+                    'sql_ms': Histograma(CUBETAS_MS),
+                    'render_ms': Histograma(CUBETAS_MS),
+                }
+            ruta['peticiones'] += 1
+            ruta['n_mas_1'] += bool(datos['repetidas'])
+            ruta['consultas'].agregar(datos['consultas'])
+            ruta['tiempo_ms'].agregar(datos['tiempo_ms'])
+            ruta['sql_ms'].agregar(datos['sql_ms'])
+            ruta['render_ms'].agregar(datos['render_ms'])
+            self.ultima = dict(datos, endpoint=endpoint)
+
+    def resumen(self):
+        with self._lock:
+            return {endpoint: {'peticiones': r['peticiones'], 'n_mas_1': r['n_mas_1'],
+                               'consultas': r['consultas'].a_dict(),
+                               'tiempo_ms': r['tiempo_ms'].a_dict(),
+                               'sql_ms': r['sql_ms'].a_dict(),
+                               'render_ms': r['render_ms'].a_dict()}
+                    for endpoint, r in self.rutas.items()}
+
+
+def _medicion():
+    # Solo se mide dentro de una petición (no en create_all, scripts, etc.)
+    return g.get('_metricas') if has_app_context() else None
+
+
+def _antes_consulta(conn, cursor, statement, parameters, context, executemany):
+    if _medicion() is not None:
+        conn.info.setdefault('_inicio_consulta', []).append(time.perf_counter())
+
+
+def _despues_consulta(conn, cursor, statement, parameters, context, executemany):
+    medicion = _medicion()
+    if medicion is None or not conn.info.get('_inicio_consulta'):
+        return
+    medicion['sql'] += time.perf_counter() - conn.info['_inicio_consulta'].pop()
+    medicion['consultas'] += 1
+    medicion['sentencias'][statement] += 1
+
+
+def _antes_plantilla(app, template, context, **extra):
+    medicion = _medicion()
+    if medicion is not None:
+        medicion['plantillas'].append(time.perf_counter())
+
+
+def _plantilla_lista(app, template, context, **extra):
+    medicion = _medicion()
+    if medicion is not None and medicion['plantillas']:
+        medicion['render'] += time.perf_counter() - medicion['plantillas'].pop()
+
+
+def init_app(app):
+    registro = RegistroMetricas(app.config.get('METRICAS_UMBRAL_N1', 5))
+    app.extensions['metricas'] = registro
+
+    with app.app_context():
+        sa.event.listen(db.engine, 'before_cursor_execute', _antes_consulta)
+        sa.event.listen(db.engine, 'after_cursor_execute', _despues_consulta)
+    before_render_template.connect(_antes_plantilla, app)
+    template_rendered.connect(_plantilla_lista, app)
+
+    @app.before_request
+    def iniciar_medicion():
+        g._metricas = {'inicio': time.perf_counter(), 'consultas': 0, 'sql': 0.0,
+                       'render': 0.0, 'plantillas': [], 'sentencias': Counter()}
+
+    @app.after_request
+    def cerrar_medicion(respuesta):
+        medicion = g.pop('_metricas', None)
+        if medicion is None:
+            return respuesta
+        total = (time.perf_counter() - medicion['inicio']) * 1000
+        sql = medicion['sql'] * 1000
+        render = medicion['render'] * 1000
+        # Misma sentencia muchas veces en una petición = carga perezosa por fila (N+1)
+        repetidas = {s: n for s, n in medicion['sentencias'].items() if n >= registro.umbral_n1}
+        if repetidas:
+            app.logger.warning('Posible N+1 en %s: %s', request.endpoint,
+                               '; '.join('%dx %s' % (n, s[:120]) for s, n in repetidas.items()))
+
+        registro.registrar(request.endpoint or request.path, {
+            'consultas': medicion['consultas'], 'sql_ms': sql,
+            'render_ms': render, 'tiempo_ms': total, 'repetidas': repetidas,
+        })
+        respuesta.headers.add('Server-Timing', 'sql;dur=%.1f;desc="%d consultas"' % (sql, medicion['consultas']))
+        respuesta.headers.add('Server-Timing', 'tpl;dur=%.1f' % render)
+        respuesta.headers.add('Server-Timing', 'app;dur=%.1f' % total)
+        return respuesta
+
+    @app.route('/debug/metrics')
+    def debug_metricas():
+        # Opt-in: expone rutas y tiempos internos
+        if not app.config.get('METRICAS_DEBUG'):
+            abort(404)
+        return jsonify(registro.resumen())
@@ -0,0 +1,70 @@
+import os
+import click
+import sqlalchemy as sa
+
+# Columnas agregadas después de la primera versión del esquema.
+# db.create_all() crea tablas nuevas pero no altera las existentes.
+COLUMNAS = [
+    ('pedido_item', 'precio_unitario', 'FLOAT'),
+    ('usuario', 'lat', 'FLOAT'),
+    ('usuario', 'lon', 'FLOAT'),
+    ('pedido', 'destino_lat', 'FLOAT'),
+    ('pedido', 'destino_lon', 'FLOAT'),
+    ('pedido', 'celda', 'VARCHAR(20)'),
+    ('producto', 'updated_at', 'DATETIME'),
+    ('pedido', 'updated_at', 'DATETIME'),
+    ('pedido_archivado', 'destino_lat', 'FLOAT'),
+    ('pedido_archivado', 'destino_lon', 'FLOAT'),
+    ('pedido_archivado', 'celda', 'VARCHAR(20)'),
+    ('pedido_archivado', 'updated_at', 'DATETIME'),
+]
+# Valor para las filas existentes al agregar la columna (si no, quedan en NULL)
+RELLENO = {
+    ('producto', 'updated_at'): 'CURRENT_TIMESTAMP',
+    ('pedido', 'updated_at'): 'COALESCE(fecha, CURRENT_TIMESTAMP)',
+}
+
+
+def aplicar(engine):
+    """Agrega a una base de datos existente las columnas e índices que le falten."""
+    from . import db
+
+    inspector = sa.inspect(engine)
+    tablas = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for tabla, columna, tipo in COLUMNAS:
+            if tabla not in tablas:
+                continue
+            if columna not in {c['name'] for c in inspector.get_columns(tabla)}:
+                conn.execute(sa.text('ALTER TABLE %s ADD COLUMN %s %s' % (tabla, columna, tipo)))
+                if (tabla, columna) in RELLENO:
+                    conn.execute(sa.text('UPDATE %s SET %s = %s' % (tabla, columna, RELLENO[tabla, columna])))
+
+        # Índices declarados en los modelos (create_all solo los crea con la tabla)
+        for tabla in db.metadata.sorted_tables:
+            for indice in tabla.indexes:
+                indice.create(bind=conn, checkfirst=True)
+
+
+def inicializar(app):
+    """Crea o actualiza el esquema completo: tablas, columnas, índices, FTS y triggers."""
+    from . import busqueda, cache, cambios, db, facetas
+
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    with app.app_context():
+        db.create_all()
+        aplicar(db.engine)
+        cache.crear_version(db.engine)
+        app.extensions['busqueda_fts'] = busqueda.crear_indice(db.engine)
+        # Conteos por categoría/tipo/tienda mantenidos por triggers
+        app.extensions['facetas_triggers'] = facetas.crear_triggers(db.engine)
+        # Bitácora de cambios para /api/productos/changes
+        app.extensions['cambios_triggers'] = cambios.crear_triggers(db.engine)
+
+
+def init_app(app):
+    @app.cli.command('init-db')
+    def init_db_cmd():
+        """Crea las tablas y aplica las migraciones pendientes (paso de despliegue)."""
+        inicializar(app)
+        click.echo('Esquema listo.')
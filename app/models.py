@@ -14,6 +14,10 @@ class Usuario(UserMixin, db.Model):
     
     direccion_tienda = db.Column(db.String(200), nullable=True)
     calificacion = db.Column(db.Float, default=5.0)
+
+    # Ubicación (tienda: su dirección; repartidor: última posición reportada)
+    lat = db.Column(db.Float, nullable=True)
+    lon = db.Column(db.Float, nullable=True)
     
     productos = db.relationship('Producto', backref='propietario', lazy=True)
     
@@ -22,6 +26,13 @@ class Usuario(UserMixin, db.Model):
     entregas = db.relationship('Pedido', foreign_keys='Pedido.repartidor_id', backref='repartidor', lazy=True)
 
 class Producto(db.Model):
+    # Rutas calientes: catálogo (stock/categoría), panel de la tienda
+    __table_args__ = (
+        db.Index('ix_producto_stock_categoria', 'stock_actual', 'categoria'),
+        db.Index('ix_producto_categoria_stock', 'categoria', 'stock_actual'),
+        db.Index('ix_producto_tienda_tipo_stock', 'tienda_id', 'tipo', 'stock_actual'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     nombre = db.Column(db.String(100), nullable=False)
     precio = db.Column(db.Float, nullable=False)
@@ -36,8 +47,19 @@ class Producto(db.Model):
     stock_minimo = db.Column(db.Integer, default=5)
     
     tienda_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    # Versión de la fila: llave de los fragmentos de plantilla en cache (ver fragmentos.py)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class Pedido(db.Model):
+    # Tablero de repartidores, entregas en curso e historial del cliente
+    __table_args__ = (
+        db.Index('ix_pedido_estado_entrega', 'estado', 'tipo_entrega'),
+        db.Index('ix_pedido_repartidor_estado', 'repartidor_id', 'estado'),
+        db.Index('ix_pedido_cliente_fecha', 'cliente_id', 'fecha'),
+        # Pedidos pendientes más cercanos por celda de la rejilla (ver geo.py)
+        db.Index('ix_pedido_estado_entrega_celda', 'estado', 'tipo_entrega', 'celda'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
     estado = db.Column(db.String(20), default='pendiente')
@@ -47,11 +69,117 @@ class Pedido(db.Model):
     
     cliente_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
     repartidor_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+
+    # Destino de la entrega y su celda en la rejilla de despacho
+    destino_lat = db.Column(db.Float, nullable=True)
+    destino_lon = db.Column(db.Float, nullable=True)
+    celda = db.Column(db.String(20), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     items = db.relationship('PedidoItem', backref='pedido', lazy=True)
 
 class PedidoItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido.id'), nullable=False)
+    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido.id'), nullable=False, index=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False, index=True)
+    cantidad = db.Column(db.Integer, default=1)
+    # Precio al momento de la compra (el del producto puede cambiar después)
+    precio_unitario = db.Column(db.Float, nullable=True)
+    producto = db.relationship('Producto')
+
+class CarritoItem(db.Model):
+    # Carrito del lado del servidor: una fila por usuario y producto
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), primary_key=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), primary_key=True)
+    cantidad = db.Column(db.Integer, nullable=False, default=1)
+
+class ResumenVentas(db.Model):
+    # Totales precalculados por tienda, día y producto; se actualizan en cada pedido
+    __table_args__ = (db.UniqueConstraint('tienda_id', 'dia', 'producto_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    tienda_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    dia = db.Column(db.Date, nullable=False)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False)
+    unidades = db.Column(db.Integer, nullable=False, default=0)
+    ingreso = db.Column(db.Float, nullable=False, default=0)
+    producto = db.relationship('Producto')
+
+class ConteoFaceta(db.Model):
+    # Productos con stock por categoría/tipo/tienda; lo mantienen triggers (ver facetas.py)
+    faceta = db.Column(db.String(20), primary_key=True)
+    valor = db.Column(db.String(100), primary_key=True)
+    conteo = db.Column(db.Integer, nullable=False, default=0)
+
+class PedidoArchivado(db.Model):
+    # Almacén frío: pedidos entregados antiguos (ver archivo.py); mismas columnas que Pedido
+    __table_args__ = (db.Index('ix_pedido_archivado_cliente_fecha', 'cliente_id', 'fecha'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.DateTime, nullable=False)
+    estado = db.Column(db.String(20), nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    tipo_entrega = db.Column(db.String(20))
+    metodo_pago = db.Column(db.String(20))
+    cliente_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    repartidor_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+    destino_lat = db.Column(db.Float, nullable=True)
+    destino_lon = db.Column(db.Float, nullable=True)
+    celda = db.Column(db.String(20), nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    archivado = db.Column(db.DateTime, default=datetime.utcnow)
+    items = db.relationship('PedidoItemArchivado', backref='pedido', lazy=True)
+
+class PedidoItemArchivado(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    pedido_id = db.Column(db.Integer, db.ForeignKey('pedido_archivado.id'), nullable=False, index=True)
     producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False)
     cantidad = db.Column(db.Integer, default=1)
-    producto = db.relationship('Producto')
\ No newline at end of file
+    precio_unitario = db.Column(db.Float, nullable=True)
+    producto = db.relationship('Producto')
+
+class Trabajo(db.Model):
+    # Cola durable (outbox): se inserta en la misma transacción que el cambio
+    # que la origina y la procesan los hilos de trabajos.py
+    __table_args__ = (db.Index('ix_trabajo_estado_disponible', 'estado', 'disponible_en'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False)
+    datos = db.Column(db.Text, nullable=False, default='{}')
+    # Llave de idempotencia: encolar dos veces la misma llave no duplica el trabajo
+    clave = db.Column(db.String(120), unique=True, nullable=True)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    max_intentos = db.Column(db.Integer, nullable=False, default=5)
+    disponible_en = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    tomado_en = db.Column(db.DateTime, nullable=True)
+    tomado_por = db.Column(db.String(32), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    terminado = db.Column(db.DateTime, nullable=True)
+
+class VersionCatalogo(db.Model):
+    # Una sola fila: versión del catálogo compartida por todos los workers (ver cache.py)
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    modificado = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class Evento(db.Model):
+    # Canal del tablero de repartidores compartido por todos los workers (ver eventos.py)
+    # AUTOINCREMENT: el id es el Last-Event-ID de los clientes y nunca se reusa
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), nullable=False)
+    datos = db.Column(db.Text, nullable=False, default='{}')
+    fecha = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
+
+class CambioProducto(db.Model):
+    # Bitácora solo de inserción para sincronizar clientes (ver cambios.py); la llenan triggers
+    # AUTOINCREMENT: el id es el cursor de los clientes y nunca se reusa
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    producto_id = db.Column(db.Integer, nullable=False, index=True)
+    # 'upsert' (alta o cambio visible) o 'baja' (sin stock o eliminado)
+    op = db.Column(db.String(10), nullable=False)
+    fecha = db.Column(db.DateTime, nullable=False, server_default=db.func.current_timestamp())
@@ -0,0 +1,181 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+import sqlalchemy as sa
+from flask import current_app
+from sqlalchemy.orm import aliased
+from .models import PedidoItem, PedidoItemArchivado, Producto, db
+
+# "Se compra junto con": co-ocurrencias de productos en un mismo pedido.
+# La matriz producto × producto vive en memoria y es dispersa y acotada:
+# cada producto guarda como máximo CAPACIDAD vecinos con su conteo
+# (algoritmo Space-Saving: al llenarse, un vecino nuevo reemplaza al menos
+# frecuente y hereda su conteo) y, ya calculados, sus K mejores.
+# Leer recomendaciones es un dict.get; nunca se consulta el historial por petición.
+#
+# Cada proceso arma su copia (desde todo el historial, incluido el archivo) y
+# la mantiene con los pedidos que confirma; la reconstrucción periódica en
+# segundo plano incorpora los de otros workers.
+
+K = 6
+CAPACIDAD = 50
+# Ids por consulta al buscar los nombres de los productos recomendados
+LOTE_NOMBRES = 500
+
+
+class Coocurrencias:
+    def __init__(self, k=K, capacidad=CAPACIDAD):
+        self.k = k
+        self.capacidad = max(capacidad, k)
+        self._conteos = {}
+        self._top = {}
+        self.nombres = {}
+        self.construido = None
+        self._lock = threading.Lock()
+
+    def _sumar(self, fila, vecino, n):
+        if vecino in fila or len(fila) < self.capacidad:
+            fila[vecino] = fila.get(vecino, 0) + n
+            return
+        minimo = min(fila, key=fila.get)
+        fila[vecino] = fila.pop(minimo) + n
+
+    def _recalcular(self, producto_id):
+        fila = self._conteos[producto_id]
+        self._top[producto_id] = tuple(heapq.nlargest(self.k, fila, key=fila.get))
+
+    def registrar(self, productos):
+        """Suma un pedido nuevo: 'productos' son (id, nombre) distintos del pedido."""
+        productos = dict(productos)
+        if len(productos) < 2:
+            return
+        with self._lock:
+            self.nombres.update(productos)
+            for a in productos:
+                fila = self._conteos.setdefault(a, {})
+                for b in productos:
+                    if b != a:
+                        self._sumar(fila, b, 1)
+                self._recalcular(a)
+
+    def cargar(self, pares, nombrar):
+        """Reemplaza todo con 'pares' (a, b, conteo) ordenados por 'a'.
+
+        'nombrar(ids)' devuelve {id: nombre} solo de los productos que quedaron
+        en algún top (los únicos que se muestran), no de todo el catálogo.
+        """
+        conteos = {}
+        for a, filas in itertools.groupby(pares, key=lambda par: par[0]):
+            # Conteos exactos: se quedan los CAPACIDAD vecinos más frecuentes
+            conteos[a] = {b: n for _, b, n in heapq.nlargest(self.capacidad, filas, key=lambda par: par[2])}
+        top = {a: tuple(heapq.nlargest(self.k, f, key=f.get)) for a, f in conteos.items()}
+        nombres = nombrar(set().union(*top.values()))
+        with self._lock:
+            self._conteos, self._top, self.nombres = conteos, top, nombres
+            self.construido = time.monotonic()
+
+    def vecinos(self, producto_id):
+        return self._top.get(producto_id, ())
+
+    def para_carrito(self, producto_ids, n=K):
+        """Los n productos que más se compran con el carrito (sin los que ya están en él)."""
+        en_carrito = set(producto_ids)
+        puntaje = {}
+        for producto_id in en_carrito:
+            fila = self._conteos.get(producto_id, {})
+            for vecino in self.vecinos(producto_id):
+                if vecino not in en_carrito:
+                    puntaje[vecino] = puntaje.get(vecino, 0) + fila.get(vecino, 0)
+        return heapq.nlargest(n, puntaje, key=puntaje.get)
+
+    def estadisticas(self):
+        return {'productos': len(self._conteos),
+                'pares': sum(len(f) for f in self._conteos.values()),
+                'k': self.k, 'capacidad': self.capacidad}
+
+
+def _pares():
+    # Pares (a, b) de productos distintos en un mismo pedido, calientes y archivados
+    consultas = []
+    for item in (PedidoItem, PedidoItemArchivado):
+        a, b = aliased(item), aliased(item)
+        consultas.append(sa.select(a.producto_id.label('a'), b.producto_id.label('b'))
+                         .join(b, sa.and_(b.pedido_id == a.pedido_id, b.producto_id != a.producto_id)))
+    pares = sa.union_all(*consultas).subquery()
+    return (sa.select(pares.c.a, pares.c.b, sa.func.count())
+            .group_by(pares.c.a, pares.c.b)
+            .order_by(pares.c.a))
+
+
+def indice():
+    return current_app.extensions['recomendaciones']
+
+
+def reconstruir():
+    """Recalcula la matriz completa desde el historial de pedidos."""
+    recomendador = indice()
+    pares = db.session.execute(_pares().execution_options(yield_per=5000))
+    recomendador.cargar(((a, b, n) for a, b, n in pares), _nombres)
+    return recomendador.estadisticas()
+
+
+def _nombres(ids):
+    ids, nombres = list(ids), {}
+    for i in range(0, len(ids), LOTE_NOMBRES):
+        nombres.update(db.session.execute(
+            sa.select(Producto.id, Producto.nombre).where(Producto.id.in_(ids[i:i + LOTE_NOMBRES]))).all())
+    return nombres
+
+
+def _reconstruir_en_segundo_plano(app):
+    try:
+        with app.app_context():
+            reconstruir()
+    except Exception:
+        app.logger.exception('No se pudieron reconstruir las recomendaciones')
+    finally:
+        app.extensions['recomendaciones_pendiente'].clear()
+
+
+def _vigente():
+    """Índice listo para leer; si está viejo pide reconstruirlo sin esperar."""
+    app = current_app._get_current_object()
+    recomendador = indice()
+    cada = app.config.get('RECOMENDACIONES_RECONSTRUIR_CADA', 3600)
+    viejo = recomendador.construido is None or (cada and time.monotonic() - recomendador.construido > cada)
+    pendiente = app.extensions['recomendaciones_pendiente']
+    if viejo and not pendiente.is_set():
+        pendiente.set()
+        app.extensions['recomendaciones_pool'].submit(_reconstruir_en_segundo_plano, app)
+    return recomendador
+
+
+def registrar_pedido(vendidos):
+    """Suma a la matriz un pedido recién confirmado: [(id, nombre), ...]."""
+    indice().registrar(vendidos)
+
+
+def junto_con(producto_id):
+    """[(id, nombre), ...] de los productos que más se compran con este."""
+    recomendador = _vigente()
+    return [(v, recomendador.nombres.get(v, '')) for v in recomendador.vecinos(producto_id)]
+
+
+def para_carrito(producto_ids, n=4):
+    return _vigente().para_carrito(producto_ids, n)
+
+
+def init_app(app):
+    app.extensions['recomendaciones'] = Coocurrencias(
+        k=app.config.get('RECOMENDACIONES_K', K),
+        capacidad=app.config.get('RECOMENDACIONES_CAPACIDAD', CAPACIDAD))
+    app.extensions['recomendaciones_pool'] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recomendaciones')
+    app.extensions['recomendaciones_pendiente'] = threading.Event()
+
+    @app.cli.command('reconstruir-recomendaciones')
+    def reconstruir_recomendaciones_cmd():
+        """Calcula las co-ocurrencias desde el historial (diagnóstico)."""
+        click.echo('Recomendaciones: %(productos)d productos, %(pares)d pares.' % reconstruir())
@@ -0,0 +1,48 @@
+import time
+import sqlalchemy as sa
+from flask import current_app, jsonify
+from . import db
+
+# Sondas para el balanceador / orquestador.
+# - /salud/vivo: el proceso responde (no toca la BD; si falla, reiniciar el worker).
+# - /salud/listo: la BD responde y el esquema existe (si falla, no mandarle tráfico).
+# El tiempo de arranque de create_app se mide contra ARRANQUE_PRESUPUESTO_MS para
+# notar pronto cualquier trabajo pesado que se cuele en el arranque de los workers.
+
+
+def registrar_arranque(app, inicio):
+    ms = (time.perf_counter() - inicio) * 1000
+    presupuesto = app.config.get('ARRANQUE_PRESUPUESTO_MS', 1000)
+    app.extensions['arranque'] = {'ms': round(ms, 1), 'presupuesto_ms': presupuesto}
+    if ms > presupuesto:
+        app.logger.warning('create_app tardó %.0f ms (presupuesto %d ms)', ms, presupuesto)
+
+
+def _esquema_listo():
+    # Una vez verificado no cambia mientras viva el proceso
+    if current_app.extensions.get('esquema_verificado'):
+        return True
+    existentes = set(sa.inspect(db.engine).get_table_names())
+    faltantes = [t for t in db.metadata.tables if t not in existentes]
+    if faltantes:
+        return False
+    current_app.extensions['esquema_verificado'] = True
+    return True
+
+
+def init_app(app):
+    @app.route('/salud/vivo')
+    def salud_vivo():
+        return jsonify({'status': 'ok', 'arranque': app.extensions.get('arranque')})
+
+    @app.route('/salud/listo')
+    def salud_listo():
+        try:
+            db.session.execute(sa.text('SELECT 1'))
+            listo = _esquema_listo()
+        except sa.exc.SQLAlchemyError as e:
+            app.logger.warning('Sonda de disponibilidad: %s', e)
+            listo = False
+        if not listo:
+            return jsonify({'status': 'no-listo'}), 503
+        return jsonify({'status': 'ok'})
@@ -0,0 +1,240 @@
+import atexit
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import click
+import sqlalchemy as sa
+from flask import current_app, g, has_app_context, has_request_context
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .models import Trabajo, db
+
+# Cola de trabajos durable (patrón outbox).
+# encolar() inserta la fila en la sesión actual: se confirma o se descarta
+# junto con el cambio que la origina (p. ej. el Pedido). Hilos de cada
+# proceso reclaman trabajos con un UPDATE condicional (compare-and-set),
+# ejecutan la tarea y marcan 'hecho' en la misma transacción que los
+# cambios de la tarea: los efectos en la BD se aplican una sola vez.
+# Si una tarea falla se reintenta con espera exponencial; si el proceso muere
+# a mitad, el trabajo vuelve a estar disponible tras VISIBILIDAD segundos.
+
+TAREAS = {}
+
+ESPERA_BASE = 2
+ESPERA_MAX = 300
+VISIBILIDAD = 300
+
+
+def tarea(tipo):
+    """Registra la función que procesa los trabajos de 'tipo' (recibe los datos como kwargs)."""
+    def registrar(funcion):
+        TAREAS[tipo] = funcion
+        return funcion
+    return registrar
+
+
+def encolar(tipo, clave=None, max_intentos=5, retraso=0, **datos):
+    """Agrega un trabajo a la transacción actual (no hace commit).
+
+    Con 'clave', encolar de nuevo la misma clave no crea otro trabajo.
+    """
+    valores = {'tipo': tipo, 'datos': json.dumps(datos), 'clave': clave, 'estado': 'pendiente',
+               'intentos': 0, 'max_intentos': max_intentos, 'creado': datetime.utcnow(),
+               'disponible_en': datetime.utcnow() + timedelta(seconds=retraso)}
+    dialecto = db.session.get_bind().dialect.name
+    if clave is not None and dialecto in ('sqlite', 'postgresql'):
+        insert = (sqlite if dialecto == 'sqlite' else postgresql).insert(Trabajo)
+        db.session.execute(insert.values(valores).on_conflict_do_nothing(index_elements=['clave']))
+    elif clave is None or not Trabajo.query.filter_by(clave=clave).first():
+        db.session.execute(sa.insert(Trabajo).values(valores))
+    # Al confirmar la transacción se despierta a los trabajadores
+    db.session.info['trabajos_nuevos'] = True
+
+
+def _espera(intentos):
+    return min(ESPERA_BASE * 2 ** (intentos - 1), ESPERA_MAX) * random.uniform(0.5, 1.5)
+
+
+def _reclamar(token):
+    """Toma el siguiente trabajo disponible; devuelve su id o None."""
+    ahora = datetime.utcnow()
+    disponible = sa.or_(
+        sa.and_(Trabajo.estado == 'pendiente', Trabajo.disponible_en <= ahora),
+        # Tomado por un proceso que murió (o se colgó) antes de terminarlo
+        sa.and_(Trabajo.estado == 'en_curso', Trabajo.tomado_en < ahora - timedelta(seconds=VISIBILIDAD)))
+    for _ in range(3):
+        candidato = db.session.scalar(
+            sa.select(Trabajo.id).where(disponible).order_by(Trabajo.disponible_en, Trabajo.id).limit(1))
+        if candidato is None:
+            db.session.commit()
+            return None
+        # Varios hilos/procesos pueden ver el mismo candidato: solo uno cambia la fila
+        tomado = db.session.execute(
+            sa.update(Trabajo).where(Trabajo.id == candidato, disponible)
+            .values(estado='en_curso', tomado_en=ahora, tomado_por=token, intentos=Trabajo.intentos + 1)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        if tomado.rowcount == 1:
+            return candidato
+    return None
+
+
+def _terminar(id, token, **valores):
+    # Solo si el trabajo sigue siendo nuestro (no lo reclamó otro por vencido)
+    resultado = db.session.execute(
+        sa.update(Trabajo).where(Trabajo.id == id, Trabajo.tomado_por == token)
+        .values(**valores).execution_options(synchronize_session=False))
+    return resultado.rowcount == 1
+
+
+def procesar_uno():
+    """Reclama y ejecuta un trabajo. Devuelve False si no había ninguno disponible."""
+    token = uuid.uuid4().hex
+    id = _reclamar(token)
+    if id is None:
+        return False
+    trabajo = db.session.get(Trabajo, id)
+    tipo, datos, intentos, max_intentos = trabajo.tipo, json.loads(trabajo.datos), trabajo.intentos, trabajo.max_intentos
+    try:
+        if tipo not in TAREAS:
+            raise LookupError('Tarea desconocida: %s' % tipo)
+        TAREAS[tipo](**datos)
+        if _terminar(id, token, estado='hecho', terminado=datetime.utcnow(), error=None):
+            db.session.commit()
+        else:
+            db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception('Trabajo %d (%s) falló en el intento %d', id, tipo, intentos)
+        if intentos >= max_intentos:
+            _terminar(id, token, estado='fallido', error=repr(e)[:1000], terminado=datetime.utcnow())
+        else:
+            _terminar(id, token, estado='pendiente', error=repr(e)[:1000],
+                      disponible_en=datetime.utcnow() + timedelta(seconds=_espera(intentos)))
+        db.session.commit()
+    return True
+
+
+def procesar_pendientes(limite=None):
+    """Procesa trabajos disponibles hasta vaciar la cola (o 'limite'); devuelve cuántos."""
+    n = 0
+    while (limite is None or n < limite) and procesar_uno():
+        n += 1
+    return n
+
+
+def estadisticas():
+    return dict(db.session.execute(
+        sa.select(Trabajo.estado, sa.func.count()).group_by(Trabajo.estado)).all())
+
+
+class Trabajadores:
+    """Hilos que procesan la cola dentro del proceso web.
+
+    Esperan un aviso (commit con trabajos nuevos en este proceso) o, como
+    máximo, 'sondeo' segundos para ver los encolados por otros procesos y
+    los reintentos que vencieron.
+    """
+
+    def __init__(self, app, hilos=2, sondeo=1.0):
+        self.app = app
+        self.hilos = hilos
+        self.sondeo = sondeo
+        self._aviso = threading.Event()
+        self._parar = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._hilos_vivos = []
+
+    def iniciar(self):
+        # Una vez por proceso: con preload_app los hilos del maestro no
+        # sobreviven al fork y cada worker arranca los suyos
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._parar.clear()
+            self._hilos_vivos = [threading.Thread(target=self._ciclo, name='trabajos-%d' % n, daemon=True)
+                                 for n in range(self.hilos)]
+            for hilo in self._hilos_vivos:
+                hilo.start()
+
+    def detener(self, espera=5):
+        """Pide a los hilos que terminen tras el trabajo en curso y los espera."""
+        with self._lock:
+            hilos, self._hilos_vivos = self._hilos_vivos, []
+            self._pid = None
+            self._parar.set()
+            self._aviso.set()
+        for hilo in hilos:
+            hilo.join(espera)
+
+    def despertar(self):
+        self._aviso.set()
+
+    def _ciclo(self):
+        while not self._parar.is_set():
+            try:
+                with self.app.app_context():
+                    hubo = procesar_uno()
+            except Exception:
+                self.app.logger.exception('Error en el ciclo de trabajos')
+                hubo = False
+            if not hubo:
+                self._aviso.wait(self.sondeo)
+                self._aviso.clear()
+
+
+def _al_confirmar(session):
+    if not session.info.pop('trabajos_nuevos', False) or not has_app_context():
+        return
+    trabajadores = current_app.extensions.get('trabajos')
+    if trabajadores is None:
+        return
+    if trabajadores.hilos:
+        trabajadores.despertar()
+    elif has_request_context():
+        g.trabajos_pendientes = True
+
+
+sa.event.listen(Session, 'after_commit', _al_confirmar)
+
+
+def init_app(app):
+    # Una BD en memoria es una sola conexión compartida por todos los hilos:
+    # ahí los trabajos corren al final de la petición que los encoló
+    en_memoria = app.config['SQLALCHEMY_DATABASE_URI'] in ('sqlite://', 'sqlite:///:memory:')
+    hilos = 0 if en_memoria else app.config.get('TRABAJOS_HILOS', 2)
+    trabajadores = Trabajadores(app, hilos, app.config.get('TRABAJOS_SONDEO', 1.0))
+    app.extensions['trabajos'] = trabajadores
+    # Al salir del proceso (o de gunicorn) no se deja un trabajo a medias
+    atexit.register(trabajadores.detener)
+
+    @app.before_request
+    def iniciar_trabajadores():
+        if trabajadores.hilos:
+            trabajadores.iniciar()
+
+    @app.after_request
+    def procesar_en_linea(respuesta):
+        if g.pop('trabajos_pendientes', False):
+            procesar_pendientes()
+        return respuesta
+
+    @app.cli.command('trabajos')
+    @click.option('--una-vez', is_flag=True, help='Procesa lo disponible y termina.')
+    def trabajos_cmd(una_vez):
+        """Procesa la cola de trabajos (worker dedicado, sin servidor web)."""
+        if una_vez:
+            click.echo('%d trabajos procesados.' % procesar_pendientes())
+            click.echo(estadisticas())
+            return
+        while True:
+            if not procesar_uno():
+                time.sleep(trabajadores.sondeo)
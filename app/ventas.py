@@ -0,0 +1,126 @@
+from collections import defaultdict
+import click
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from .models import Producto, Pedido, PedidoArchivado, PedidoItem, PedidoItemArchivado, ResumenVentas, Trabajo, db
+
+
+def registrar(items, productos, dia):
+    """Suma las líneas de un pedido nuevo a ResumenVentas (misma transacción).
+
+    'items' son PedidoItem con precio_unitario; 'productos' mapea id -> Producto.
+    """
+    filas = defaultdict(lambda: [0, 0.0])
+    for item in items:
+        clave = (productos[item.producto_id].tienda_id, item.producto_id)
+        filas[clave][0] += item.cantidad
+        filas[clave][1] += item.precio_unitario * item.cantidad
+
+    valores = [{'tienda_id': tienda_id, 'dia': dia, 'producto_id': producto_id,
+                'unidades': unidades, 'ingreso': ingreso}
+               for (tienda_id, producto_id), (unidades, ingreso) in filas.items()]
+    if not valores:
+        return
+
+    dialecto = db.session.get_bind().dialect.name
+    if dialecto in ('sqlite', 'postgresql'):
+        insert = (sqlite if dialecto == 'sqlite' else postgresql).insert(ResumenVentas)
+        db.session.execute(insert.values(valores).on_conflict_do_update(
+            index_elements=['tienda_id', 'dia', 'producto_id'],
+            set_={'unidades': ResumenVentas.unidades + insert.excluded.unidades,
+                  'ingreso': ResumenVentas.ingreso + insert.excluded.ingreso}))
+        return
+
+    # Otros motores: leer y actualizar dentro de la misma transacción
+    for v in valores:
+        fila = ResumenVentas.query.filter_by(tienda_id=v['tienda_id'], dia=dia,
+                                             producto_id=v['producto_id']).with_for_update().first()
+        if fila is None:
+            db.session.add(ResumenVentas(**v))
+        else:
+            fila.unidades += v['unidades']
+            fila.ingreso += v['ingreso']
+
+
+def _lineas(pedido, item):
+    return (sa.select(Producto.tienda_id.label('tienda_id'), sa.func.date(pedido.fecha).label('dia'),
+                      item.producto_id.label('producto_id'), item.cantidad.label('cantidad'),
+                      item.precio_unitario.label('precio_unitario'))
+            .join(pedido, pedido.id == item.pedido_id)
+            .join(Producto, Producto.id == item.producto_id))
+
+
+def reconstruir():
+    """Recalcula ResumenVentas desde cero a partir de PedidoItem (y de los archivados).
+
+    Las ventas anteriores al precio congelado toman el precio actual del
+    producto (es el único dato que existe para ellas).
+    """
+    for item in (PedidoItem, PedidoItemArchivado):
+        db.session.execute(
+            sa.update(item)
+            .where(item.precio_unitario.is_(None))
+            .values(precio_unitario=sa.select(Producto.precio)
+                    .where(Producto.id == item.producto_id)
+                    .scalar_subquery())
+            .execution_options(synchronize_session=False))
+
+    lineas = sa.union_all(_lineas(Pedido, PedidoItem),
+                          _lineas(PedidoArchivado, PedidoItemArchivado)).subquery()
+    agregado = (sa.select(lineas.c.tienda_id, lineas.c.dia, lineas.c.producto_id,
+                          sa.func.sum(lineas.c.cantidad),
+                          sa.func.sum(lineas.c.cantidad * lineas.c.precio_unitario))
+                .group_by(lineas.c.tienda_id, lineas.c.dia, lineas.c.producto_id))
+    # Los pedidos con su registro aún en cola ya quedan incluidos aquí: esos
+    # trabajos se dan por hechos (y uno en curso ya no podrá confirmarse)
+    db.session.execute(
+        sa.update(Trabajo)
+        .where(Trabajo.tipo == 'ventas.registrar', Trabajo.estado.in_(('pendiente', 'en_curso')))
+        .values(estado='hecho', tomado_por=None)
+        .execution_options(synchronize_session=False))
+    db.session.execute(sa.delete(ResumenVentas))
+    db.session.execute(sa.insert(ResumenVentas).from_select(
+        ['tienda_id', 'dia', 'producto_id', 'unidades', 'ingreso'], agregado))
+    db.session.commit()
+    return ResumenVentas.query.count()
+
+
+def _filtro(tienda_id, desde, hasta):
+    condiciones = [ResumenVentas.tienda_id == tienda_id]
+    if desde:
+        condiciones.append(ResumenVentas.dia >= desde)
+    if hasta:
+        condiciones.append(ResumenVentas.dia <= hasta)
+    return condiciones
+
+
+def totales(tienda_id, desde=None, hasta=None):
+    """Ingreso total, serie diaria y ranking de productos de una tienda."""
+    condiciones = _filtro(tienda_id, desde, hasta)
+    ingreso, unidades = db.session.execute(
+        sa.select(sa.func.coalesce(sa.func.sum(ResumenVentas.ingreso), 0),
+                  sa.func.coalesce(sa.func.sum(ResumenVentas.unidades), 0))
+        .where(*condiciones)).one()
+    por_dia = db.session.execute(
+        sa.select(ResumenVentas.dia, sa.func.sum(ResumenVentas.ingreso))
+        .where(*condiciones)
+        .group_by(ResumenVentas.dia)
+        .order_by(ResumenVentas.dia)).all()
+    por_producto = db.session.execute(
+        sa.select(Producto.nombre, sa.func.sum(ResumenVentas.unidades), sa.func.sum(ResumenVentas.ingreso))
+        .join(Producto, Producto.id == ResumenVentas.producto_id)
+        .where(*condiciones)
+        .group_by(Producto.id, Producto.nombre)
+        .order_by(sa.func.sum(ResumenVentas.ingreso).desc())
+        .limit(10)).all()
+    return {'ingreso': ingreso, 'unidades': unidades,
+            'dias': [d.isoformat() if hasattr(d, 'isoformat') else d for d, _ in por_dia],
+            'ingresos_dia': [round(i, 2) for _, i in por_dia],
+            'productos': por_producto}
+
+
+def init_app(app):
+    @app.cli.command('resumen-ventas')
+    def resumen_ventas_cmd():
+        """Reconstruye el resumen de ventas a partir del historial de pedidos."""
+        click.echo('%d filas de resumen generadas.' % reconstruir())
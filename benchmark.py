@@ -0,0 +1,385 @@
+"""Banco de pruebas de carga y latencia de VeciMarket.
+
+Siembra datos sintéticos con volúmenes realistas y recorre las rutas de
+auth, market, inventario y delivery con varios workers concurrentes.
+Reporta peticiones/s, latencia p50/p95/p99 y consultas SQL por ruta
+(contadas en el proceso o leídas de Server-Timing con --url), guarda líneas base en JSON y termina con
+código 1 si alguna ruta empeora más del umbral.
+
+Ejemplos:
+    python benchmark.py --escala 0.01 --guardar base.json
+    python benchmark.py --escala 0.01 --comparar base.json --umbral 0.25
+    python benchmark.py --url http://127.0.0.1:8000 --comparar base.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.cookiejar import CookieJar
+
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+
+from app import create_app, db, ventas
+from app.models import Pedido, PedidoItem, Producto, Usuario
+
+# Volúmenes con escala 1.0
+VOLUMEN = {'tiendas': 2000, 'clientes': 20000, 'repartidores': 300,
+           'productos': 100000, 'pedidos': 1000000}
+CATEGORIAS = ['Alimentos', 'Salud', 'Tecnologia', 'Hogar', 'Servicios', 'Papelería', 'Mascotas', 'Belleza']
+PALABRAS = ['pan', 'leche', 'tortilla', 'jabón', 'cable', 'cuaderno', 'aspirina', 'corte', 'plomero', 'café']
+PASSWORD = 'bench'
+# Hash barato: el banco mide la app, no el costo del hash
+METODO_HASH = 'pbkdf2:sha256:1000'
+LOTE = 20000
+
+_CONSULTAS = re.compile(r'desc="(\d+) consultas"')
+
+
+def crear_app_bench(db_path):
+    return create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(db_path),
+        'AUTH_HASH_METODO': METODO_HASH,
+        # Todos los workers salen de la misma IP
+        'AUTH_LIMITE_IP': 10 ** 9,
+        'AUTH_LIMITE_EMAIL': 10 ** 9,
+        'ESTATICOS_PRECOMPRIMIR': False,
+    })
+
+
+# --- Siembra ---
+
+def _insertar(modelo, filas):
+    for i in range(0, len(filas), LOTE):
+        db.session.execute(sa.insert(modelo), filas[i:i + LOTE])
+
+
+def sembrar(escala=1.0, semilla=1, log=print):
+    """Llena la BD de la app actual. Devuelve los conteos generados."""
+    rnd = random.Random(semilla)
+    n = {k: max(int(v * escala), 1) for k, v in VOLUMEN.items()}
+    password = generate_password_hash(PASSWORD, method=METODO_HASH)
+
+    inicio = time.perf_counter()
+    usuarios, ids = [], defaultdict(list)
+    siguiente = (db.session.scalar(sa.select(sa.func.max(Usuario.id))) or 0) + 1
+    for rol, clave in (('tienda', 'tiendas'), ('cliente', 'clientes'), ('repartidor', 'repartidores')):
+        for i in range(n[clave]):
+            usuarios.append({'id': siguiente, 'email': 'bench-%s%d@vecimarket.test' % (rol, i),
+                             'password': password, 'nombre': '%s %d' % (rol.title(), i), 'rol': rol,
+                             'telefono': '55%08d' % siguiente,
+                             'calificacion': round(rnd.uniform(3.5, 5), 1)})
+            ids[rol].append(siguiente)
+            siguiente += 1
+    _insertar(Usuario, usuarios)
+    log('  %d usuarios' % len(usuarios))
+
+    productos, vendibles = [], []
+    siguiente = (db.session.scalar(sa.select(sa.func.max(Producto.id))) or 0) + 1
+    for i in range(n['productos']):
+        tipo = 'servicio' if rnd.random() < 0.1 else 'producto'
+        precio = round(rnd.uniform(5, 800), 2)
+        productos.append({'id': siguiente, 'nombre': '%s %d' % (rnd.choice(PALABRAS).title(), i),
+                          'precio': precio, 'descripcion': ' '.join(rnd.sample(PALABRAS, 3)),
+                          'categoria': 'Servicios' if tipo == 'servicio' else rnd.choice(CATEGORIAS),
+                          'tipo': tipo, 'stock_actual': 0 if rnd.random() < 0.1 else rnd.randint(1, 500),
+                          'stock_minimo': 5, 'tienda_id': rnd.choice(ids['tienda'])})
+        if tipo == 'producto':
+            vendibles.append((siguiente, precio))
+        siguiente += 1
+    _insertar(Producto, productos)
+    db.session.commit()
+    log('  %d productos' % len(productos))
+
+    ahora = datetime.utcnow()
+    pedido_id = (db.session.scalar(sa.select(sa.func.max(Pedido.id))) or 0) + 1
+    total_items = 0
+    for desde in range(0, n['pedidos'], LOTE):
+        pedidos, items = [], []
+        for _ in range(min(LOTE, n['pedidos'] - desde)):
+            total = 0.0
+            for producto_id, precio in rnd.sample(vendibles, min(rnd.randint(1, 4), len(vendibles))):
+                cantidad = rnd.randint(1, 3)
+                items.append({'pedido_id': pedido_id, 'producto_id': producto_id,
+                              'cantidad': cantidad, 'precio_unitario': precio})
+                total += precio * cantidad
+            azar = rnd.random()
+            estado, repartidor = 'entregado', rnd.choice(ids['repartidor'])
+            if azar < 0.0005:
+                estado, repartidor = 'pendiente', None
+            elif azar < 0.002:
+                estado = 'en_camino'
+            envio = rnd.random() < 0.7 or estado != 'entregado'
+            pedidos.append({'id': pedido_id, 'fecha': ahora - timedelta(minutes=rnd.randint(0, 525600)),
+                            'estado': estado, 'total': round(total, 2),
+                            'tipo_entrega': 'envio' if envio else 'recoger',
+                            'metodo_pago': rnd.choice(['efectivo', 'tarjeta']),
+                            'cliente_id': rnd.choice(ids['cliente']),
+                            'repartidor_id': repartidor if envio else None})
+            pedido_id += 1
+        _insertar(Pedido, pedidos)
+        _insertar(PedidoItem, items)
+        db.session.commit()
+        total_items += len(items)
+        log('  %d/%d pedidos' % (desde + len(pedidos), n['pedidos']))
+
+    # El resumen de ventas lo llena la cola de trabajos en cada checkout y estos
+    # pedidos entraron por INSERT directo. El índice FTS y las facetas ya los
+    # llenaron los triggers de 'producto' durante el INSERT.
+    ventas.reconstruir()
+    log('  siembra lista en %.1f s' % (time.perf_counter() - inicio))
+    return dict(n, items=total_items)
+
+
+def _muestra_emails(rol, cuantos=500):
+    return db.session.scalars(sa.select(Usuario.email).where(Usuario.rol == rol,
+                                                             Usuario.email.like('bench-%'))
+                              .limit(cuantos)).all()
+
+
+# --- Clientes ---
+
+_hilo = threading.local()
+
+
+def _contar_consulta(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_hilo, 'consultas', None) is not None:
+        _hilo.consultas += 1
+
+
+class ClienteApp:
+    """Peticiones dentro del proceso con el test client de Flask.
+
+    El test client corre la app en el hilo que pide, así que las consultas se
+    cuentan aquí mismo: también las de respuestas en streaming, que se
+    ejecutan al leer el cuerpo, después de que Server-Timing ya salió.
+    """
+
+    def __init__(self, app):
+        self._cliente = app.test_client()
+        with app.app_context():
+            if not sa.event.contains(db.engine, 'before_cursor_execute', _contar_consulta):
+                sa.event.listen(db.engine, 'before_cursor_execute', _contar_consulta)
+
+    def pedir(self, metodo, ruta, datos=None):
+        _hilo.consultas = 0
+        try:
+            r = self._cliente.open(ruta, method=metodo, data=datos)
+            # El cuerpo se consume dentro de la medición (tiempo y consultas)
+            r.get_data()
+            r.close()
+            return r.status_code, 'sql;desc="%d consultas"' % _hilo.consultas
+        finally:
+            _hilo.consultas = None
+
+
+class _SinRedirecciones(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ClienteHTTP:
+    """Peticiones a un servidor WSGI local (gunicorn, waitress, flask run...).
+
+    Las consultas salen del encabezado Server-Timing: en respuestas en
+    streaming (p. ej. /api/productos) solo cuenta las hechas antes del cuerpo.
+    """
+
+    def __init__(self, base):
+        self.base = base.rstrip('/')
+        self._opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()),
+                                                   _SinRedirecciones())
+
+    def pedir(self, metodo, ruta, datos=None):
+        cuerpo = urllib.parse.urlencode(datos).encode() if datos else None
+        peticion = urllib.request.Request(self.base + ruta, data=cuerpo, method=metodo)
+        try:
+            with self._opener.open(peticion, timeout=30) as r:
+                r.read()
+                return r.status, ', '.join(r.headers.get_all('Server-Timing') or [])
+        except urllib.error.HTTPError as e:
+            return e.code, ', '.join(e.headers.get_all('Server-Timing') or [])
+
+
+# --- Escenarios ---
+# (ruta, rol, peso, generador(rnd, datos) -> (metodo, url, form)); rol None = anónimo
+
+def _login(rol):
+    def generar(rnd, datos):
+        return 'POST', '/auth/login', {'email': rnd.choice(datos['emails'][rol]), 'password': PASSWORD}
+    return generar
+
+
+ESCENARIOS = [
+    ('auth.login', None, 2, _login('cliente')),
+    ('market.catalogo', None, 10, lambda rnd, d: ('GET', '/catalogo', None)),
+    ('market.catalogo?categoria', None, 6,
+     lambda rnd, d: ('GET', '/catalogo?categoria=%s&page=%d' % (rnd.choice(CATEGORIAS), rnd.randint(1, 5)), None)),
+    ('market.catalogo?q', None, 6, lambda rnd, d: ('GET', '/catalogo?q=%s' % rnd.choice(PALABRAS), None)),
+    ('market.api_productos', None, 6,
+     lambda rnd, d: ('GET', '/api/productos?cursor=%d&limit=100' % rnd.randint(0, d['max_producto']), None)),
+    ('market.agregar_carrito', 'cliente', 4,
+     lambda rnd, d: ('GET', '/agregar/%d' % rnd.randint(1, d['max_producto']), None)),
+    ('market.ver_carrito', 'cliente', 4, lambda rnd, d: ('GET', '/carrito', None)),
+    ('market.checkout', 'cliente', 1,
+     lambda rnd, d: ('POST', '/carrito', {'tipo_entrega': 'envio', 'metodo_pago': 'efectivo'})),
+    ('market.historial', 'cliente', 3, lambda rnd, d: ('GET', '/mis_pedidos', None)),
+    ('inventario.dashboard', 'tienda', 4, lambda rnd, d: ('GET', '/inventario/dashboard', None)),
+    ('inventario.historial_ventas', 'tienda', 3, lambda rnd, d: ('GET', '/inventario/ventas', None)),
+    ('delivery.dashboard', 'repartidor', 4, lambda rnd, d: ('GET', '/delivery/dashboard', None)),
+    ('delivery.eventos', 'repartidor', 2, lambda rnd, d: ('GET', '/delivery/eventos?espera=0', None)),
+]
+ROLES = [None, 'cliente', 'tienda', 'repartidor']
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    # Rango más cercano
+    return ordenados[max(math.ceil(p / 100.0 * len(ordenados)) - 1, 0)]
+
+
+def correr(nuevo_cliente, datos, workers=8, duracion=30.0, peticiones=None, semilla=1):
+    """Lanza 'workers' hilos, cada uno con su sesión y un rol, hasta agotar tiempo o peticiones.
+
+    Devuelve {ruta: {peticiones, rps, p50_ms, p95_ms, p99_ms, consultas, errores}}.
+    """
+    medidas = defaultdict(list)
+    consultas = defaultdict(list)
+    errores = defaultdict(int)
+    lock = threading.Lock()
+    restantes = [peticiones]
+    fin = time.monotonic() + duracion
+
+    def trabajar(numero):
+        rnd = random.Random(semilla * 1000 + numero)
+        rol = ROLES[numero % len(ROLES)]
+        escenarios = [e for e in ESCENARIOS if e[1] in (None, rol)]
+        pesos = [e[2] for e in escenarios]
+        cliente = nuevo_cliente()
+        if rol:
+            cliente.pedir(*_login(rol)(rnd, datos))
+        while time.monotonic() < fin:
+            with lock:
+                if restantes[0] is not None:
+                    if restantes[0] <= 0:
+                        return
+                    restantes[0] -= 1
+            ruta, rol_escenario, _, generar = rnd.choices(escenarios, pesos)[0]
+            metodo, url, form = generar(rnd, datos)
+            # El login se mide con una sesión limpia para no cambiar el rol del worker
+            destino = nuevo_cliente() if ruta == 'auth.login' else cliente
+            inicio = time.perf_counter()
+            estado, timing = destino.pedir(metodo, url, form)
+            ms = (time.perf_counter() - inicio) * 1000
+            encontrado = _CONSULTAS.search(timing)
+            with lock:
+                medidas[ruta].append(ms)
+                if encontrado:
+                    consultas[ruta].append(int(encontrado.group(1)))
+                if estado >= 400:
+                    errores[ruta] += 1
+
+    hilos = [threading.Thread(target=trabajar, args=(i,)) for i in range(workers)]
+    inicio = time.perf_counter()
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    transcurrido = time.perf_counter() - inicio
+
+    return {ruta: {'peticiones': len(ms), 'rps': round(len(ms) / transcurrido, 1),
+                   'p50_ms': round(percentil(ms, 50), 2), 'p95_ms': round(percentil(ms, 95), 2),
+                   'p99_ms': round(percentil(ms, 99), 2),
+                   'consultas': round(sum(consultas[ruta]) / len(consultas[ruta]), 2) if consultas[ruta] else None,
+                   'errores': errores[ruta]}
+            for ruta, ms in sorted(medidas.items())}
+
+
+def comparar(actual, base, umbral=0.2, margen_ms=2.0):
+    """Lista de regresiones: p95 peor que base * (1 + umbral) o más consultas SQL."""
+    regresiones = []
+    for ruta, previo in base.items():
+        ahora = actual.get(ruta)
+        if not ahora:
+            continue
+        limite = previo['p95_ms'] * (1 + umbral)
+        # El margen absoluto evita falsos positivos en rutas de 1-2 ms
+        if ahora['p95_ms'] > limite and ahora['p95_ms'] - previo['p95_ms'] > margen_ms:
+            regresiones.append('%s: p95 %.1f ms (base %.1f ms)' % (ruta, ahora['p95_ms'], previo['p95_ms']))
+        if previo.get('consultas') is not None and ahora.get('consultas') is not None \
+                and ahora['consultas'] > previo['consultas'] + 0.5:
+            regresiones.append('%s: %.1f consultas (base %.1f)' % (ruta, ahora['consultas'], previo['consultas']))
+    return regresiones
+
+
+def imprimir(rutas):
+    print('%-30s %8s %8s %9s %9s %9s %9s %6s' % ('ruta', 'n', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'consultas', 'errores'))
+    for ruta, r in rutas.items():
+        print('%-30s %8d %8.1f %9.1f %9.1f %9.1f %9s %6d' % (
+            ruta, r['peticiones'], r['rps'], r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            '-' if r['consultas'] is None else '%.1f' % r['consultas'], r['errores']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', default='instance/benchmark.db', help='BD SQLite de la siembra')
+    parser.add_argument('--escala', type=float, default=1.0, help='fracción de los volúmenes completos')
+    parser.add_argument('--resembrar', action='store_true', help='borra la BD y siembra de nuevo')
+    parser.add_argument('--url', help='servidor WSGI local en vez del test client')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duracion', type=float, default=30.0, help='segundos de carga')
+    parser.add_argument('--guardar', help='escribe los resultados como línea base JSON')
+    parser.add_argument('--comparar', help='línea base JSON contra la cual comparar')
+    parser.add_argument('--umbral', type=float, default=0.2, help='empeoramiento tolerado del p95 (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    if args.resembrar and os.path.exists(args.db):
+        os.remove(args.db)
+    app = crear_app_bench(args.db)
+    with app.app_context():
+        if not db.session.scalar(sa.select(Usuario.id).where(Usuario.email.like('bench-%')).limit(1)):
+            print('Sembrando datos sintéticos (escala %g)...' % args.escala)
+            sembrar(args.escala)
+        datos = {'emails': {rol: _muestra_emails(rol) for rol in ROLES if rol},
+                 'max_producto': db.session.scalar(sa.select(sa.func.max(Producto.id)))}
+
+    if args.url:
+        nuevo_cliente = lambda: ClienteHTTP(args.url)
+    else:
+        nuevo_cliente = lambda: ClienteApp(app)
+    print('Carga: %d workers durante %g s contra %s' % (args.workers, args.duracion, args.url or 'test client'))
+    rutas = correr(nuevo_cliente, datos, workers=args.workers, duracion=args.duracion)
+    imprimir(rutas)
+
+    resultado = {'fecha': datetime.utcnow().isoformat(), 'escala': args.escala,
+                 'workers': args.workers, 'destino': args.url or 'test-client', 'rutas': rutas}
+    if args.guardar:
+        with open(args.guardar, 'w') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print('Línea base guardada en %s' % args.guardar)
+    if args.comparar:
+        with open(args.comparar) as f:
+            base = json.load(f)
+        regresiones = comparar(rutas, base['rutas'], args.umbral)
+        for r in regresiones:
+            print('REGRESIÓN ' + r)
+        if regresiones:
+            return 1
+        print('Sin regresiones (umbral %d%%).' % (args.umbral * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
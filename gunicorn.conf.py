@@ -0,0 +1,40 @@
+import os
+
+# Servidor pre-fork: el maestro importa la app una vez (preload_app) y los
+# workers nacen con fork, compartiendo memoria y sin repetir el arranque.
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+# Un solo worker por defecto. La versión del catálogo, los eventos de
+# repartidores y la cola de trabajos se comparten por la BD, pero otro estado
+# sigue siendo de cada proceso y con varios workers se comporta distinto:
+#   - límites de intentos de login (contrasenas.py): cada worker cuenta por
+#     su lado, así que N workers permiten N veces AUTH_LIMITE_IP/EMAIL;
+#   - cache de identidad (identidad.py): un cambio de perfil o contraseña
+#     hecho en otro worker tarda hasta IDENTIDAD_CACHE_TTL en verse;
+#   - matriz de recomendaciones (recomendaciones.py): cada worker solo suma
+#     sus propios pedidos hasta la reconstrucción periódica;
+#   - cache de fragmentos en memoria (fragmentos.py): las claves llevan la
+#     versión del contenido, así que solo se duplica la memoria.
+# Por eso solo se soporta un worker: WEB_CONCURRENCY > 1 queda pendiente de
+# mover ese estado a la BD (o a un backend compartido como FRAGMENTOS_BACKEND).
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# Hilos del worker: toda la concurrencia va aquí. Cada tablero de
+# repartidores con SSE/long-poll abierto ocupa un hilo mientras espera; a lo
+# más EVENTOS_MAX_ESPERAS (4) a la vez por worker, el resto recibe 503 y
+# consulta /delivery/eventos sin esperar. Subir ese límite exige subir threads.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Reciclar workers de vez en cuando acota fugas de memoria
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def post_fork(server, worker):
+    # Las conexiones que el maestro haya abierto no se comparten entre procesos
+    from wsgi import app
+    from app import db
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -1,7 +1,8 @@
+import os
 from app import create_app
 
 app = create_app()
 
 if __name__ == '__main__':
-    
-    app.run(debug=True)
\ No newline at end of file
+    # Servidor de desarrollo. En producción: gunicorn -c gunicorn.conf.py wsgi:app
+    app.run(debug=os.environ.get('FLASK_DEBUG', '1') == '1')
@@ -1,3 +1,10 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from app import create_app, db
 from app.models import Usuario, Producto, Pedido
@@ -6,11 +13,15 @@ from werkzeug.security import generate_password_hash
 class VeciMarketTestCase(unittest.TestCase):
     
     def setUp(self):
+        # Imágenes en una carpeta temporal: las pruebas no tocan app/static/uploads
+        self.uploads = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.uploads, True)
         # Usamos memoria RAM:
         self.app = create_app({
             'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
             'TESTING': True,
-            'WTF_CSRF_ENABLED': False
+            'WTF_CSRF_ENABLED': False,
+            'UPLOAD_FOLDER': self.uploads,
         })
         self.client = self.app.test_client()
         
@@ -18,6 +29,8 @@ class VeciMarketTestCase(unittest.TestCase):
             db.create_all()
 
     def tearDown(self):
+        # Los hilos de la cola no sobreviven a la prueba
+        self.app.extensions['trabajos'].detener()
         with self.app.app_context():
             db.session.remove()
             db.drop_all()
@@ -113,6 +126,1096 @@ class VeciMarketTestCase(unittest.TestCase):
         self.assertNotIn(b'Panel de Control', response.data)
         print(" [EXITO] Acceso denegado correctamente.")
 
+    # --- PRUEBA 5: BÚSQUEDA DE TEXTO COMPLETO ---
+    def test_busqueda_catalogo(self):
+        print("\n[PRUEBA 5] Verificando búsqueda con acentos y relevancia...")
+        with self.app.app_context():
+            tienda = Usuario(email='t@test.com', nombre='Tienda', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+
+            db.session.add_all([
+                Producto(nombre='Pan dulce', descripcion='Hecho con azúcar', precio=5, stock_actual=3, tienda_id=tienda.id),
+                Producto(nombre='Azúcar morena', categoria='Abarrotes', precio=30, stock_actual=10, tienda_id=tienda.id),
+                Producto(nombre='Sal', precio=12, stock_actual=10, tienda_id=tienda.id),
+            ])
+            db.session.commit()
+
+            # Renombrar un producto actualiza el índice
+            sal = Producto.query.filter_by(nombre='Sal').first()
+            sal.nombre = 'Sal de mar'
+            db.session.commit()
+
+        html = self.client.get('/catalogo?q=azucar').data.decode('utf-8')
+        self.assertIn('Azúcar morena', html)
+        self.assertIn('Pan dulce', html)
+        self.assertNotIn('Sal de mar', html)
+        # El nombre pesa más que la descripción
+        self.assertLess(html.index('Azúcar morena'), html.index('Pan dulce'))
+
+        html = self.client.get('/catalogo?q=mar').data.decode('utf-8')
+        self.assertIn('Sal de mar', html)
+        # Una página absurda no desborda el OFFSET: sale vacía, no con error
+        r = self.client.get('/catalogo?q=mar&page=99999999999999999999')
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('Sal de mar', r.get_data(as_text=True))
+        print(" [EXITO] Búsqueda indexada y ordenada por relevancia.")
+
+    # --- PRUEBA 6: API PAGINADA ---
+    def test_api_productos_paginada(self):
+        print("\n[PRUEBA 6] Verificando paginación por cursor de la API...")
+        with self.app.app_context():
+            tienda = Usuario(email='t@test.com', nombre='Tienda', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            db.session.add_all([Producto(nombre='P%d' % i, precio=i, stock_actual=1, tienda_id=tienda.id) for i in range(5)])
+            db.session.add(Producto(nombre='Agotado', precio=1, stock_actual=0, tienda_id=tienda.id))
+            db.session.commit()
+
+        pagina = self.client.get('/api/productos?limit=3&fields=id,nombre,tienda').get_json()
+        self.assertEqual(pagina['count'], 3)
+        self.assertEqual(set(pagina['data'][0]), {'id', 'nombre', 'tienda'})
+        self.assertEqual(pagina['data'][0]['tienda'], 'Tienda')
+
+        siguiente = self.client.get('/api/productos?limit=3&cursor=%d' % pagina['next_cursor']).get_json()
+        self.assertEqual([p['nombre'] for p in siguiente['data']], ['P3', 'P4'])
+        self.assertIsNone(siguiente['next_cursor'])
+        print(" [EXITO] Cursor, campos y filtros de stock correctos.")
+
+    # --- PRUEBA 7: CACHE DEL CATÁLOGO ---
+    def test_cache_catalogo(self):
+        print("\n[PRUEBA 7] Verificando cache, ETag e invalidación del catálogo...")
+        self.client.post('/auth/registro', data={'email': 'shop@test.com', 'nombre': 'Shop', 'password': '123', 'rol': 'tienda', 'telefono': '00'})
+        self.client.post('/auth/login', data={'email': 'shop@test.com', 'password': '123'})
+        self.client.post('/inventario/agregar', data={'nombre': 'Huevo', 'tipo': 'producto', 'precio': '40',
+                                                       'descripcion': '', 'categoria': 'Abarrotes', 'stock': '10'})
+
+        r1 = self.client.get('/api/productos')
+        etag = r1.headers['ETag']
+        self.assertEqual(r1.get_json()['count'], 1)
+        self.assertEqual(self.client.get('/api/productos').get_json()['count'], 1)
+
+        r304 = self.client.get('/api/productos', headers={'If-None-Match': etag})
+        self.assertEqual(r304.status_code, 304)
+        # Un cliente que solo devuelve Last-Modified también recibe 304
+        r304 = self.client.get('/api/productos', headers={'If-Modified-Since': r1.headers['Last-Modified']})
+        self.assertEqual(r304.status_code, 304)
+        self.assertGreaterEqual(self.client.get('/api/catalogo/cache').get_json()['hits'], 1)
+
+        # Un ajuste de stock invalida la versión: el ETag viejo ya no vale
+        with self.app.app_context():
+            pid = Producto.query.first().id
+        self.client.post('/inventario/ajustar_stock/%d' % pid, data={'nuevo_stock': '0'})
+        r2 = self.client.get('/api/productos', headers={'If-None-Match': etag})
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r2.get_json()['count'], 0)
+
+        # Otro worker (cache local vacía) comparte la versión guardada en la BD
+        from app.cache import CacheCatalogo, invalidar_catalogo
+        self.app.extensions['cache_catalogo'] = CacheCatalogo()
+        self.assertEqual(self.client.get('/api/productos', headers={'If-None-Match': r2.headers['ETag']}).status_code, 304)
+        # ...y ve las escrituras hechas por cualquier proceso, aunque no limpie su memoria
+        local = self.app.extensions['cache_catalogo']
+        self.assertEqual(self.client.get('/api/productos').get_json()['count'], 0)
+        with self.app.app_context():
+            db.session.get(Producto, pid).stock_actual = 3
+            self.app.extensions['cache_catalogo'] = CacheCatalogo()
+            invalidar_catalogo()
+            db.session.commit()
+        self.app.extensions['cache_catalogo'] = local
+        r3 = self.client.get('/api/productos', headers={'If-None-Match': r2.headers['ETag']})
+        self.assertEqual(r3.status_code, 200)
+        self.assertEqual(r3.get_json()['count'], 1)
+        print(" [EXITO] Cache con ETag/304 invalidada por escritura.")
+
+    # --- PRUEBA 8: CHECKOUT SIN SOBREVENTA ---
+    def test_checkout_stock(self):
+        print("\n[PRUEBA 8] Verificando checkout atómico y sin sobreventa...")
+        with self.app.app_context():
+            tienda = Usuario(email='shop@test.com', nombre='Shop', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            prod = Producto(nombre='Garrafón', precio=30, stock_actual=2, tienda_id=tienda.id)
+            db.session.add(prod)
+            db.session.commit()
+            pid = prod.id
+
+        self.client.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        self.client.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+
+        # 3 unidades con stock 2: se rechaza sin tocar nada
+        for _ in range(3):
+            self.client.get('/agregar/%d' % pid)
+        r = self.client.post('/carrito', data={'tipo_entrega': 'envio', 'metodo_pago': 'efectivo'}, follow_redirects=True)
+        self.assertIn('Sin stock suficiente', r.data.decode('utf-8'))
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Producto, pid).stock_actual, 2)
+            self.assertEqual(Pedido.query.count(), 0)
+
+        # 2 unidades: un solo renglón con cantidad 2
+        self.client.get('/eliminar_item/%d' % pid)
+        self.client.post('/carrito', data={'tipo_entrega': 'envio', 'metodo_pago': 'efectivo'})
+        with self.app.app_context():
+            pedido = Pedido.query.one()
+            self.assertEqual(pedido.total, 60)
+            self.assertEqual([(i.producto_id, i.cantidad) for i in pedido.items], [(pid, 2)])
+            self.assertEqual(db.session.get(Producto, pid).stock_actual, 0)
+        print(" [EXITO] Stock descontado en una sola transacción.")
+
+    # --- PRUEBA 9: ASIGNACIÓN ATÓMICA Y EVENTOS EN VIVO ---
+    def test_asignacion_atomica(self):
+        print("\n[PRUEBA 9] Verificando que solo un repartidor gana el pedido...")
+        with self.app.app_context():
+            cli = Usuario(email='cli@test.com', nombre='Cli', password='123', rol='cliente')
+            db.session.add(cli)
+            db.session.commit()
+            pedido = Pedido(total=100, cliente_id=cli.id, estado='pendiente', tipo_entrega='envio')
+            db.session.add(pedido)
+            db.session.commit()
+            pid = pedido.id
+
+        otro = self.app.test_client()
+        for cliente, email in ((self.client, 'rep1@test.com'), (otro, 'rep2@test.com')):
+            cliente.post('/auth/registro', data={'email': email, 'nombre': 'Rep', 'password': '123', 'rol': 'repartidor', 'telefono': '00'})
+            cliente.post('/auth/login', data={'email': email, 'password': '123'})
+
+        self.client.get('/delivery/aceptar/%d' % pid)
+        r = otro.get('/delivery/aceptar/%d' % pid, follow_redirects=True)
+        self.assertIn('No disponible', r.data.decode('utf-8'))
+        with self.app.app_context():
+            rep1 = Usuario.query.filter_by(email='rep1@test.com').one()
+            self.assertEqual(db.session.get(Pedido, pid).repartidor_id, rep1.id)
+
+        feed = otro.get('/delivery/eventos?desde=0&espera=0').get_json()
+        self.assertEqual([(e['tipo'], e['datos']['pedido']) for e in feed['eventos']], [('tomado', pid)])
+        # Otro worker (bus local vacío) lee el mismo evento con el mismo id desde la BD
+        from app.eventos import BusEventos
+        with self.app.app_context():
+            self.assertEqual(BusEventos().desde(0), feed['eventos'])
+        # Un Last-Event-ID que este canal no conoce pide recargar en vez de quedarse colgado
+        feed = otro.get('/delivery/eventos?desde=999&espera=5', headers={'Last-Event-ID': '999'}).get_json()
+        self.assertEqual([e['tipo'] for e in feed['eventos']], ['resync'])
+
+        # El stream SSE termina solo (libera el hilo) y el navegador reconecta
+        self.app.config['DELIVERY_DURACION_SSE'] = 0.2
+        stream = otro.get('/delivery/stream?desde=0').get_data(as_text=True)
+        self.assertIn('event: tomado', stream)
+
+        # Leer eventos no cierra la sesión de la petición (current_user sigue cargado)
+        with self.app.app_context():
+            rep1 = Usuario.query.filter_by(email='rep1@test.com').one()
+            self.app.extensions['eventos'].desde(0)
+            self.assertIn(rep1, db.session)
+
+        # Sin lugares libres: el stream responde 503 y el long-poll no espera
+        from app import eventos
+        self.app.extensions['eventos'] = eventos.BusEventos(max_esperas=1)
+        self.assertTrue(self.app.extensions['eventos'].reservar())
+        r = otro.get('/delivery/stream?desde=0')
+        self.assertEqual(r.status_code, 503)
+        inicio = time.monotonic()
+        feed = otro.get('/delivery/eventos?desde=%d&espera=5' % feed['ultimo_id']).get_json()
+        self.assertEqual(feed['eventos'], [])
+        self.assertLess(time.monotonic() - inicio, 1)
+        # Al cerrar el stream (el servidor WSGI llama a close) se devuelve el lugar
+        self.app.extensions['eventos'].liberar()
+        with otro.get('/delivery/stream?desde=0') as r:
+            self.assertIn('event: tomado', r.get_data(as_text=True))
+        self.assertTrue(self.app.extensions['eventos'].reservar())
+        print(" [EXITO] Asignación compare-and-set y aviso a los demás repartidores.")
+
+    # --- PRUEBA 10: PRESUPUESTO DE CONSULTAS ---
+    def test_presupuesto_consultas(self):
+        print("\n[PRUEBA 10] Verificando conteo de consultas por ruta...")
+        with self.app.app_context():
+            tiendas = [Usuario(email='t%d@test.com' % i, nombre='T%d' % i, password='123', rol='tienda') for i in range(5)]
+            db.session.add_all(tiendas)
+            db.session.commit()
+            db.session.add_all([Producto(nombre='P%d' % i, precio=1, stock_actual=1, tienda_id=t.id)
+                                for i, t in enumerate(tiendas * 4)])
+            db.session.commit()
+
+        r = self.client.get('/catalogo')
+        self.assertIn('sql;dur=', r.headers['Server-Timing'])
+        ultima = self.app.extensions['metricas'].ultima
+        # Versión del catálogo + productos con su tienda + categorías, sin importar cuántas tiendas haya
+        self.assertLessEqual(ultima['consultas'], 3)
+        self.assertEqual(ultima['repetidas'], {})
+
+        self.assertEqual(self.client.get('/debug/metrics').status_code, 404)
+        self.app.config['METRICAS_DEBUG'] = True
+        resumen = self.client.get('/debug/metrics').get_json()
+        self.assertEqual(resumen['market.catalogo']['peticiones'], 1)
+        print(" [EXITO] Consultas, tiempos y Server-Timing registrados.")
+
+    # --- PRUEBA 11: IMÁGENES POR CONTENIDO Y VARIANTES ---
+    def test_imagenes_variantes(self):
+        print("\n[PRUEBA 11] Verificando deduplicación y miniaturas de imágenes...")
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest('Pillow no instalado')
+        carpeta = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, carpeta, True)
+        self.app.config['UPLOAD_FOLDER'] = carpeta
+        png = io.BytesIO()
+        Image.new('RGBA', (800, 600), (255, 0, 0, 128)).save(png, 'PNG')
+
+        self.client.post('/auth/registro', data={'email': 'shop@test.com', 'nombre': 'Shop', 'password': '123', 'rol': 'tienda', 'telefono': '00'})
+        self.client.post('/auth/login', data={'email': 'shop@test.com', 'password': '123'})
+        for nombre in ('Foto A', 'Foto B'):
+            self.client.post('/inventario/agregar', content_type='multipart/form-data', data={
+                'nombre': nombre, 'tipo': 'producto', 'precio': '1', 'descripcion': '', 'categoria': 'X', 'stock': '1',
+                'imagen': (io.BytesIO(png.getvalue()), 'foto.PNG')})
+        self.app.extensions['imagenes_pool'].shutdown(wait=True)
+
+        with self.app.app_context():
+            nombres = {p.imagen for p in Producto.query.all()}
+        self.assertEqual(len(nombres), 1)
+        self.assertEqual(len([f for f in os.listdir(carpeta) if f.endswith('.png')]), 1)
+        self.assertEqual(len(os.listdir(os.path.join(carpeta, 'variantes'))), 4)
+
+        html = self.client.get('/catalogo').data.decode('utf-8')
+        self.assertIn('_card.webp', html)
+        print(" [EXITO] Una sola copia en disco y variantes WebP/JPEG generadas.")
+
+    # --- PRUEBA 12: ESTÁTICOS CON HUELLA Y COMPRESIÓN ---
+    def test_estaticos_y_compresion(self):
+        print("\n[PRUEBA 12] Verificando cache inmutable y compresión gzip...")
+        imagen = 'fixture.png'
+        with open(os.path.join(self.uploads, imagen), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + b'\x00' * 64)
+        with self.app.test_request_context():
+            from app.estaticos import url
+            url_imagen = url('uploads/' + imagen)
+        self.assertIn('?v=', url_imagen)
+        r = self.client.get(url_imagen)
+        self.assertIn('immutable', r.headers['Cache-Control'])
+        r.close()
+
+        with self.app.app_context():
+            tienda = Usuario(email='t@test.com', nombre='Tienda', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            db.session.add(Producto(nombre='Leche', precio=25, stock_actual=5, tienda_id=tienda.id))
+            db.session.commit()
+
+        r = self.client.get('/catalogo', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Leche', gzip.decompress(r.data).decode('utf-8'))
+        # El ETag débil de la respuesta comprimida sigue sirviendo para 304
+        r304 = self.client.get('/catalogo', headers={'Accept-Encoding': 'gzip', 'If-None-Match': r.headers['ETag']})
+        self.assertEqual(r304.status_code, 304)
+        print(" [EXITO] Assets inmutables y HTML comprimido.")
+
+    # --- PRUEBA 13: RESUMEN DE VENTAS PRECALCULADO ---
+    def test_resumen_ventas(self):
+        print("\n[PRUEBA 13] Verificando precio congelado y resumen de ventas...")
+        from app import ventas
+        from app.models import ResumenVentas
+        self.client.post('/auth/registro', data={'email': 'shop@test.com', 'nombre': 'Shop', 'password': '123', 'rol': 'tienda', 'telefono': '00'})
+        with self.app.app_context():
+            tienda = Usuario.query.filter_by(email='shop@test.com').one()
+            prod = Producto(nombre='Tortilla', precio=20, stock_actual=10, tienda_id=tienda.id)
+            db.session.add(prod)
+            db.session.commit()
+            pid = prod.id
+
+        comprador = self.app.test_client()
+        comprador.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        comprador.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        for _ in range(3):
+            comprador.get('/agregar/%d' % pid)
+        comprador.post('/carrito', data={'tipo_entrega': 'recoger', 'metodo_pago': 'efectivo'})
+
+        with self.app.app_context():
+            # Subir el precio después no cambia lo ya vendido
+            db.session.get(Producto, pid).precio = 99
+            db.session.commit()
+            fila = ResumenVentas.query.one()
+            self.assertEqual((fila.unidades, fila.ingreso), (3, 60))
+            self.assertEqual(ventas.reconstruir(), 1)
+            self.assertEqual(ResumenVentas.query.one().ingreso, 60)
+
+        self.client.post('/auth/login', data={'email': 'shop@test.com', 'password': '123'})
+        html = self.client.get('/inventario/ventas').data.decode('utf-8')
+        self.assertIn('$60.00', html)
+        html = self.client.get('/inventario/ventas?desde=2000-01-01&hasta=2000-01-02').data.decode('utf-8')
+        self.assertIn('$0.00', html)
+        print(" [EXITO] Ventas leídas del resumen con filtro de fechas.")
+
+    # --- PRUEBA 14: AJUSTE MASIVO DE STOCK ---
+    def test_stock_masivo(self):
+        print("\n[PRUEBA 14] Verificando reabasto masivo con verificación de propiedad...")
+        self.client.post('/auth/registro', data={'email': 'shop@test.com', 'nombre': 'Shop', 'password': '123', 'rol': 'tienda', 'telefono': '00'})
+        with self.app.app_context():
+            mia = Usuario.query.filter_by(email='shop@test.com').one()
+            otra = Usuario(email='otra@test.com', nombre='Otra', password='123', rol='tienda')
+            db.session.add(otra)
+            db.session.commit()
+            mios = [Producto(nombre='M%d' % i, precio=1, stock_actual=0, tienda_id=mia.id) for i in range(3)]
+            ajeno = Producto(nombre='Ajeno', precio=1, stock_actual=7, tienda_id=otra.id)
+            db.session.add_all(mios + [ajeno])
+            db.session.commit()
+            ids = [p.id for p in mios]
+            id_ajeno = ajeno.id
+
+        self.client.post('/auth/login', data={'email': 'shop@test.com', 'password': '123'})
+        html = self.client.get('/inventario/dashboard').data.decode('utf-8')
+        self.assertIn('Stock Crítico', html)
+
+        r = self.client.post('/inventario/stock_masivo', json={'items': [{'id': ids[0], 'stock': 10}, [ids[1], 20], [id_ajeno, 0]]})
+        self.assertEqual(r.get_json()['actualizados'], 2)
+        self.assertEqual(r.get_json()['rechazados'], [id_ajeno])
+        # Documentos o renglones mal formados: 400 o rechazados, nunca un 500
+        self.assertEqual(self.client.post('/inventario/stock_masivo', json=[[ids[0], 1]]).status_code, 400)
+        self.assertEqual(self.client.post('/inventario/stock_masivo', json={'items': 5}).status_code, 400)
+        r = self.client.post('/inventario/stock_masivo', json={'items': [5, [ids[0]], 'x', [ids[0], 10]]})
+        self.assertEqual(r.get_json()['rechazados'], [5, [ids[0]], 'x'])
+        # Decimales y booleanos no se truncan ni se convierten: se rechazan
+        r = self.client.post('/inventario/stock_masivo', json={'items': [[ids[1], 3.7], [ids[2], True], [True, 1]]})
+        self.assertEqual((r.get_json()['actualizados'], r.get_json()['rechazados']), (0, [ids[1], ids[2], True]))
+        # Un id con un renglón válido y otro inválido se rechaza una sola vez y no se toca
+        r = self.client.post('/inventario/stock_masivo', json={'items': [[ids[0], 99], [ids[0], -1], [ids[0], 98]]})
+        self.assertEqual((r.get_json()['actualizados'], r.get_json()['rechazados']), (0, [ids[0]]))
+        # Un CSV que no es UTF-8 es un 400, no un 500
+        r = self.client.post('/inventario/stock_masivo', content_type='multipart/form-data',
+                             data={'archivo': (io.BytesIO(('id,stock\n%d,5 años\n' % ids[2]).encode('latin-1')), 'reabasto.csv')})
+        self.assertEqual(r.status_code, 400)
+
+        csv = 'id,stock\n%d,30\n' % ids[2]
+        self.client.post('/inventario/stock_masivo', content_type='multipart/form-data',
+                         data={'archivo': (io.BytesIO(csv.encode('utf-8')), 'reabasto.csv')})
+        with self.app.app_context():
+            self.assertEqual([db.session.get(Producto, i).stock_actual for i in ids], [10, 20, 30])
+            self.assertEqual(db.session.get(Producto, id_ajeno).stock_actual, 7)
+        print(" [EXITO] Un solo UPDATE por lote y productos ajenos intactos.")
+
+    # --- PRUEBA 15: CARRITO DEL LADO DEL SERVIDOR ---
+    def test_carrito_servidor(self):
+        print("\n[PRUEBA 15] Verificando carrito en servidor y migración de la cookie...")
+        from app.models import CarritoItem
+        with self.app.app_context():
+            tienda = Usuario(email='shop@test.com', nombre='Shop', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            a = Producto(nombre='Pan', precio=10, stock_actual=50, tienda_id=tienda.id)
+            b = Producto(nombre='Leche', precio=25, stock_actual=50, tienda_id=tienda.id)
+            db.session.add_all([a, b])
+            db.session.commit()
+            pa, pb = a.id, b.id
+
+        self.client.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        self.client.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        # Carrito con el formato anterior (lista de ids en la cookie)
+        with self.client.session_transaction() as sess:
+            sess['carrito'] = [pa, pa]
+
+        self.client.get('/agregar/%d' % pb)
+        self.client.post('/carrito/cantidad/%d' % pb, data={'cantidad': '4'})
+        self.client.get('/eliminar_item/%d' % pa)
+        with self.client.session_transaction() as sess:
+            self.assertNotIn('carrito', sess)
+            self.assertEqual(sess['carrito_n'], 5)
+        with self.app.app_context():
+            self.assertEqual({i.producto_id: i.cantidad for i in CarritoItem.query.all()}, {pa: 1, pb: 4})
+
+        self.client.post('/carrito', data={'tipo_entrega': 'recoger', 'metodo_pago': 'efectivo'})
+        with self.app.app_context():
+            self.assertEqual(Pedido.query.one().total, 110)
+            self.assertEqual(CarritoItem.query.count(), 0)
+        print(" [EXITO] Carrito {id: cantidad} en servidor y vaciado al comprar.")
+
+    # --- PRUEBA 16: FACETAS DEL CATÁLOGO ---
+    def test_facetas_catalogo(self):
+        print("\n[PRUEBA 16] Verificando conteos de facetas y filtros combinados...")
+        import sqlalchemy as sa
+        from app import facetas
+        with self.app.app_context():
+            tienda = Usuario(email='shop@test.com', nombre='Shop', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            pan = Producto(nombre='Pan', precio=10, categoria='Panadería', stock_actual=1, tienda_id=tienda.id)
+            db.session.add_all([pan,
+                                Producto(nombre='Bolillo', precio=2, categoria='Panadería', stock_actual=9, tienda_id=tienda.id),
+                                Producto(nombre='Leche', precio=25, categoria='Lácteos', stock_actual=0, tienda_id=tienda.id),
+                                Producto(nombre='Plomero', precio=300, categoria='Hogar', tipo='servicio', stock_actual=1, tienda_id=tienda.id)])
+            db.session.commit()
+            conteos = facetas.conteos()
+            self.assertEqual(dict(conteos['categoria']), {'Panadería': 2, 'Hogar': 1})
+            self.assertEqual(dict(conteos['tipo']), {'producto': 2, 'servicio': 1})
+            self.assertEqual(conteos['tienda'], [(tienda.id, 'Shop', 3)])
+            pan_id = pan.id
+
+            # Bajar de 9 a 8 no toca conteo_faceta: solo cambia la fila del producto
+            antes = db.session.execute(sa.text('SELECT total_changes()')).scalar()
+            db.session.execute(sa.update(Producto).where(Producto.nombre == 'Bolillo')
+                               .values(stock_actual=Producto.stock_actual - 1))
+            self.assertEqual(db.session.execute(sa.text('SELECT total_changes()')).scalar() - antes, 1)
+            db.session.commit()
+
+        # El checkout agota el pan: el conteo baja sin recalcular
+        self.client.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        self.client.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        self.client.get('/agregar/%d' % pan_id)
+        self.client.post('/carrito', data={'tipo_entrega': 'recoger', 'metodo_pago': 'efectivo'})
+        with self.app.app_context():
+            self.assertEqual(dict(facetas.conteos()['categoria']), {'Panadería': 1, 'Hogar': 1})
+            facetas.reconstruir()
+            self.assertEqual(dict(facetas.conteos()['categoria']), {'Panadería': 1, 'Hogar': 1})
+
+        html = self.client.get('/catalogo?categoria=Panadería&categoria=Hogar&tipo=servicio').get_data(as_text=True)
+        self.assertIn('Plomero', html)
+        self.assertNotIn('Bolillo', html)
+        self.assertIn('Panadería <span>1</span>', html)
+        self.assertNotIn('Lácteos', html)
+        print(" [EXITO] Conteos mantenidos por triggers y filtros múltiples.")
+
+    # --- PRUEBA 17: IDENTIDAD EN CACHE Y LÍMITE DE LOGIN ---
+    def test_identidad_y_login(self):
+        print("\n[PRUEBA 17] Verificando cache de usuario, rehash y límite de intentos...")
+        self.app.config['AUTH_HASH_METODO'] = 'pbkdf2:sha256:1000'
+        self.app.extensions['hash_pool'].metodo = 'pbkdf2:sha256:1000'
+        with self.app.app_context():
+            u = Usuario(email='cli@test.com', nombre='Cli', password=generate_password_hash('123'), rol='cliente')
+            db.session.add(u)
+            db.session.commit()
+
+        self.client.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        with self.app.app_context():
+            # Se guardó con los parámetros configurados
+            self.assertTrue(Usuario.query.one().password.startswith('pbkdf2:sha256:1000$'))
+
+        self.client.get('/catalogo')
+        self.client.get('/catalogo?q=pan')
+        # Versión + productos + facetas: el usuario sale de la cache, sin SELECT
+        self.assertEqual(self.app.extensions['metricas'].ultima['consultas'], 3)
+
+        # Un cambio de perfil invalida la entrada
+        from app import identidad
+        with self.app.app_context():
+            u = Usuario.query.one()
+            uid = u.id
+            u.nombre = 'Cli Nuevo'
+            db.session.commit()
+            db.session.remove()
+            self.assertEqual(identidad.cargar(uid).nombre, 'Cli Nuevo')
+
+        # Un commit revertido no toca la cache; el que se confirma la invalida al final
+        with self.app.app_context():
+            identidad.cargar(uid)
+            u = db.session.get(Usuario, uid)
+            u.nombre = 'Cli Revertido'
+            db.session.flush()
+            self.assertIsNotNone(self.app.extensions['identidad_cache'].get(uid))
+            db.session.rollback()
+            db.session.remove()
+            self.assertEqual(identidad.cargar(uid).nombre, 'Cli Nuevo')
+
+        self.client.get('/auth/logout')
+        codigos = [self.client.post('/auth/login', data={'email': 'otro@test.com', 'password': 'x'}).status_code
+                   for _ in range(6)]
+        self.assertEqual(codigos[-1], 429)
+        # El intento rechazado por el correo no gasta cupo de la IP (login inicial + 5)
+        limites = self.app.extensions['hash_limites']
+        self.assertEqual(len(limites['ip']._intentos['127.0.0.1']), 1 + 5)
+
+        # Con PROXY_X_FOR la IP del límite es la del cliente, no la del proxy
+        app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+                          'PROXY_X_FOR': 1, 'AUTH_LIMITE_IP': 1})
+        cliente = app.test_client()
+        codigos = [cliente.post('/auth/login', data={'email': 'a%d@test.com' % i, 'password': 'x'},
+                                headers={'X-Forwarded-For': ip}).status_code
+                   for i, ip in enumerate(['10.0.0.1', '10.0.0.2', '10.0.0.1'])]
+        self.assertEqual(codigos, [200, 200, 429])
+        print(" [EXITO] Usuario sin SELECT por petición y login limitado.")
+
+    # --- PRUEBA 18: BANCO DE CARGA ---
+    def test_banco_de_carga(self):
+        print("\n[PRUEBA 18] Verificando siembra sintética y reporte de latencias...")
+        import benchmark
+        self.app.config.update(AUTH_HASH_METODO=benchmark.METODO_HASH, AUTH_LIMITE_IP=10 ** 9)
+        self.app.extensions['hash_pool'].metodo = benchmark.METODO_HASH
+        with self.app.app_context():
+            n = benchmark.sembrar(escala=0.0005, log=lambda *_: None)
+            self.assertEqual(Pedido.query.count(), n['pedidos'])
+            datos = {'emails': {rol: benchmark._muestra_emails(rol) for rol in benchmark.ROLES if rol},
+                     'max_producto': n['productos']}
+
+        rutas = benchmark.correr(lambda: benchmark.ClienteApp(self.app), datos,
+                                 workers=1, duracion=30, peticiones=40)
+        self.assertEqual(sum(r['peticiones'] for r in rutas.values()), 40)
+        for r in rutas.values():
+            self.assertEqual(r['errores'], 0)
+            self.assertLessEqual(r['p50_ms'], r['p99_ms'])
+
+        base = {'market.catalogo': {'p95_ms': 10.0, 'consultas': 2}}
+        self.assertEqual(benchmark.comparar({'market.catalogo': {'p95_ms': 11.0, 'consultas': 2}}, base), [])
+        self.assertEqual(len(benchmark.comparar({'market.catalogo': {'p95_ms': 30.0, 'consultas': 5}}, base)), 2)
+        print(" [EXITO] Latencias p50/p95/p99 por ruta y detección de regresiones.")
+
+    # --- PRUEBA 19: IMPORTACIÓN Y EXPORTACIÓN MASIVA ---
+    def test_importar_exportar(self):
+        print("\n[PRUEBA 19] Verificando importación por lotes con errores por fila...")
+        import zipfile
+        carpeta = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, carpeta, True)
+        self.app.config['UPLOAD_FOLDER'] = carpeta
+        self.client.post('/auth/registro', data={'email': 'shop@test.com', 'nombre': 'Shop', 'password': '123', 'rol': 'tienda', 'telefono': '00'})
+        self.client.post('/auth/login', data={'email': 'shop@test.com', 'password': '123'})
+
+        filas = ['nombre,precio,categoria,tipo,stock,imagen']
+        filas += ['Producto %d,%d,Alimentos,producto,5,' % (i, i + 1) for i in range(1200)]
+        filas += [',10,Hogar,producto,1,', 'Malo,abc,Hogar,producto,1,', 'Corte,80,Servicios,servicio,,foto.gif']
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w') as z:
+            # GIF de 1x1
+            z.writestr('fotos/foto.gif', b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff'
+                                         b'!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;')
+        zip_buffer.seek(0)
+
+        r = self.client.post('/inventario/importar', headers={'Accept': 'application/json'},
+                             content_type='multipart/form-data',
+                             data={'archivo': (io.BytesIO('\n'.join(filas).encode('utf-8')), 'catalogo.csv'),
+                                   'imagenes': (zip_buffer, 'fotos.zip')})
+        datos = r.get_json()
+        self.assertEqual(datos['insertados'], 1201)
+        self.assertEqual([e['fila'] for e in datos['errores']], [1202, 1203])
+        with self.app.app_context():
+            corte = Producto.query.filter_by(nombre='Corte').one()
+            self.assertEqual((corte.tipo, corte.stock_actual), ('servicio', 1))
+            self.assertNotEqual(corte.imagen, 'default.jpg')
+            self.assertTrue(os.path.isfile(os.path.join(carpeta, corte.imagen)))
+
+        # Modo estricto: un error y no se inserta nada, ni se escribe la imagen del ZIP
+        originales = lambda: {n for n in os.listdir(carpeta) if os.path.isfile(os.path.join(carpeta, n))}
+        archivos = originales()
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w') as z:
+            z.writestr('otra.png', b'\x89PNG no es la misma imagen')
+        zip_buffer.seek(0)
+        jsonl = ('{"nombre": "A", "precio": 1, "imagen": "otra.png"}\n{"nombre": "B", "precio": -1}\n'
+                 '{"nombre": "C", "precio": NaN}\n{"nombre": "D", "precio": 1, "stock": Infinity}\n')
+        r = self.client.post('/inventario/importar', headers={'Accept': 'application/json'},
+                             content_type='multipart/form-data',
+                             data={'archivo': (io.BytesIO(jsonl.encode('utf-8')), 'extra.jsonl'), 'estricto': '1',
+                                   'imagenes': (zip_buffer, 'fotos.zip')})
+        datos = r.get_json()
+        self.assertEqual(datos['insertados'], 0)
+        self.assertEqual([e['error'] for e in datos['errores']],
+                         ['precio no puede ser negativo', 'precio no es un número', 'stock no es un número'])
+        self.assertEqual(originales(), archivos)
+
+        # Un CSV guardado en Latin-1: la fila con bytes no UTF-8 es un error de fila, no un 500
+        latin = 'nombre,precio\nPiñata,50\nVela,10\n'.encode('latin-1')
+        r = self.client.post('/inventario/importar', headers={'Accept': 'application/json'},
+                             content_type='multipart/form-data',
+                             data={'archivo': (io.BytesIO(latin), 'latin.csv')})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual((r.get_json()['insertados'], r.get_json()['errores']),
+                         (1, [{'fila': 2, 'error': 'codificación no es UTF-8'}]))
+        r = self.client.post('/inventario/importar', headers={'Accept': 'application/json'},
+                             content_type='multipart/form-data',
+                             data={'archivo': (io.BytesIO('{"nombre": "Año", "precio": 1}\n'.encode('latin-1')), 'x.jsonl')})
+        self.assertEqual([e['error'] for e in r.get_json()['errores']], ['codificación no es UTF-8'])
+
+        r = self.client.get('/inventario/exportar')
+        self.assertTrue(r.is_streamed)
+        lineas = r.get_data(as_text=True).strip().splitlines()
+        self.assertEqual(lineas[0], 'id,nombre,precio,descripcion,categoria,tipo,stock,stock_minimo,imagen')
+        self.assertEqual(len(lineas), 1203)
+        print(" [EXITO] Lotes executemany, errores por fila y exportación en flujo.")
+
+    # --- PRUEBA 20: ARRANQUE DE PRODUCCIÓN Y SONDAS ---
+    def test_arranque_produccion(self):
+        print("\n[PRUEBA 20] Verificando arranque sin esquema, init-db y sondas de salud...")
+        import sqlalchemy as sa
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'TESTING': True,
+                          'ESQUEMA_AUTOMATICO': False})
+        cliente = app.test_client()
+        with app.app_context():
+            self.assertEqual(sa.inspect(db.engine).get_table_names(), [])
+        self.assertIn('ms', app.extensions['arranque'])
+
+        self.assertEqual(cliente.get('/salud/vivo').status_code, 200)
+        self.assertEqual(cliente.get('/salud/listo').status_code, 503)
+
+        resultado = app.test_cli_runner().invoke(args=['init-db'])
+        self.assertIn('Esquema listo', resultado.output)
+        self.assertEqual(cliente.get('/salud/listo').status_code, 200)
+        with app.app_context():
+            self.assertIn('producto_fts', sa.inspect(db.engine).get_table_names())
+        print(" [EXITO] Workers sin DDL al arrancar y esquema creado por 'flask init-db'.")
+
+    # --- PRUEBA 21: HISTORIAL PAGINADO Y ARCHIVO ---
+    def test_historial_paginado_y_archivo(self):
+        print("\n[PRUEBA 21] Verificando historial por cursor sin N+1 y archivo de pedidos...")
+        from datetime import datetime, timedelta
+        from app import archivo, ventas
+        from app.models import PedidoArchivado, PedidoItem, ResumenVentas
+        self.client.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        with self.app.app_context():
+            cliente = Usuario.query.filter_by(email='cli@test.com').one()
+            tiendas = [Usuario(email='t%d@test.com' % i, nombre='Tienda %d' % i, password='123', rol='tienda') for i in range(3)]
+            db.session.add_all(tiendas)
+            db.session.commit()
+            productos = [Producto(nombre='P%d' % i, precio=10, stock_actual=5, tienda_id=tiendas[i].id) for i in range(3)]
+            db.session.add_all(productos)
+            db.session.commit()
+            ahora = datetime.utcnow()
+            for n in range(25):
+                # Los 10 primeros son entregas de hace un año
+                pedido = Pedido(cliente_id=cliente.id, total=30, estado='entregado' if n < 10 else 'pendiente',
+                                fecha=ahora - timedelta(days=365 if n < 10 else 25 - n))
+                pedido.items = [PedidoItem(producto_id=p.id, cantidad=1, precio_unitario=10) for p in productos]
+                if n == 0:
+                    pedido.destino_lat, pedido.destino_lon, pedido.celda = 19.4, -99.1, '7760:-3965'
+                db.session.add(pedido)
+            db.session.commit()
+            ventas.reconstruir()
+            ingreso = db.session.query(db.func.sum(ResumenVentas.ingreso)).scalar()
+
+        self.client.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        html = self.client.get('/mis_pedidos').get_data(as_text=True)
+        # Usuario + pedidos + ítems/productos/tiendas, sin importar cuántos pedidos haya
+        self.assertLessEqual(self.app.extensions['metricas'].ultima['consultas'], 3)
+        self.assertEqual(html.count('Ver Ticket'), 20)
+        self.assertIn('Tienda 0, Tienda 1 y 1 más', html)
+        siguiente = html.split('cursor=')[1].split('"')[0].replace('%3A', ':')
+        html = self.client.get('/mis_pedidos?cursor=' + siguiente).get_data(as_text=True)
+        self.assertEqual(html.count('Ver Ticket'), 5)
+
+        html = self.client.get('/mis_pedidos?archivo=1').get_data(as_text=True)
+        self.assertIn('No tienes pedidos archivados', html)
+
+        with self.app.app_context():
+            self.assertEqual(archivo.archivar(meses=6), 10)
+            self.assertEqual(Pedido.query.count(), 15)
+            self.assertEqual(PedidoArchivado.query.count(), 10)
+            # Destino, celda y versión de la fila viajan al almacén frío
+            primero = PedidoArchivado.query.order_by(PedidoArchivado.id).first()
+            self.assertEqual((primero.destino_lat, primero.destino_lon, primero.celda), (19.4, -99.1, '7760:-3965'))
+            self.assertIsNotNone(primero.updated_at)
+            # El resumen reconstruido incluye las ventas archivadas
+            ventas.reconstruir()
+            self.assertEqual(db.session.query(db.func.sum(ResumenVentas.ingreso)).scalar(), ingreso)
+        html = self.client.get('/mis_pedidos?archivo=1').get_data(as_text=True)
+        self.assertEqual(html.count('Ver Ticket'), 10)
+        self.assertNotIn('No tienes pedidos', html)
+        print(" [EXITO] Páginas en consultas fijas y pedidos viejos en el almacén frío.")
+
+    # --- PRUEBA 22: DESPACHO POR CERCANÍA Y RUTA ---
+    def test_despacho_por_cercania(self):
+        print("\n[PRUEBA 22] Verificando pedidos más cercanos y orden de la ruta...")
+        import random
+        from app import geo
+        from app.models import PedidoItem
+        self.client.post('/auth/registro', data={'email': 'moto@test.com', 'nombre': 'Moto', 'password': '123',
+                                                 'rol': 'repartidor', 'telefono': '00'})
+        with self.app.app_context():
+            cliente = Usuario(email='cli@test.com', nombre='Cli', password='123', rol='cliente')
+            db.session.add(cliente)
+            db.session.commit()
+            azar = random.Random(7)
+            for n in range(300):
+                destino = (19.3 + azar.uniform(-0.2, 0.2), -99.1 + azar.uniform(-0.2, 0.2))
+                pedido = Pedido(cliente_id=cliente.id, total=10, estado='pendiente', tipo_entrega='envio',
+                                destino_lat=destino[0], destino_lon=destino[1], celda=geo.celda(*destino))
+                db.session.add(pedido)
+            db.session.add(Pedido(cliente_id=cliente.id, total=10, estado='pendiente', tipo_entrega='envio'))
+            db.session.commit()
+
+            # Igual que recorrer todos los pedidos, pero consultando solo las celdas vecinas
+            posicion = (19.31, -99.12)
+            cercanos = geo.mas_cercanos(db.session, posicion, 10)
+            todos = sorted(Pedido.query.filter(Pedido.celda.isnot(None)).all(),
+                           key=lambda p: geo.distancia_km(posicion, (p.destino_lat, p.destino_lon)))
+            self.assertEqual([p.id for p, _ in cercanos], [p.id for p in todos[:10]])
+            # Sin posición se ven los más antiguos; sin suficientes cercanos se completa con los sin ubicación
+            self.assertEqual(len(geo.mas_cercanos(db.session, None, 5)), 5)
+            # Fuera del radio de búsqueda también se completa: lejanos con su km y los sin ubicación
+            lejos = geo.mas_cercanos(db.session, (40.0, 3.0), 301)
+            self.assertEqual(len(lejos), 301)
+            self.assertEqual(sum(km is None for _, km in lejos), 1)
+            self.assertTrue(all(km > 1000 for _, km in lejos if km is not None))
+
+            # Ruta: vecino más cercano + 2-opt sobre paradas en línea recta
+            paradas = [(n, (19.3, -99.1 + 0.01 * n)) for n in (3, 0, 4, 1, 2)]
+            ruta = geo.ordenar_ruta((19.3, -99.11), paradas)
+            self.assertEqual([clave for clave, _ in ruta], [0, 1, 2, 3, 4])
+
+            ids = [p.id for p in todos[:3]]
+            moto = Usuario.query.filter_by(email='moto@test.com').one()
+            Pedido.query.filter(Pedido.id.in_(ids)).update({'estado': 'en_camino', 'repartidor_id': moto.id})
+            # Las entregas en curso salen de dos tiendas: una con ubicación y otra sin ella
+            tiendas = [Usuario(email='t1@test.com', nombre='Abarrotes Uno', password='123', rol='tienda', lat=19.33, lon=-99.13),
+                       Usuario(email='t2@test.com', nombre='Farmacia Dos', password='123', rol='tienda')]
+            db.session.add_all(tiendas)
+            db.session.flush()
+            for n, id in enumerate(ids):
+                producto = Producto(nombre='Caja %d' % n, precio=10, stock_actual=5, tienda_id=tiendas[n % 2].id)
+                db.session.add(PedidoItem(pedido_id=id, producto=producto, cantidad=1, precio_unitario=10))
+            db.session.commit()
+
+            recogidas, entregas = geo.ruta_repartidor(db.session, moto.id, posicion)
+            self.assertEqual([t.nombre for t, _ in recogidas], ['Abarrotes Uno', 'Farmacia Dos'])
+            self.assertIsNone(recogidas[1][1])
+            # El primer tramo de entrega se mide desde la tienda, no desde el repartidor
+            primero, tramo = entregas[0]
+            self.assertEqual(tramo, round(geo.distancia_km((19.33, -99.13), (primero.destino_lat, primero.destino_lon)), 2))
+
+        self.client.post('/auth/login', data={'email': 'moto@test.com', 'password': '123'})
+        # La posición se guarda por POST; el GET del tablero no escribe
+        r = self.client.post('/delivery/ubicacion', data={'lat': '19.31', 'lon': '-99.12', 'k': '5'})
+        self.assertIn('/delivery/dashboard?k=5', r.headers['Location'])
+        self.client.get('/delivery/dashboard?lat=1&lon=1')
+        html = self.client.get('/delivery/dashboard?k=5').get_data(as_text=True)
+        self.assertIn('Recoger primero', html)
+        self.assertEqual(html.count('class="gig-card"'), 5)
+        self.assertIn('>298<', html.replace(' ', ''))
+        self.assertIn('Parada 3', html)
+        self.assertNotIn('1.2 km', html)
+        # Sin N+1: el número de consultas no depende de cuántos pedidos se muestran
+        self.assertLessEqual(self.app.extensions['metricas'].ultima['consultas'], 16)
+        with self.app.app_context():
+            # La posición queda guardada para la siguiente visita
+            self.assertEqual(Usuario.query.filter_by(email='moto@test.com').one().lat, 19.31)
+        print(" [EXITO] Los k pedidos más cercanos salen de las celdas vecinas y la ruta queda ordenada.")
+
+    # --- PRUEBA 23: SE COMPRA JUNTO CON ---
+    def test_recomendaciones_coocurrencia(self):
+        print("\n[PRUEBA 23] Verificando recomendaciones por co-ocurrencia en pedidos...")
+        from app import recomendaciones
+        from app.models import PedidoItem
+        self.client.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        with self.app.app_context():
+            cliente = Usuario.query.filter_by(email='cli@test.com').one()
+            tienda = Usuario(email='t@test.com', nombre='Tienda', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            p = [Producto(nombre=n, precio=10, stock_actual=50, tienda_id=tienda.id)
+                 for n in ('Pan', 'Leche', 'Cafe', 'Azucar', 'Jabon')]
+            db.session.add_all(p)
+            db.session.commit()
+            # Pan+Leche 3 veces, Pan+Cafe 2, Cafe+Azucar 1
+            for grupo in [(0, 1)] * 3 + [(0, 2)] * 2 + [(2, 3)]:
+                db.session.add(Pedido(cliente_id=cliente.id, total=20,
+                                      items=[PedidoItem(producto_id=p[i].id, cantidad=1) for i in grupo]))
+            db.session.commit()
+            ids = [x.id for x in p]
+            stats = recomendaciones.reconstruir()
+            self.assertEqual(stats['productos'], 4)
+            self.assertEqual(recomendaciones.junto_con(ids[0]), [(ids[1], 'Leche'), (ids[2], 'Cafe')])
+            # Solo se cargan los nombres de productos recomendados (Jabon no está en ningún top)
+            self.assertEqual(set(recomendaciones.indice().nombres), set(ids[:4]))
+
+            # Memoria acotada: un producto nunca guarda más de 'capacidad' vecinos
+            chica = recomendaciones.Coocurrencias(k=2, capacidad=3)
+            for vecino in range(100, 110):
+                chica.registrar([(1, 'a'), (vecino, 'b')])
+            chica.registrar([(1, 'a'), (109, 'b')])
+            # Fila de 1: 3 vecinos; cada vecino: solo el 1
+            self.assertEqual(chica.estadisticas()['pares'], 3 + 10)
+            self.assertEqual(chica.vecinos(1)[0], 109)
+
+        # Checkout: Jabon + Azucar se suman sin reconstruir
+        self.client.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        self.client.get('/agregar/%d' % ids[4])
+        self.client.get('/agregar/%d' % ids[3])
+        self.client.post('/carrito', data={'tipo_entrega': 'recoger', 'metodo_pago': 'efectivo'})
+        with self.app.app_context():
+            self.assertIn(ids[3], recomendaciones.indice().vecinos(ids[4]))
+
+        # El carrito sugiere lo que se compra con su contenido, sin leer el historial
+        self.client.get('/agregar/%d' % ids[0])
+        html = self.client.get('/carrito').get_data(as_text=True)
+        self.assertIn('Otros clientes también compraron', html)
+        self.assertLess(html.index('Leche'), html.index('Cafe'))
+        self.assertLessEqual(self.app.extensions['metricas'].ultima['consultas'], 4)
+        html = self.client.get('/catalogo').get_data(as_text=True)
+        self.assertIn('Se compra junto con', html)
+        # La página en cache no congela las recomendaciones: se leen al renderizar
+        with self.app.app_context():
+            recomendaciones.indice().registrar([(ids[1], 'Leche'), (ids[4], 'Jabon')])
+        nuevo = self.client.get('/catalogo').get_data(as_text=True)
+        self.assertEqual(nuevo.count('q=Jabon'), html.count('q=Jabon') + 1)
+        print(" [EXITO] Vecinos top-k en memoria, actualizados en cada pedido.")
+
+    # --- PRUEBA 24: COLA DE TRABAJOS DURABLE ---
+    def test_cola_trabajos(self):
+        print("\n[PRUEBA 24] Verificando outbox, reintentos e idempotencia de trabajos...")
+        from datetime import datetime, timedelta
+        from app import trabajos
+        from app.models import ResumenVentas, Trabajo
+        fallas = []
+
+        @trabajos.tarea('prueba.inestable')
+        def inestable(n):
+            if len(fallas) < n:
+                fallas.append(1)
+                raise RuntimeError('falla %d' % len(fallas))
+
+        self.addCleanup(trabajos.TAREAS.pop, 'prueba.inestable')
+        with self.app.app_context():
+            # Misma llave = un solo trabajo; un rollback descarta el trabajo con su transacción
+            trabajos.encolar('prueba.inestable', clave='x', n=1)
+            trabajos.encolar('prueba.inestable', clave='x', n=1)
+            db.session.commit()
+            trabajos.encolar('prueba.inestable', clave='y', n=0)
+            db.session.rollback()
+            self.assertEqual(Trabajo.query.count(), 1)
+
+            # Falla: vuelve a la cola con espera; al vencer se reintenta
+            self.assertEqual(trabajos.procesar_pendientes(), 1)
+            trabajo = Trabajo.query.one()
+            self.assertEqual((trabajo.estado, trabajo.intentos), ('pendiente', 1))
+            self.assertGreater(trabajo.disponible_en, datetime.utcnow())
+            self.assertEqual(trabajos.procesar_pendientes(), 0)
+            trabajo.disponible_en = datetime.utcnow()
+            db.session.commit()
+            trabajos.procesar_pendientes()
+            self.assertEqual(Trabajo.query.one().estado, 'hecho')
+
+            # Sin más intentos queda como fallido
+            trabajos.encolar('prueba.inestable', max_intentos=1, n=99)
+            db.session.commit()
+            trabajos.procesar_pendientes()
+            self.assertEqual(Trabajo.query.filter_by(estado='fallido').count(), 1)
+
+            # Un trabajo tomado por un proceso que murió se recupera
+            trabajos.encolar('prueba.inestable', n=0)
+            db.session.commit()
+            Trabajo.query.filter_by(estado='pendiente').update({
+                'estado': 'en_curso', 'tomado_por': 'muerto',
+                'tomado_en': datetime.utcnow() - timedelta(seconds=trabajos.VISIBILIDAD + 1)})
+            db.session.commit()
+            self.assertEqual(trabajos.procesar_pendientes(), 1)
+            self.assertEqual(trabajos.estadisticas(), {'hecho': 2, 'fallido': 1})
+
+            tienda = Usuario(email='t@test.com', nombre='T', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            prod = Producto(nombre='Pan', precio=5, stock_actual=3, tienda_id=tienda.id)
+            db.session.add(prod)
+            db.session.commit()
+            pid = prod.id
+
+        # El checkout encola el resumen y publica el aviso junto con el pedido
+        self.client.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        self.client.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        self.client.get('/agregar/%d' % pid)
+        self.client.post('/carrito', data={'tipo_entrega': 'envio', 'metodo_pago': 'efectivo'})
+        with self.app.app_context():
+            pedido = Pedido.query.one()
+            hechos = Trabajo.query.filter(Trabajo.clave.like('%%:%d' % pedido.id), Trabajo.estado == 'hecho').count()
+            self.assertEqual(hechos, 1)
+            self.assertEqual(ResumenVentas.query.one().ingreso, 5)
+        with self.app.app_context():
+            from app import eventos
+            self.assertEqual(eventos.ultimo_id(), 1)
+            # Un pedido que ya no está (archivado) no consume los reintentos
+            trabajos.encolar('ventas.registrar', pedido_id=pedido.id + 100)
+            db.session.commit()
+            trabajos.procesar_pendientes()
+            self.assertEqual(Trabajo.query.filter_by(tipo='ventas.registrar', estado='hecho').count(), 2)
+        print(" [EXITO] Efectos del checkout en cola durable, con reintentos y sin duplicados.")
+
+    # --- PRUEBA 25: CACHE DE FRAGMENTOS ---
+    def test_cache_fragmentos(self):
+        print("\n[PRUEBA 25] Verificando fragmentos de plantilla versionados por updated_at...")
+        import sqlalchemy as sa
+        from flask import render_template_string
+        from app.cache import invalidar_catalogo
+        from app.fragmentos import MemoriaFragmentos
+        fragmentos = self.app.extensions['fragmentos']
+        with self.app.app_context():
+            tienda = Usuario(email='t@test.com', nombre='Tienda', password='123', rol='tienda')
+            db.session.add(tienda)
+            db.session.commit()
+            db.session.add_all([Producto(nombre='P%d' % i, precio=10, stock_actual=5, tienda_id=tienda.id)
+                                for i in range(6)])
+            db.session.commit()
+            pid = Producto.query.first().id
+
+        self.client.get('/catalogo')
+        self.assertEqual(fragmentos.estadisticas()['misses'], 6)
+        # Segunda visita: las tarjetas salen de cache, sin volver a renderizarlas
+        html = self.client.get('/catalogo').get_data(as_text=True)
+        self.assertEqual(fragmentos.estadisticas()['hits'], 6)
+        self.assertIn('$10', html)
+        # Cada fragmento es una tarjeta completa (abre y cierra su div)
+        for tarjeta, _ in self.app.extensions['fragmentos']._datos.values():
+            self.assertTrue(tarjeta.strip().startswith('<div class="product-card">'))
+            self.assertEqual(tarjeta.count('<div'), tarjeta.count('</div>'))
+
+        # Un cambio de la tienda (sin tocar el producto) cambia la clave de sus tarjetas
+        with self.app.app_context():
+            Usuario.query.filter_by(email='t@test.com').one().nombre = 'Tienda Renombrada'
+            invalidar_catalogo()
+            db.session.commit()
+        self.assertIn('Tienda Renombrada', self.client.get('/catalogo').get_data(as_text=True))
+        self.assertEqual(fragmentos.estadisticas()['misses'], 12)
+
+        with self.app.app_context():
+            antes = db.session.get(Producto, pid).updated_at
+            # También un UPDATE masivo (como el del checkout) cambia la versión
+            db.session.execute(sa.update(Producto).where(Producto.id == pid).values(precio=77))
+            invalidar_catalogo()
+            db.session.commit()
+            self.assertGreater(db.session.get(Producto, pid).updated_at, antes)
+        html = self.client.get('/catalogo').get_data(as_text=True)
+        self.assertIn('$77', html)
+        self.assertEqual(fragmentos.estadisticas()['misses'], 13)
+
+        with self.app.test_request_context():
+            plantilla = "{% cache 'x', n %}<b>{{ valor }}</b>{% endcache %}"
+            self.assertEqual(render_template_string(plantilla, n=1, valor='<a>'), '<b>&lt;a&gt;</b>')
+            self.assertEqual(render_template_string(plantilla, n=1, valor='otro'), '<b>&lt;a&gt;</b>')
+            self.assertEqual(render_template_string(plantilla, n=2, valor='otro'), '<b>otro</b>')
+
+        # Un cliente externo (Redis, Memcached) devuelve bytes: el adaptador los decodifica
+        class ClienteBytes:
+            def __init__(self):
+                self.datos = {}
+
+            def get(self, clave):
+                return self.datos.get(clave)
+
+            def set(self, clave, valor):
+                self.datos[clave] = valor.encode('utf-8')
+
+        from flask import Flask
+        from app import fragmentos as modulo_fragmentos
+        otra = Flask('fragmentos')
+        otra.config['FRAGMENTOS_BACKEND'] = ClienteBytes()
+        modulo_fragmentos.init_app(otra)
+        self.assertIsInstance(otra.extensions['fragmentos'], modulo_fragmentos.BackendExterno)
+        with otra.test_request_context():
+            plantilla = "{% cache 'x', 1 %}<b>{{ valor }}</b>{% endcache %}"
+            self.assertEqual(render_template_string(plantilla, valor='ñ'), '<b>ñ</b>')
+            self.assertEqual(render_template_string(plantilla, valor='otro'), '<b>ñ</b>')
+
+        # Memoria acotada por entradas y por tamaño
+        chica = MemoriaFragmentos(max_items=10, max_bytes=100)
+        for n in range(20):
+            chica.set(n, 'x' * 30)
+        self.assertEqual(chica.estadisticas()['items'], 3)
+        self.assertIsNone(chica.get(0))
+        self.assertEqual(chica.get(19), 'x' * 30)
+        print(" [EXITO] Solo se renderiza lo que cambió y la memoria queda acotada.")
+
+    # --- PRUEBA 26: FEED DE CAMBIOS DEL CATÁLOGO ---
+    def test_feed_cambios(self):
+        print("\n[PRUEBA 26] Verificando feed de cambios con upserts y tombstones...")
+        from app import cambios
+        self.client.post('/auth/registro', data={'email': 'shop@test.com', 'nombre': 'Shop', 'password': '123', 'rol': 'tienda', 'telefono': '00'})
+        with self.app.app_context():
+            tienda = Usuario.query.filter_by(email='shop@test.com').one()
+            productos = [Producto(nombre='P%d' % i, precio=10, stock_actual=2, tienda_id=tienda.id) for i in range(3)]
+            productos.append(Producto(nombre='Agotado', precio=1, stock_actual=0, tienda_id=tienda.id))
+            db.session.add_all(productos)
+            db.session.commit()
+            ids = [p.id for p in productos]
+
+        # Sincronización inicial: todo lo que tiene stock
+        feed = self.client.get('/api/productos/changes?since=0&fields=nombre').get_json()
+        self.assertEqual([p['id'] for p in feed['upserts']], ids[:3])
+        self.assertEqual(feed['upserts'][0], {'id': ids[0], 'nombre': 'P0'})
+        cursor = feed['cursor']
+        self.assertEqual(self.client.get('/api/productos/changes?since=%d' % cursor).get_json()['upserts'], [])
+
+        # Cambio de precio, venta que agota un producto y ajuste que no cambia nada visible
+        self.client.post('/auth/login', data={'email': 'shop@test.com', 'password': '123'})
+        self.client.post('/inventario/ajustar_stock/%d' % ids[0], data={'nuevo_stock': '5'})
+        with self.app.app_context():
+            db.session.get(Producto, ids[1]).precio = 12
+            db.session.commit()
+        comprador = self.app.test_client()
+        comprador.post('/auth/registro', data={'email': 'cli@test.com', 'nombre': 'Cli', 'password': '123', 'rol': 'cliente', 'telefono': '00'})
+        comprador.post('/auth/login', data={'email': 'cli@test.com', 'password': '123'})
+        comprador.get('/agregar/%d' % ids[2])
+        comprador.get('/agregar/%d' % ids[2])
+        comprador.post('/carrito', data={'tipo_entrega': 'recoger', 'metodo_pago': 'efectivo'})
+
+        feed = self.client.get('/api/productos/changes?since=%d' % cursor).get_json()
+        self.assertEqual([(p['id'], p['precio']) for p in feed['upserts']], [(ids[1], 12)])
+        self.assertEqual(feed['tombstones'], [ids[2]])
+        self.assertFalse(feed['has_more'])
+
+        # Tramos acotados con has_more y compactación sin perder el estado final
+        with self.app.app_context():
+            for precio in (13, 14, 15):
+                db.session.get(Producto, ids[1]).precio = precio
+                db.session.commit()
+            self.assertGreater(cambios.compactar(), 0)
+        feed = self.client.get('/api/productos/changes?since=%d&limit=1' % cursor).get_json()
+        self.assertTrue(feed['has_more'])
+        feed = self.client.get('/api/productos/changes?since=%d' % feed['cursor']).get_json()
+        self.assertEqual([p['precio'] for p in feed['upserts']], [15])
+        self.assertEqual(self.client.get('/api/productos/changes?since=999999').status_code, 410)
+
+        # Lote por ids: los que no están disponibles se informan aparte
+        lote = self.client.get('/api/productos?ids=%d,%d,%d&fields=id' % (ids[1], ids[2], ids[3])).get_json()
+        self.assertEqual(lote['data'], [{'id': ids[1]}])
+        self.assertEqual(lote['missing'], [ids[2], ids[3]])
+        print(" [EXITO] Los clientes se sincronizan solo con lo que cambió.")
+
+    # --- PRUEBA 27: PERFIL DE BASE DE DATOS ---
+    def test_perfil_base_datos(self):
+        print("\n[PRUEBA 27] Verificando índices, pragmas de SQLite y opciones del pool...")
+        import sqlalchemy as sa
+        from flask import Flask
+        from app import basedatos, migraciones
+        carpeta = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, carpeta, True)
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(carpeta, 'perfil.db'),
+                          'TESTING': True, 'UPLOAD_FOLDER': self.uploads})
+        # Con BD en archivo la cola usa hilos; detener() los termina
+        trabajadores = app.extensions['trabajos']
+        trabajadores.iniciar()
+        hilos = [h for h in threading.enumerate() if h.name.startswith('trabajos-')]
+        self.assertEqual(len(hilos), 2)
+        trabajadores.detener()
+        self.assertFalse(any(h.is_alive() for h in hilos))
+        with app.app_context():
+            self.addCleanup(db.engine.dispose)
+
+            def indices(conexion, tabla):
+                return {fila[1] for fila in conexion.exec_driver_sql("PRAGMA index_list('%s')" % tabla)}
+
+            with db.engine.connect() as conexion:
+                self.assertLessEqual({'ix_producto_stock_categoria', 'ix_producto_categoria_stock',
+                                      'ix_producto_tienda_tipo_stock'}, indices(conexion, 'producto'))
+                self.assertLessEqual({'ix_pedido_estado_entrega', 'ix_pedido_repartidor_estado',
+                                      'ix_pedido_cliente_fecha'}, indices(conexion, 'pedido'))
+                # Una BD anterior a los índices los recibe con la migración
+                conexion.exec_driver_sql('DROP INDEX ix_pedido_cliente_fecha')
+                # ... y una anterior a updated_at, la columna con valor en las filas existentes
+                conexion.exec_driver_sql("INSERT INTO usuario (email, password, nombre, rol) VALUES ('c@test.com', 'x', 'C', 'cliente')")
+                conexion.exec_driver_sql("INSERT INTO pedido (fecha, estado, total, cliente_id) VALUES ('2024-01-02 03:04:05', 'entregado', 10, 1)")
+                conexion.exec_driver_sql('ALTER TABLE pedido DROP COLUMN updated_at')
+                conexion.commit()
+            # Conexiones nuevas: PRAGMA table_info de otra conexión del pool puede ver el esquema anterior
+            db.engine.dispose()
+            migraciones.aplicar(db.engine)
+            self.assertEqual(db.session.execute(sa.text('SELECT updated_at FROM pedido')).scalar(), '2024-01-02 03:04:05')
+
+            # Los pragmas se aplican en cada conexión nueva del pool
+            db.engine.dispose()
+            with db.engine.connect() as conexion:
+                self.assertIn('ix_pedido_cliente_fecha', indices(conexion, 'pedido'))
+                self.assertEqual(conexion.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(conexion.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+                self.assertEqual(conexion.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+
+        # Con un servidor de BD el pool se dimensiona desde la configuración
+        otra = Flask('perfil')
+        otra.config.update(SQLALCHEMY_DATABASE_URI='postgresql://u@localhost/vecimarket', DB_POOL_SIZE=4)
+        basedatos.configurar(otra)
+        opciones = otra.config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.assertEqual((opciones['pool_size'], opciones['max_overflow'], opciones['pool_pre_ping']), (4, 20, True))
+        print(" [EXITO] Índices presentes y cada conexión con WAL, NORMAL y busy_timeout.")
+
 if __name__ == '__main__':
     print("============================================")
     print("              SUITE DE PRUEBAS")
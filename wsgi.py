@@ -0,0 +1,7 @@
+from app import create_app
+
+# Punto de entrada de producción (gunicorn -c gunicorn.conf.py wsgi:app).
+# El esquema y los assets se preparan una vez por despliegue:
+#   flask --app wsgi init-db && flask --app wsgi precomprimir
+# así que cada worker arranca sin DDL ni escrituras en disco.
+app = create_app({'ESQUEMA_AUTOMATICO': False})